@@ -0,0 +1,528 @@
+# Serialization of saved vaults, shared by the app and the server
+
+# A vault file starts with a 4 byte header, then the vault encoded with the codec the header names:
+# +-------+----------------+-------+
+# | magic | format version | codec |
+# | "PV"  | 1 byte         | 1 byte|
+# +-------+----------------+-------+
+# Files without the header were written as indented json by older versions, sometimes json encoded twice. They
+# are read transparently and written back with a header on their next save
+
+# msgpack and cbor2 are optional, a codec whose package isn't installed can't be chosen but files written with it
+# are still recognised so the error is clear
+
+# The binary codec is only in the server's copy of this module. It only stores vaults shaped
+# {service: {username: entry}}, which the app's password file isn't:
+# header | records | string table | index | trailer
+# record:       !I length, then !IIH service id, username id, field count, then per field !IB name id, value type
+#               and the value. Base64 tokens (Fernet tokens, and "prefix:" followed by a token) are stored as their
+#               raw bytes, which is about 3/4 of their text. A long string used by more than one record, like an
+#               entry key shared by every entry saved in one session, is stored once in the string table and the
+#               records refer to it by id
+# string table: !I count, count + 1 !I offsets into the strings, then the utf-8 strings. Service names, usernames
+#               and field names are stored once each and records refer to them by id
+# index:        !I service count, one !IQI row per service (name id, offset of its entry table, entry count) sorted by
+#               name, then each service's entry table, one !IQ row per entry (username id, record offset) sorted by
+#               username
+# trailer:      !QQI4s offset of the string table, offset of the index, entry count, "PVIX"
+# BinaryVault looks single entries up through the index without parsing any other record
+
+import json
+import base64
+import struct
+import binascii
+import logging
+import collections
+
+import json_repair
+
+try:
+    import msgpack
+
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PV"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("!2sBB")
+
+CODEC_IDS = {
+    "json": 1,
+    "msgpack": 2,
+    "cbor": 3,
+    "binary": 4
+}
+
+CODEC_NAMES = {codec_id: codec_name for codec_name, codec_id in CODEC_IDS.items()}
+
+# How often legacy files were read, and how often strict parsing failed and json_repair had to step in
+counters = collections.Counter()
+
+
+class CodecError(Exception):
+    pass
+
+
+def available_codecs() -> list[str]:
+    return [
+        codec_name for codec_name, module in (("json", json), ("msgpack", msgpack), ("cbor", cbor2), ("binary", struct))
+        if module is not None
+    ]
+
+
+def encode(data, codec_name: str = "json") -> bytes:
+    if codec_name not in available_codecs():
+        raise CodecError(f"Codec {codec_name} isn't available")
+
+    if codec_name == "binary":
+        return encode_binary(data)
+
+    if codec_name == "msgpack":
+        encoded_data = msgpack.packb(data, use_bin_type=True)
+
+    elif codec_name == "cbor":
+        encoded_data = cbor2.dumps(data)
+
+    else:
+        encoded_data = json.dumps(data, separators=(",", ":")).encode()
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, CODEC_IDS[codec_name]) + encoded_data
+
+
+def is_legacy(raw_data: bytes) -> bool:
+    return not raw_data.startswith(MAGIC)
+
+
+def is_binary(raw_data) -> bool:
+    return raw_data[:HEADER.size] == HEADER.pack(MAGIC, FORMAT_VERSION, CODEC_IDS["binary"])
+
+
+def decode(raw_data: bytes):
+    if is_legacy(raw_data):
+        return decode_legacy(raw_data)
+
+    if len(raw_data) < HEADER.size:
+        raise CodecError("Vault header is cut off")
+
+    _, format_version, codec_id = HEADER.unpack_from(raw_data)
+
+    if format_version != FORMAT_VERSION:
+        raise CodecError(f"Unsupported vault format version {format_version}")
+
+    codec_name = CODEC_NAMES.get(codec_id)
+
+    if codec_name is None:
+        raise CodecError(f"Unknown vault codec {codec_id}")
+
+    if codec_name not in available_codecs():
+        raise CodecError(f"The vault was written with {codec_name}, which isn't installed")
+
+    if codec_name == "binary":
+        return decode_binary(raw_data)
+
+    encoded_data = raw_data[HEADER.size:]
+
+    if codec_name == "msgpack":
+        return msgpack.unpackb(encoded_data, raw=False)
+
+    if codec_name == "cbor":
+        return cbor2.loads(encoded_data)
+
+    try:
+        return json.loads(encoded_data)
+
+    except json.JSONDecodeError:
+        return repair(encoded_data.decode(errors="replace"))
+
+
+def decode_legacy(raw_data: bytes):
+    counters["legacy_reads"] += 1
+
+    text = raw_data.decode(errors="replace")
+
+    if text.strip() == "":
+        return ""
+
+    try:
+        data = json.loads(text)
+
+    except json.JSONDecodeError:
+        data = repair(text)
+
+    # Older REPLACE writes stored the vault as a json encoded string
+    if isinstance(data, str) and data != "":
+        try:
+            data = json.loads(data)
+
+        except json.JSONDecodeError:
+            data = repair(data)
+
+    return data
+
+
+def repair(text: str):
+    counters["repair_fallbacks"] += 1
+    logger.warning(
+        f"Strict parsing of a saved vault failed, repaired it with json_repair ({counters['repair_fallbacks']} so far)"
+    )
+
+    return json_repair.loads(text)
+
+
+LENGTH = struct.Struct("!I")
+RECORD_HEAD = struct.Struct("!IIH")
+FIELD_HEAD = struct.Struct("!IB")
+INTEGER = struct.Struct("!q")
+SERVICE_ROW = struct.Struct("!IQI")
+ENTRY_ROW = struct.Struct("!IQ")
+TRAILER = struct.Struct("!QQI4s")
+
+TRAILER_MAGIC = b"PVIX"
+
+# Value types of a record's fields
+TEXT = 0
+TOKEN = 1
+PREFIXED_TOKEN = 2
+INTEGER_VALUE = 3
+NONE = 4
+JSON_VALUE = 5
+STRING_REFERENCE = 6
+
+
+def token_bytes(value: str) -> bytes | None:
+    # The raw bytes of a url safe base64 string, or None if it doesn't round trip exactly
+    try:
+        raw_bytes = base64.urlsafe_b64decode(value.encode())
+
+    except (binascii.Error, ValueError):
+        return None
+
+    return raw_bytes if base64.urlsafe_b64encode(raw_bytes).decode() == value else None
+
+
+class StringTable:
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.strings: list[str] = []
+
+    def id(self, string: str) -> int:
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+
+        return self.ids[string]
+
+    def pack(self) -> bytes:
+        encoded_strings = [string.encode() for string in self.strings]
+        offsets = [0]
+
+        for encoded_string in encoded_strings:
+            offsets.append(offsets[-1] + len(encoded_string))
+
+        return (
+            LENGTH.pack(len(encoded_strings))
+            + struct.pack(f"!{len(offsets)}I", *offsets)
+            + b"".join(encoded_strings)
+        )
+
+
+def encode_field(string_table: StringTable, field: str, value, shared_values: set[str]) -> bytes:
+    field_id = string_table.id(field)
+
+    if value is None:
+        return FIELD_HEAD.pack(field_id, NONE)
+
+    if isinstance(value, int) and not isinstance(value, bool):
+        return FIELD_HEAD.pack(field_id, INTEGER_VALUE) + INTEGER.pack(value)
+
+    if isinstance(value, str):
+        if value in shared_values:
+            return FIELD_HEAD.pack(field_id, STRING_REFERENCE) + LENGTH.pack(string_table.id(value))
+
+        # Short strings are left as text, storing them raw would save next to nothing
+        raw_bytes = token_bytes(value) if len(value) >= 16 else None
+
+        if raw_bytes is not None:
+            return FIELD_HEAD.pack(field_id, TOKEN) + LENGTH.pack(len(raw_bytes)) + raw_bytes
+
+        prefix, separator, token = value.partition(":")
+        raw_bytes = token_bytes(token) if separator != "" and len(token) >= 16 else None
+
+        if raw_bytes is not None:
+            return (
+                FIELD_HEAD.pack(field_id, PREFIXED_TOKEN)
+                + LENGTH.pack(string_table.id(prefix + separator))
+                + LENGTH.pack(len(raw_bytes))
+                + raw_bytes
+            )
+
+        encoded_value = value.encode()
+
+        return FIELD_HEAD.pack(field_id, TEXT) + LENGTH.pack(len(encoded_value)) + encoded_value
+
+    encoded_value = json.dumps(value, separators=(",", ":")).encode()
+
+    return FIELD_HEAD.pack(field_id, JSON_VALUE) + LENGTH.pack(len(encoded_value)) + encoded_value
+
+
+def encode_binary(vault: dict) -> bytes:
+    if not isinstance(vault, dict) or not all(
+        isinstance(usernames, dict) and all(isinstance(entry, dict) for entry in usernames.values())
+        for usernames in vault.values()
+    ):
+        raise CodecError("The binary codec only stores vaults shaped {service: {username: entry}}")
+
+    value_counts = collections.Counter(
+        value
+        for usernames in vault.values()
+        for entry in usernames.values()
+        for value in entry.values()
+        if isinstance(value, str) and len(value) >= 16
+    )
+    shared_values = {value for value, count in value_counts.items() if count > 1}
+
+    string_table = StringTable()
+    encoded_vault = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, CODEC_IDS["binary"]))
+    record_offsets: dict[str, list[tuple[str, int]]] = {}
+
+    for service, usernames in vault.items():
+        for username, entry in usernames.items():
+            record = bytearray(RECORD_HEAD.pack(string_table.id(service), string_table.id(username), len(entry)))
+
+            for field, value in entry.items():
+                record += encode_field(string_table, field, value, shared_values)
+
+            record_offsets.setdefault(service, []).append((username, len(encoded_vault)))
+            encoded_vault += LENGTH.pack(len(record)) + record
+
+    strings_offset = len(encoded_vault)
+    encoded_vault += string_table.pack()
+
+    index_offset = len(encoded_vault)
+    services = sorted(record_offsets.keys())
+    entry_table_offset = index_offset + LENGTH.size + SERVICE_ROW.size * len(services)
+
+    encoded_vault += LENGTH.pack(len(services))
+
+    for service in services:
+        encoded_vault += SERVICE_ROW.pack(string_table.ids[service], entry_table_offset, len(record_offsets[service]))
+        entry_table_offset += ENTRY_ROW.size * len(record_offsets[service])
+
+    for service in services:
+        for username, record_offset in sorted(record_offsets[service]):
+            encoded_vault += ENTRY_ROW.pack(string_table.ids[username], record_offset)
+
+    entry_count = sum(len(usernames) for usernames in record_offsets.values())
+    encoded_vault += TRAILER.pack(strings_offset, index_offset, entry_count, TRAILER_MAGIC)
+
+    return bytes(encoded_vault)
+
+
+def decode_binary(raw_data: bytes) -> dict:
+    binary_vault = BinaryVault(raw_data)
+
+    try:
+        return binary_vault.to_vault()
+
+    finally:
+        binary_vault.release()
+
+
+class BinaryVault:
+    # Reads a binary vault from any buffer: bytes, or an mmap of the file. Only the trailer is read up front,
+    # strings and records are read as they are needed
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+
+        if len(self.buffer) < HEADER.size + TRAILER.size:
+            raise CodecError("Binary vault is cut off")
+
+        self.strings_offset, self.index_offset, self.entry_count, trailer_magic = TRAILER.unpack_from(
+            self.buffer, len(self.buffer) - TRAILER.size
+        )
+
+        if trailer_magic != TRAILER_MAGIC:
+            raise CodecError("Binary vault has no index trailer")
+
+        self.string_count = LENGTH.unpack_from(self.buffer, self.strings_offset)[0]
+        self.string_offsets_offset = self.strings_offset + LENGTH.size
+        self.string_data_offset = self.string_offsets_offset + LENGTH.size * (self.string_count + 1)
+        self.service_count = LENGTH.unpack_from(self.buffer, self.index_offset)[0]
+
+    def release(self):
+        # Must be called before the mmap the vault was read from is closed
+        self.buffer.release()
+
+    def string(self, string_id: int) -> str:
+        start, end = struct.unpack_from("!II", self.buffer, self.string_offsets_offset + LENGTH.size * string_id)
+
+        return str(self.buffer[self.string_data_offset + start:self.string_data_offset + end], "utf-8")
+
+    def find_row(self, table_offset: int, row_count: int, row_struct: struct.Struct, name: str) -> tuple | None:
+        # Binary search of an index table sorted by name
+        low, high = 0, row_count
+
+        while low < high:
+            middle = (low + high) // 2
+            row = row_struct.unpack_from(self.buffer, table_offset + row_struct.size * middle)
+            row_name = self.string(row[0])
+
+            if row_name == name:
+                return row
+
+            if row_name < name:
+                low = middle + 1
+
+            else:
+                high = middle
+
+        return None
+
+    def service_rows(self):
+        for service_number in range(self.service_count):
+            yield SERVICE_ROW.unpack_from(
+                self.buffer,
+                self.index_offset + LENGTH.size + SERVICE_ROW.size * service_number
+            )
+
+    def entry_rows(self, service_row: tuple):
+        _, entry_table_offset, entry_count = service_row
+
+        for entry_number in range(entry_count):
+            yield ENTRY_ROW.unpack_from(self.buffer, entry_table_offset + ENTRY_ROW.size * entry_number)
+
+    def read_value(self, value_type: int, offset: int, strings: list[str] | None = None) -> tuple[object, int]:
+        # Returns the value and the offset right after it
+        string = strings.__getitem__ if strings is not None else self.string
+
+        if value_type == NONE:
+            return None, offset
+
+        if value_type == INTEGER_VALUE:
+            return INTEGER.unpack_from(self.buffer, offset)[0], offset + INTEGER.size
+
+        if value_type == STRING_REFERENCE:
+            return string(LENGTH.unpack_from(self.buffer, offset)[0]), offset + LENGTH.size
+
+        prefix = ""
+
+        if value_type == PREFIXED_TOKEN:
+            prefix = string(LENGTH.unpack_from(self.buffer, offset)[0])
+            offset += LENGTH.size
+
+        value_length = LENGTH.unpack_from(self.buffer, offset)[0]
+        offset += LENGTH.size
+        value_bytes = self.buffer[offset:offset + value_length]
+        offset += value_length
+
+        if value_type in (TOKEN, PREFIXED_TOKEN):
+            return prefix + base64.urlsafe_b64encode(value_bytes).decode(), offset
+
+        if value_type == JSON_VALUE:
+            return json.loads(bytes(value_bytes)), offset
+
+        return str(value_bytes, "utf-8"), offset
+
+    def read_record(
+            self,
+            record_offset: int,
+            fields: tuple[str, ...] | None = None,
+            strings: list[str] | None = None
+    ) -> tuple[str, str, dict]:
+        # (service, username, entry) of the record at record_offset. With fields, the entry only holds those
+        string = strings.__getitem__ if strings is not None else self.string
+        offset = record_offset + LENGTH.size
+
+        service_id, username_id, field_count = RECORD_HEAD.unpack_from(self.buffer, offset)
+        offset += RECORD_HEAD.size
+        entry = {}
+
+        for _ in range(field_count):
+            field_id, value_type = FIELD_HEAD.unpack_from(self.buffer, offset)
+            offset += FIELD_HEAD.size
+            field = string(field_id)
+
+            value, offset = self.read_value(value_type, offset, strings)
+
+            if fields is None or field in fields:
+                entry[field] = value
+
+        return string(service_id), string(username_id), entry
+
+    def entry(self, service: str, username: str) -> dict | None:
+        service_row = self.find_row(self.index_offset + LENGTH.size, self.service_count, SERVICE_ROW, service)
+
+        if service_row is None:
+            return None
+
+        entry_row = self.find_row(service_row[1], service_row[2], ENTRY_ROW, username)
+
+        if entry_row is None:
+            return None
+
+        return self.read_record(entry_row[1])[2]
+
+    def service(self, service: str) -> dict | None:
+        service_row = self.find_row(self.index_offset + LENGTH.size, self.service_count, SERVICE_ROW, service)
+
+        if service_row is None:
+            return None
+
+        return {
+            self.string(username_id): self.read_record(record_offset)[2]
+            for username_id, record_offset in self.entry_rows(service_row)
+        }
+
+    def select(self, selectors: list[list[str]]) -> dict:
+        # Same result as selecting the entries from the decoded vault, see storage.select_entries
+        selected_entries = {}
+
+        for selector in selectors:
+            if len(selector) == 1:
+                usernames = self.service(selector[0])
+
+                if usernames is not None:
+                    selected_entries[selector[0]] = usernames
+
+                continue
+
+            entry = self.entry(selector[0], selector[1])
+
+            if entry is not None:
+                selected_entries.setdefault(selector[0], {})[selector[1]] = entry
+
+        return selected_entries
+
+    def listing(self) -> dict:
+        # Every entry without its password or key, see storage.list_entries
+        listing = {}
+
+        for service_row in self.service_rows():
+            listing[self.string(service_row[0])] = {
+                self.string(username_id): self.read_record(record_offset, ("last-refresh", "version"))[2]
+                for username_id, record_offset in self.entry_rows(service_row)
+            }
+
+        return listing
+
+    def to_vault(self) -> dict:
+        # The whole vault, reading the records in file order with the string table decoded once
+        strings = [self.string(string_id) for string_id in range(self.string_count)]
+        vault = {}
+        offset = HEADER.size
+
+        while offset < self.strings_offset:
+            service, username, entry = self.read_record(offset, strings=strings)
+            vault.setdefault(service, {})[username] = entry
+            offset += LENGTH.size + LENGTH.unpack_from(self.buffer, offset)[0]
+
+        return vault
@@ -0,0 +1,162 @@
+# Key hierarchy for vaults at rest
+
+# password <- entry key (wrapped by the client's main key, see main.py) <- vault data key <- key encryption key
+# Every vault has its own data key. The data key wraps each entry's key with AES-SIV, which is deterministic, so
+# an unchanged entry keeps the same stored bytes and the sqlite backend doesn't rewrite its row. The data key is
+# itself wrapped by the active key encryption key (KEK)
+
+# Routine rotation only generates a new KEK and re-wraps every vault's data key, which is a few hundred bytes per
+# vault. Replacing a vault's data key re-wraps every entry key, and is done by a separate throttled job
+
+# KEKs are kept in data/kek.json, or wherever PYPASS_KEK_PATH points so they can live off the data disk:
+# {
+#   "active": id of the KEK new data keys are wrapped with,
+#   "keys": {
+#       id: Fernet key
+#   }
+# }
+
+import os
+import json
+import base64
+import logging
+import datetime
+import threading
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESSIV
+
+import persistence
+
+logger = logging.getLogger(__name__)
+
+# Stored entry keys wrapped by a data key start with this, anything else is an entry key saved before data keys
+WRAPPED_KEY_PREFIX = "dek:"
+
+ENTRY_KEY_ASSOCIATED_DATA = [b"pypass entry key"]
+
+
+class KeyRing:
+    def __init__(self, kek_path: str = None):
+        self.kek_path = kek_path or os.environ.get("PYPASS_KEK_PATH", os.path.join("data", "kek.json"))
+        self.ring_lock = threading.Lock()
+
+        self.active_id = ""
+        self.keys: dict[str, Fernet] = {}
+        self.raw_keys: dict[str, str] = {}
+        self.loaded_mtime = None
+
+        self.reload()
+
+        if self.keys == {}:
+            self.rotate()
+
+    def reload(self):
+        with self.ring_lock:
+            try:
+                kek_stat = os.stat(self.kek_path)
+
+            except FileNotFoundError:
+                return
+
+            # Another process may have rotated the KEK, only parse the file again if it changed
+            if kek_stat.st_mtime_ns == self.loaded_mtime:
+                return
+
+            with open(self.kek_path, mode="r") as kek_file:
+                kek_data = json.load(kek_file)
+
+            self.active_id = kek_data["active"]
+            self.keys = {kek_id: Fernet(key) for kek_id, key in kek_data["keys"].items()}
+            self.raw_keys = kek_data["keys"]
+            self.loaded_mtime = kek_stat.st_mtime_ns
+
+    def write(self, active_id: str, raw_keys: dict[str, str]):
+        # The KEK file is only ever replaced whole, so a crash can't leave a half written key
+        persistence.write_json(self.kek_path, {"active": active_id, "keys": raw_keys}, indent=4)
+
+    def rotate(self) -> str:
+        self.reload()
+
+        with self.ring_lock:
+            raw_keys = dict(self.raw_keys)
+            new_id = str(max((int(kek_id) for kek_id in raw_keys.keys()), default=0) + 1)
+            raw_keys[new_id] = Fernet.generate_key().decode()
+
+            self.write(new_id, raw_keys)
+
+        self.reload()
+
+        logger.info(f"Rotated key encryption key, KEK {new_id} is now active")
+
+        return new_id
+
+    def retire(self, kek_ids_in_use: set[str]):
+        # Drop KEKs no vault is wrapped with any more. The active KEK and the one before it are always kept, a
+        # worker may still be saving a vault wrapped with the previous KEK while the rotation runs
+        self.reload()
+
+        with self.ring_lock:
+            raw_keys = {
+                kek_id: key for kek_id, key in self.raw_keys.items()
+                if kek_id in kek_ids_in_use or int(kek_id) >= int(self.active_id) - 1
+            }
+
+            if raw_keys.keys() == self.raw_keys.keys():
+                return
+
+            self.write(self.active_id, raw_keys)
+
+        self.reload()
+
+    def wrap(self, data_key: bytes) -> tuple[str, str]:
+        self.reload()
+
+        return self.active_id, self.keys[self.active_id].encrypt(data_key).decode()
+
+    def unwrap(self, kek_id: str, wrapped_data_key: str) -> bytes:
+        if kek_id not in self.keys:
+            self.reload()
+
+        return self.keys[kek_id].decrypt(wrapped_data_key.encode())
+
+
+def new_data_key(key_ring: KeyRing) -> tuple[bytes, dict]:
+    data_key = AESSIV.generate_key(512)
+    kek_id, wrapped_data_key = key_ring.wrap(data_key)
+
+    return data_key, {
+        "kek_id": kek_id,
+        "wrapped_data_key": wrapped_data_key,
+        "data_key_created": datetime.datetime.now().strftime(format="%m-%d-%Y")
+    }
+
+
+def rewrap_data_key(key_ring: KeyRing, metadata: dict) -> dict:
+    # Moves a vault's data key to the active KEK without touching any entry
+    data_key = key_ring.unwrap(metadata["kek_id"], metadata["wrapped_data_key"])
+    kek_id, wrapped_data_key = key_ring.wrap(data_key)
+
+    return {
+        **metadata,
+        "kek_id": kek_id,
+        "wrapped_data_key": wrapped_data_key
+    }
+
+
+def wrap_entry_key(data_key: bytes, entry_key: str) -> str:
+    if entry_key.startswith(WRAPPED_KEY_PREFIX):
+        return entry_key
+
+    wrapped_entry_key = AESSIV(data_key).encrypt(entry_key.encode(), ENTRY_KEY_ASSOCIATED_DATA)
+
+    return WRAPPED_KEY_PREFIX + base64.urlsafe_b64encode(wrapped_entry_key).decode()
+
+
+def unwrap_entry_key(data_key: bytes, stored_entry_key: str) -> str:
+    if not stored_entry_key.startswith(WRAPPED_KEY_PREFIX):
+        return stored_entry_key
+
+    wrapped_entry_key = base64.urlsafe_b64decode(stored_entry_key.removeprefix(WRAPPED_KEY_PREFIX))
+
+    return AESSIV(data_key).decrypt(wrapped_entry_key, ENTRY_KEY_ASSOCIATED_DATA).decode()
@@ -1,8 +1,18 @@
 # Data structure
 # data /
-#   client_addr /
+#   client_addr / (flat layout, or ab / cd / vault id / with the hashed layout, see storage.DataLayout)
 #     Client user /
-#       .passwords.json
+#       .passwords.json (json storage backend)
+#       .passwords.lock
+#       .owner.json (hashed layout)
+#   layout.json (only once a data tree has been migrated with --migrate-layout)
+#   manifest.sqlite3 (path, size, entry count, version and last write of every vault, json storage backend)
+#   vaults.sqlite3 (sqlite storage backend)
+#   kek.json (see envelope.py)
+#   rotation_due.sqlite3 (when each vault is next due for key rotation)
+#   rotation.checkpoint (only while a key rotation is running, see rotation.py)
+#   wal /
+#     <pid>.log (write-ahead log of each process, with --wal, see wal.py)
 #   data.json
 import asyncio
 # .passwords data structure
@@ -19,17 +29,30 @@ import json
 import pprint
 import time
 import socket
+import sqlite3
 import logging
 import traceback
 
 import cryptography.fernet
+import cryptography.exceptions
 import schedule
 import datetime
 import threading
 import netifaces
+import argparse
 import json_repair
+import multiprocessing
 from cryptography.fernet import Fernet
 
+import merkle
+import envelope
+import protocol
+import storage
+import wal
+import codec
+import rotation
+import persistence
+
 def get_connection_data():
     if os.path.exists("data/data.json"):
         connection_data = tuple(json_repair.from_file("data/data.json"))
@@ -52,183 +75,220 @@ def get_connection_data():
         if not os.path.exists("data"):
             os.mkdir("data")
 
-        with open("data/data.json", mode="w") as connection_file:
-            json.dump(connection_data, connection_file, indent=4)
+        persistence.write_json("data/data.json", connection_data, indent=4)
 
     return connection_data
 
-def refresh_keys():
+def refresh_keys(max_age_days: int, max_entries_per_second: int, cpu_budget: float):
+    # Weekly rotation: a new key encryption key, and every vault the rotation index says is due either gets its data
+    # key re-wrapped with it or, once older than max_age_days, replaced. The work is fanned out to worker processes
+    # by rotation.run_rotation
     logger.info("Running refresh_keys")
 
-    data_folder = os.path.join(os.getcwd(), "data")
-
-    for client_folder in os.listdir(data_folder):
-        for username_folder in os.listdir(os.path.join(data_folder, client_folder)):
-            if os.path.isdir(os.path.join(data_folder, client_folder)):
-                user_folder_path = os.path.join(data_folder, client_folder, username_folder)
-                saved_data = json_repair.from_file(user_folder_path + ".passwords.json")
-
-                if isinstance(saved_data, dict) and saved_data != {}:
-                    for saved_service in saved_data.keys():
-                        for saved_username in saved_data[saved_service].keys():
-                            last_refreshed = saved_data[saved_service][saved_username]["last-refresh"]
-                            last_refreshed_date = datetime.date(
-                                month=int(last_refreshed.split("-")[0]),
-                                day=int(last_refreshed.split("-")[1]),
-                                year=int(last_refreshed.split("-")[2])
-                            )
-
-                            today = datetime.date.today()
-                            if last_refreshed_date.month - today.month == 0 and last_refreshed_date.day - today.day == 0 and last_refreshed_date.year - today.year == 0\
-                                and last_refreshed_date.month != today.month and last_refreshed_date.day != today.day and last_refreshed_date.year != today.year:
-                                print("Inside second if statement")
-                                old_key = saved_data[saved_service][saved_username]["key"].encode()
-                                old_cipher = Fernet(old_key)
-
-                                new_key = Fernet.generate_key()
-                                new_cipher = Fernet(new_key)
-                                saved_data[saved_service][saved_username]["key"] = new_key.decode()
-                                saved_data[saved_service][saved_username]["password"] = new_cipher.encrypt(
-                                    old_cipher.decrypt(
-                                        saved_data[saved_service][saved_username]["password"].encode()
-                                    )
-                                ).decode()
-
-                    with open(f"data/{user_folder_path}/.passwords.json", mode="w") as passwords_file:
-                        json.dump(saved_data, passwords_file, indent=4)
+    report = rotation.run_rotation(
+        vault_store,
+        key_ring,
+        rotation_index,
+        arguments.storage,
+        max_age_days=max_age_days,
+        max_entries_per_second=max_entries_per_second,
+        cpu_budget=cpu_budget,
+        stop_event=stop_event,
+        vault_codec=arguments.vault_codec,
+        group_commit_window=arguments.group_commit_window / 1000,
+        wal_checkpoint_bytes=arguments.wal_checkpoint_mb * 1024 * 1024 if arguments.wal else None
+    )
+
+    logger.info(f"refresh_keys done, entries rotated: {report['rotated']}, skipped: {report['skipped']}, failed: {report['failed']}")
 
 def start_scheduled_tasks():
     while not stop_event.is_set():
         schedule.run_pending()
         time.sleep(5)
 
-class Client:
-    def __init__(self, user_client: socket.socket, client_address: float):
-        global client_connected
-        client_connected = True
+class RequestError(Exception):
+    # A request that can't be served. The message is sent back to the client, along with any fields in details
+    def __init__(self, message: str, details: dict | None = None):
+        super().__init__(message)
 
-        logger.info("New client connected")
+        self.details = details or {}
+
+class VersionConflict(RequestError):
+    # The vault changed since the version the client expected. Nothing was written, the client can reload and retry
+    def __init__(self, expected_version: int, current_version: int):
+        super().__init__(
+            f"Vault is at version {current_version}, not {expected_version}",
+            {"code": "conflict", "retryable": True, "version": current_version}
+        )
 
-        print("Received new connection")
-        self.client_user = client.recv(1024)
-        print("Received client user")
+class KeyTable:
+    # Entry keys wrapped by the client's main key, for the request being served. Every entry saved with the same key
+    # is given the same wrapped key, so a vault stores each key once however many entries use it, and each distinct
+    # wrapped key is only decrypted once per request
+    def __init__(self, client_fernet: Fernet):
+        self.client_fernet = client_fernet
 
-        client_key = client.recv(1024)
-        print("Received client key")
-        print(client_key.decode())
+        self.wrapped_keys: dict[bytes, str] = {}
+        self.keys: dict[str, bytes] = {}
+        self.ciphers: dict[str, Fernet] = {}
 
-        self.client_fernet = Fernet(client_key)
+    def wrap(self, key: bytes) -> str:
+        if key not in self.wrapped_keys:
+            wrapped_key = self.client_fernet.encrypt(key).decode()
+
+            self.wrapped_keys[key] = wrapped_key
+            self.keys[wrapped_key] = key
+
+        return self.wrapped_keys[key]
+
+    def unwrap(self, wrapped_key: str) -> bytes:
+        if wrapped_key not in self.keys:
+            key = self.client_fernet.decrypt(wrapped_key)
+
+            self.keys[wrapped_key] = key
+
+            # New entries with this key reuse the wrapped key already saved
+            self.wrapped_keys.setdefault(key, wrapped_key)
+
+        return self.keys[wrapped_key]
+
+    def cipher(self, wrapped_key: str) -> Fernet:
+        if wrapped_key not in self.ciphers:
+            self.ciphers[wrapped_key] = Fernet(self.unwrap(wrapped_key))
+
+        return self.ciphers[wrapped_key]
 
-        self.client_addr = client_address[0]
-        self.client = user_client
+class Client:
+    # Untyped commands sent by older apps, mapped to (op, mode). Every other op is only served to typed requests
+    LEGACY_COMMANDS = {
+        "DOWNLOAD_DATA": ("download", None)
+    }
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
 
+        self.client_addr = writer.get_extra_info("peername")[0]
 
-        logger.info("Collected client connection and address")
+        self.client_user = b""
+        self.client_fernet = None
+        self.digest_key = b""
 
         self.key = Fernet.generate_key()
         self.cipher = Fernet(self.key)
-        self.client.sendall(self.client_fernet.encrypt(self.key))
-        print("Sent server key")
 
-        logger.info("Set up server cipher")
+        # Replaced for every request, see dispatch
+        self.key_table: KeyTable | None = None
+
+        # Set once the app negotiates a session cipher, see protocol.py
+        self.session_channel: protocol.SessionChannel | None = None
 
-        threading.Thread(target=asyncio.run, args=(self.receive_messages(),)).start()
+        # Handler of every request op, see parse_request
+        self.request_handlers = {
+            "download": self.download_request,
+            "tree_digests": self.tree_digests_request,
+            "list": self.list_request,
+            "fetch": self.fetch_request,
+            "update": self.update_request,
+            "batch": self.batch_request
+        }
 
-        logger.info("Started message receiver")
+    async def run(self):
+        logger.info("New client connected")
 
-    def encrypt_data(self, data: str) -> list[str] | bytes:
-        # Check if data can be converted to dict
         try:
-            data: dict = json.loads(data)
-            logger.info("Successfully loaded data")
+            await self.handshake()
+            await self.receive_messages()
 
-        except json.decoder.JSONDecodeError:
-            # Assume can't be converted to dict, encrypt as message
-            logger.warning("Couldn't load data, assuming data is a string, not a dictionary")
+        except (ConnectionError, protocol.ProtocolError, ValueError) as e:
+            logger.warning(f"Closing connection from {self.client_addr}: {e}")
 
-            encrypted_data = self.client_fernet.encrypt(self.cipher.encrypt(data.encode()))
+        finally:
+            self.writer.close()
 
-            logger.info("Successfully encrypted data")
-            return encrypted_data
+            try:
+                await self.writer.wait_closed()
 
-        # Data can be converted into dict, converting as dict
-        logger.info("Breaking down data and encrypting it")
+            except ConnectionError:
+                pass
 
-        encrypted_data = []
+            logger.info("Client disconnected")
 
-        for broken_down_data in self.break_down_data(data):
-            encrypted_data.append(
-                self.client_fernet.encrypt(
-                    self.cipher.encrypt(broken_down_data)
-                )
-            )
+    async def handshake(self):
+        self.client_user = await self.receive_handshake()
+        client_key = await self.receive_handshake()
 
-        logger.info("Successfully broke down and encrypted data")
+        self.client_fernet = Fernet(client_key)
+        self.digest_key = merkle.derive_digest_key(client_key)
 
-        return encrypted_data
+        logger.info("Collected client user and key")
 
-    def decrypt_data(self, data: bytes) -> dict | bytes:
-        # Check if data can be converted to dict
-        try:
-            logger.info("Attempting to decrypt data and load into dictionary")
-            decrypted_data_string = self.client_fernet.decrypt(self.cipher.decrypt(data))
-            decrypted_data_dictionary: dict = json.loads(decrypted_data_string)
+        await protocol.write_frame(self.writer, protocol.HANDSHAKE, self.client_fernet.encrypt(self.key))
 
-            logger.info("Successfully decrypted and loaded data to dictionary")
-            return decrypted_data_dictionary
+        logger.info("Set up server cipher")
 
-        except json.decoder.JSONDecodeError:
-            # Assume data can't be converted to dict, decrypt message
-            logger.warning("Data couldn't be loaded into dictionary. Assuming its a string")
+    def encrypt_data(self, data: bytes) -> tuple[int, bytes]:
+        # Returns the frame type and payload to send data as, encrypted with the session cipher if one was
+        # negotiated, otherwise with the session key and the client's main key
+        if self.session_channel is not None:
+            return protocol.SESSION_DATA, self.session_channel.encrypt(data)
 
-            decrypted_data = self.client_fernet.decrypt(self.cipher.decrypt(data.decode()))
+        return protocol.DATA, self.client_fernet.encrypt(self.cipher.encrypt(data))
 
-            logger.info("Successfully decrypted data")
-            return decrypted_data
+    def decrypt_data(self, message_type: int, data: bytes) -> bytes:
+        if message_type == protocol.SESSION_DATA and self.session_channel is not None:
+            return self.session_channel.decrypt(data)
 
-    async def receive_all(self) -> str:
-        print("Receive_all called")
+        if message_type == protocol.DATA:
+            return self.client_fernet.decrypt(self.cipher.decrypt(data))
 
-        encrypted_received_data: bytes = b""
+        raise protocol.ProtocolError(f"Expected a data frame, received message type {message_type}")
 
-        while True:
-            print("Receiving new data")
-            new_received_data: bytes = self.client.recv(1024)
+    async def receive_handshake(self) -> bytes:
+        message_type, payload = await protocol.read_frame_async(self.reader)
 
-            print(
-                f"\n ------------------------------ \n    Total received data: {encrypted_received_data} \n ------------------------------ ")
-            print(
-                f"\n ------------------------------ \n    New data received: {new_received_data} \n ------------------------------ ")
+        if message_type != protocol.HANDSHAKE:
+            raise protocol.ProtocolError("Expected a handshake frame")
 
-            try:
-                print("Trying to decrypt total received data")
+        return payload
 
-                encrypted_received_data += new_received_data
-                decrypted_received_data: str = self.client_fernet.decrypt(self.cipher.decrypt(encrypted_received_data)).decode()
+    async def negotiate_session(self, offer_payload: bytes):
+        cipher_name, nonce = protocol.choose_session_cipher(offer_payload)
 
-            except cryptography.fernet.InvalidToken:
-                print("Couldn't decrypt received data")
+        await protocol.write_frame(self.writer, protocol.HANDSHAKE, json.dumps({"session_cipher": cipher_name}).encode())
 
-                print(type(new_received_data))
-                print(new_received_data.decode() == "DONE" or new_received_data == b"DONE")
+        if cipher_name is not None:
+            self.session_channel = protocol.SessionChannel(self.key, cipher_name, nonce, is_server=True)
 
-                if new_received_data.decode() == "":
-                    break
+        logger.info(f"Negotiated session cipher {cipher_name}")
 
+    async def send_message(self, data: bytes):
+        await protocol.write_frame(self.writer, *self.encrypt_data(data))
 
-                elif new_received_data.decode() == "DONE" or new_received_data == b"DONE":
-                    print("DONE message received")
-                    break
+    async def send_status(self, message: str):
+        await protocol.write_frame(self.writer, protocol.STATUS, message.encode())
 
-            else:
-                print("Data was successfully decrypted, breaking out of while loop")
-                # encrypted_received_data = b""
-                break
+    async def receive_all(self) -> str:
+        try:
+            message_type, encrypted_received_data = await protocol.read_frame_async(self.reader)
+
+            if message_type == protocol.HANDSHAKE and self.session_channel is None:
+                await self.negotiate_session(encrypted_received_data)
+                message_type, encrypted_received_data = await protocol.read_frame_async(self.reader)
+
+        except (ConnectionError, protocol.ProtocolError):
+            logger.warning("Connection closed or sent an invalid frame")
+            return ""
 
         try:
-            return decrypted_received_data
+            return self.decrypt_data(message_type, encrypted_received_data).decode()
+
+        except (cryptography.fernet.InvalidToken, cryptography.exceptions.InvalidTag):
+            logger.error("Couldn't decrypt received frame")
+            return ""
 
-        except UnboundLocalError:
+        except protocol.ProtocolError as e:
+            logger.warning(e)
             return ""
 
     async def receive_messages(self):
@@ -243,254 +303,597 @@ class Client:
                 logger.warning("Received empty message, returning")
                 return
 
-            # logger.info("Decrypting data")
-            # print("Decrypting data")
-            saved_data: dict = self.load_device_data()
+            request = self.parse_request(decrypted_data)
+
+            if request is None:
+                logger.warning("Received an unknown command, ignoring it")
+                continue
+
+            if request["legacy"] and request["op"] == "update":
+                # Older apps send the update mode as a second message
+                request["mode"] = await self.receive_all()
+
+                if request["mode"] == "":
+                    logger.warning("Connection closed before update depth was received, returning")
+                    return
+
+            await self.dispatch(request)
+
+    def parse_request(self, message: str) -> dict | None:
+        # Typed requests are json objects with a string "op":
+        # {"op": op, "mode": optional mode, "payload": optional payload, "id": request id echoed in the response,
+        #  "expected_version": optional vault version writes are only applied on}
+        # Anything else is one of the untyped messages older apps send, and is turned into the same request
+        try:
+            message_data = json.loads(message)
+
+        except json.decoder.JSONDecodeError:
+            message_data = None
+
+        if isinstance(message_data, dict) and isinstance(message_data.get("op"), str):
+            return {
+                "op": message_data["op"],
+                "mode": message_data.get("mode"),
+                "payload": message_data.get("payload"),
+                "id": message_data.get("id"),
+                "expected_version": message_data.get("expected_version"),
+                "legacy": False
+            }
+
+        if isinstance(message_data, dict):
+            # An untyped upload, the whole dict is the payload
+            return {"op": "update", "mode": None, "payload": message_data, "id": None, "expected_version": None, "legacy": True}
+
+        if message in self.LEGACY_COMMANDS:
+            op, mode = self.LEGACY_COMMANDS[message]
+
+            return {"op": op, "mode": mode, "payload": None, "id": None, "expected_version": None, "legacy": True}
+
+        return None
+
+    async def dispatch(self, request: dict):
+        handler = self.request_handlers.get(request["op"])
+
+        if handler is None:
+            return await self.respond(request, error=f"Unknown op {request['op']}")
+
+        self.key_table = KeyTable(self.client_fernet)
+
+        try:
+            response_payload = await handler(request)
+
+        except RequestError as e:
+            logger.error(e)
+            return await self.respond(request, error=str(e), error_details=e.details)
+
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.error(f"Invalid {request['op']} request: {e!r}")
+            return await self.respond(request, error=f"Invalid {request['op']} request")
+
+        # The session stays up, only this request fails
+        except (cryptography.fernet.InvalidToken, cryptography.exceptions.InvalidTag) as e:
+            logger.error(f"Couldn't decrypt saved data for {request['op']} request: {e!r}")
+            return await self.respond(request, error=f"Failed to {request['op']}. Saved data couldn't be decrypted")
+
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Storage error during {request['op']} request: {e!r}")
+            return await self.respond(request, error=f"Failed to {request['op']}. Storage error")
+
+        await self.respond(request, response_payload)
+
+    async def respond(
+            self,
+            request: dict,
+            payload=None,
+            error: str | None = None,
+            partial: bool = False,
+            error_details: dict | None = None
+    ):
+        # Typed requests get one response envelope, {"id", "status": "ok" | "error" | "partial", "payload" | "error"},
+        # streamed ops send "partial" responses before the final one. Untyped requests are answered the way older
+        # apps expect, with a status after an update and the decrypted vault after a download
+        if not request["legacy"]:
+            response = {"id": request["id"], "status": "error" if error is not None else "partial" if partial else "ok"}
+
+            if error is not None:
+                response["error"] = error
+                response.update(error_details or {})
+
+            else:
+                response["payload"] = payload
+
+            return await self.send_message(json.dumps(response).encode())
+
+        if request["op"] == "update":
+            await self.send_status(error if error is not None else "Successfully updated data")
+
+            return
+
+        if error is not None:
+            await self.send_message(error.encode())
+
+        else:
+            await self.send_message(json.dumps(payload).encode())
+
+    async def download_request(self, request: dict) -> dict:
+        logger.info("Client requested user data. Decrypting user data")
+
+        # Loading and decrypting run off the event loop, so other sessions are served while a large vault is read
+        saved_version, saved_data = await asyncio.to_thread(self.load_versioned_data)
+
+        if saved_data == {}:
+            raise RequestError("Failed to download passwords. No data saved")
+
+        if request["mode"] == "STREAM":
+            # One response per service, so only one service is ever decrypted and serialised at a time
+            for service_data in self.break_down_data(saved_data):
+                await self.respond(request, await asyncio.to_thread(self.decrypt_services, service_data), partial=True)
+
+            logger.info("Successfully streamed user data to client")
+
+            return {"services": len(saved_data), "version": saved_version}
+
+        logger.info("Successfully decrypted user data. Sending to client")
+
+        return await asyncio.to_thread(self.decrypt_services, saved_data)
+
+    def load_versioned_data(self) -> tuple[int, dict]:
+        # Version read before the vault, so a write in between can only make the version older than the data sent
+        saved_version = vault_store.version(self.client_addr, self.client_user.decode())
+
+        return saved_version, self.load_device_data()
+
+    async def tree_digests_request(self, request: dict) -> list:
+        # The client walks our hash tree from the root to find which entries differ, one level per request
+        requested_paths: list[list[str]] = request["payload"]
+        saved_tree = await asyncio.to_thread(vault_store.load_tree, self.client_addr, self.client_user.decode())
+
+        if saved_tree is not None:
+            vault_tree = merkle.VaultTree(saved_tree)
+
+        else:
+            # Building the missing tree saves it. It is built under the vault lock like any other write, so it can't
+            # be built from a vault an update is replacing and then overwrite the update's tree
+            async with storage.VaultLock(vault_store.vault_folder(self.client_addr, self.client_user.decode())):
+                vault_tree = await asyncio.to_thread(self.load_vault_tree)
+
+        logger.info(f"Sending {len(requested_paths)} tree node(s) to client")
+
+        return [vault_tree.describe(path) for path in requested_paths]
+
+    async def list_request(self, _request: dict) -> dict:
+        # What is saved, without any password or key, so nothing is decrypted or unwrapped
+        listing = await asyncio.to_thread(self.load_listing)
+
+        logger.info(f"Sending listing of {len(listing['services'])} service(s) to client")
+
+        return listing
+
+    def load_listing(self) -> dict:
+        return {
+            "version": vault_store.version(self.client_addr, self.client_user.decode()),
+            "services": vault_store.load_listing(self.client_addr, self.client_user.decode())
+        }
+
+    async def fetch_request(self, request: dict) -> dict:
+        # Selected entries only, the payload is [[service], [service, username], ...]. Only those entries are
+        # loaded and decrypted, services or usernames that aren't saved are left out of the response
+        selectors = request["payload"]
+
+        if not self.valid_selectors(selectors):
+            raise RequestError("Failed to fetch passwords. Invalid selectors")
+
+        saved_entries = await asyncio.to_thread(
+            vault_store.load_entries,
+            self.client_addr,
+            self.client_user.decode(),
+            selectors
+        )
+
+        logger.info(f"Sending {sum(len(entries) for entries in saved_entries.values())} fetched entries to client")
+
+        return await asyncio.to_thread(self.decrypt_services, saved_entries)
+
+    def check_version(self, request: dict):
+        # Compare and set: a write that names the vault version it was based on is only applied on that version
+        if request["expected_version"] is None:
+            return
+
+        current_version = vault_store.version(self.client_addr, self.client_user.decode())
+
+        if current_version != request["expected_version"]:
+            raise VersionConflict(request["expected_version"], current_version)
+
+    async def update_request(self, request: dict) -> dict:
+        # Older apps only ever sent whole vaults, deltas are typed requests
+        if request["mode"] not in (("RECURSIVE", "REPLACE") if request["legacy"] else ("RECURSIVE", "REPLACE", "DELTA")):
+            raise RequestError("Failed to update data. Invalid update_depth sent")
+
+        # Checked before waiting for the lock so a stale writer fails fast, and again once the lock is held
+        self.check_version(request)
+
+        # Reload the saved data while holding the vault lock, another session or worker may have written it since
+        # this message was received
+        async with storage.VaultLock(vault_store.vault_folder(self.client_addr, self.client_user.decode())):
+            self.check_version(request)
 
             try:
-                decrypted_data: dict = json.loads(decrypted_data)
+                logger.info("Updating saved data with received data")
+                pprint.pprint(f"Update depth is: {request['mode']}")
 
-            except json.decoder.JSONDecodeError:
+                # The save waits on the disk, and with group commit on the saves of other sessions. It runs off the
+                # event loop so those sessions keep being served and can join the same commit
+                saved_version = await asyncio.to_thread(self.update_vault, request["mode"], request["payload"])
+
+            except Exception:
                 print(traceback.format_exc())
 
-                logger.info("Received data was not a dictionary. Checking for data request")
+                raise RequestError("Failed to update data. Invalid data")
+
+        logger.info("Successfully updated saved data")
 
-                print("Decrypted data wasn't a dictionary")
-                decrypted_user_data = {}
+        return {"version": saved_version}
 
-                print(decrypted_data)
+    async def batch_request(self, request: dict) -> dict:
+        # Applies every operation in the payload to the vault, or none of them. The vault is loaded and persisted
+        # once, and the response reports a status per operation:
+        # {"committed": bool, "version": new vault version or None, "results": [{"status": "ok" | "error", "error"}]}
+        operations: list[dict] = request["payload"]["operations"]
 
-                if decrypted_data == "DOWNLOAD_DATA":
-                    logger.info("Client requested user data. Decrypting user data")
-                    print(f"Saved data is: {saved_data}")
-                    print(f"Saved data is of type: {type(saved_data)}")
+        self.check_version(request)
 
-                    if saved_data == {} or saved_data == "{}":
-                        await asyncio.to_thread(self.client.sendall, self.cipher.encrypt(b"Failed to download passwords. No data saved"))
+        async with storage.VaultLock(vault_store.vault_folder(self.client_addr, self.client_user.decode())):
+            self.check_version(request)
 
-                    for service in saved_data.keys():
-                        for username in saved_data[service].keys():
-                            saved_key = self.client_fernet.decrypt(saved_data[service][username]["key"])
-                            cipher = Fernet(saved_key)
+            # Off the event loop, like update_request
+            committed, saved_version, results = await asyncio.to_thread(self.apply_batch, operations)
 
-                            if service not in decrypted_user_data.keys():
-                                decrypted_user_data[service] = {
-                                    username: {
-                                        "password": cipher.decrypt(
-                                            saved_data[service][username]["password"].encode()
-                                        ).decode(),
-                                        "key": saved_key.decode()
-                                    }
-                                }
+        logger.info(f"Batch of {len(operations)} operation(s) {'committed' if committed else 'rolled back'}")
 
-                            else:
-                                decrypted_user_data[service][username] = {
-                                    "password": cipher.decrypt(
-                                        saved_data[service][username]["password"].encode()
-                                    ).decode(),
-                                    "key": saved_key.decode()
-                                }
+        return {
+            "committed": committed,
+            "version": saved_version,
+            "results": results
+        }
 
-                    logger.info("Successfully decrypted user data. Sending to client")
+    def apply_batch(self, operations: list[dict]) -> tuple[bool, int | None, list[dict]]:
+        # Returns whether the batch was committed, the version it saved and the result of every operation. The
+        # caller holds the vault lock
+        results = []
 
-                    decrypted_user_data_bytes: bytes = json.dumps(decrypted_user_data).encode()
-                    encrypted_data = self.client_fernet.encrypt(self.cipher.encrypt(decrypted_user_data_bytes))
+        saved_data: dict = self.load_device_data()
+        vault_tree = self.load_vault_tree(saved_data)
+        new_version = vault_store.version(self.client_addr, self.client_user.decode()) + 1
 
-                    print(
-                        f"\n ------------------------------ \n    Total data sent: {encrypted_data} \n ------------------------------ ")
+        for operation in operations:
+            # Every operation is still tried after a failure, so the client hears about all of them at once
+            try:
+                self.apply_operation(saved_data, operation, new_version, vault_tree)
+                results.append({"status": "ok"})
 
-                    await asyncio.to_thread(self.client.sendall, encrypted_data)
-                    await asyncio.to_thread(self.client.sendall, b"DONE")
+            except (ValueError, KeyError, TypeError, AttributeError, cryptography.fernet.InvalidToken) as e:
+                results.append({"status": "error", "error": str(e) or type(e).__name__})
 
-                    logger.info("Successfully sent user data to client")
+        committed = all(result["status"] == "ok" for result in results)
+        saved_version = None
 
-            else:
-                print("Decrypted data was dictionary")
-                print(decrypted_data)
+        # Nothing was written so far, a failed batch leaves the saved vault untouched
+        if committed:
+            saved_version = vault_store.save(self.client_addr, self.client_user.decode(), saved_data)
+            vault_store.save_tree(self.client_addr, self.client_user.decode(), vault_tree.to_dict())
 
-                update_depth: str = await self.receive_all()
+        return committed, saved_version, results
 
-                while update_depth == "":
-                    update_depth: str = await self.receive_all()
+    def update_vault(self, mode: str, decrypted_data: dict) -> int:
+        saved_data: dict = self.load_device_data()
 
-                try:
-                    logger.info("Updating saved data with received data")
-
-                    pprint.pprint(f"Update depth is: {update_depth}")
-
-                    # Check update_depth to figure out if update should be recursive or not
-                    if update_depth == "RECURSIVE":
-                        # Loop through all the saved services. delete all services that are saved from decrypted_data
-
-                        for saved_service in saved_data.keys():
-                            for saved_username in saved_data[saved_service]:
-                                del decrypted_data[saved_service][saved_username]
-
-
-                        # Loop through all services in decrypted_data. If a service is empty, then all its usernames were deleted and no changes were made to that service, so you can remove it
-                        for decrypted_service in decrypted_data.keys():
-                            if decrypted_data[decrypted_service] is dict:
-                                del decrypted_data[decrypted_service]
-
-                        for decrypted_service in decrypted_data.keys():
-                            for decrypted_username in decrypted_data[decrypted_service].keys():
-
-                                # Check if the decrypted service is already saved. If so, add new username. If not, add new service
-                                if decrypted_service in saved_data.keys():
-
-                                    saved_data[decrypted_service][decrypted_username] = {
-                                        "password": decrypted_data[decrypted_service][decrypted_username]["password"],
-                                        "key": self.client_fernet.encrypt(self.key).decode()
-                                    }
-
-                                else:
-                                    saved_data[decrypted_service] = {
-                                        decrypted_username: {
-                                            "password": decrypted_data[decrypted_service][decrypted_username]["password"],
-                                            "key": self.client_fernet.encrypt(self.key).decode()
-                                        }
-                                    }
-
-                        for saved_service in saved_data.keys():
-                            for saved_username in saved_data[saved_service].keys():
-                                print(saved_data[saved_service][saved_username]["password"])
-                                # Check if the saved key matches the key saved for the current cipher. If so, encrypt it
-                                # using current cipher. If not, create temporary cipher with saved key
-                                if self.client_fernet.decrypt(saved_data[saved_service][saved_username]["key"]) == self.key:
-                                    saved_data[saved_service][saved_username]["password"] = self.cipher.encrypt(
-                                            saved_data[saved_service][saved_username]["password"].encode()
-                                    ).decode()
-
-                                    saved_data[saved_service][saved_username]["last-refresh"] = (datetime.datetime.now()
-                                                                                                 .strftime(format="%m-%d-%Y"))
-
-                                else:
-                                    temp_cipher = Fernet(self.client_fernet.decrypt(saved_data[saved_service][saved_username]["key"]))
-                                    saved_data[saved_service][saved_username]["password"] = temp_cipher.encrypt(
-                                        saved_data[saved_service][saved_username]["password"].encode()).decode()
-
-                                    saved_data[saved_service][saved_username]["last-refresh"] = (datetime.datetime.now()
-                                                                                                 .strftime(format="%m-%d-%Y"))
-                                    saved_data[saved_service][saved_username]["key"] = self.client_fernet.encrypt(saved_data[saved_service][saved_username]["key"].encode()).decode()
-
-                        with open(f"data/{self.client_addr}/{self.client_user.decode()}/.passwords.json", mode="w") as passwords_file:
-
-                            json.dump(saved_data, passwords_file, indent=4)
-
-                    elif update_depth == "REPLACE":
-                        saved_data = {}
-                        for decrypted_service in decrypted_data.keys():
-                            for decrypted_username in decrypted_data[decrypted_service].keys():
-                                print(decrypted_data[decrypted_service][decrypted_username]["key"])
-                                password = decrypted_data[decrypted_service][decrypted_username]["password"]
-                                key = decrypted_data[decrypted_service][decrypted_username]["key"]
-
-                                if decrypted_service in saved_data.keys() and decrypted_username in saved_data[decrypted_service].keys():
-                                    saved_data[decrypted_service][decrypted_username]["password"] = Fernet(key).encrypt(password.encode()).decode()
-                                    saved_data[decrypted_service][decrypted_username]["key"] = self.client_fernet.encrypt(key.encode()).decode()
-
-                                elif decrypted_service in saved_data.keys():
-                                    saved_data[decrypted_service][decrypted_username] = {
-                                        "password": Fernet(key).encrypt(password.encode()).decode(),
-                                        "key": self.client_fernet.encrypt(key.encode()).decode()
-                                    }
-                                    
-                                else:
-                                    saved_data[decrypted_service] = {
-                                        decrypted_username: {
-                                            "password": Fernet(key).encrypt(password.encode()).decode(),
-                                            "key": self.client_fernet.encrypt(key.encode()).decode()
-                                        }
-                                    }
-
-                        print(f"Saved data and decrypted data combined are: {saved_data}")
-
-                        with open(f"data/{self.client_addr}/{self.client_user.decode()}/.passwords.json", mode="w") as passwords_file:
-                            json.dump(json.dumps(saved_data), passwords_file, indent=4)
+        # Every entry written by this update is stamped with the version the save produces, for listings
+        new_version = vault_store.version(self.client_addr, self.client_user.decode()) + 1
+        refreshed_on = datetime.datetime.now().strftime(format="%m-%d-%Y")
+
+        if mode == "RECURSIVE":
+            # Loop through all the saved services. delete all services that are saved from decrypted_data
+
+            for saved_service in saved_data.keys():
+                for saved_username in saved_data[saved_service]:
+                    del decrypted_data[saved_service][saved_username]
+
+
+            # Loop through all services in decrypted_data. If a service is empty, then all its usernames were deleted and no changes were made to that service, so you can remove it
+            for decrypted_service in decrypted_data.keys():
+                if decrypted_data[decrypted_service] is dict:
+                    del decrypted_data[decrypted_service]
+
+            for decrypted_service in decrypted_data.keys():
+                for decrypted_username in decrypted_data[decrypted_service].keys():
+
+                    # Check if the decrypted service is already saved. If so, add new username. If not, add new service
+                    if decrypted_service in saved_data.keys():
+
+                        saved_data[decrypted_service][decrypted_username] = {
+                            "password": decrypted_data[decrypted_service][decrypted_username]["password"],
+                            "key": self.key_table.wrap(self.key),
+                            "version": new_version
+                        }
 
                     else:
-                        client.sendall(b"Failed to update data. Invalid update_depth sent")
-                        logger.error("Failed to update data. Invalid update_depth sent")
+                        saved_data[decrypted_service] = {
+                            decrypted_username: {
+                                "password": decrypted_data[decrypted_service][decrypted_username]["password"],
+                                "key": self.key_table.wrap(self.key),
+                                "version": new_version
+                            }
+                        }
+
+            for saved_service in saved_data.keys():
+                for saved_username in saved_data[saved_service].keys():
+                    print(saved_data[saved_service][saved_username]["password"])
+                    # Check if the saved key matches the key saved for the current cipher. If so, encrypt it
+                    # using current cipher. If not, create temporary cipher with saved key
+                    if self.key_table.unwrap(saved_data[saved_service][saved_username]["key"]) == self.key:
+                        saved_data[saved_service][saved_username]["password"] = self.cipher.encrypt(
+                                saved_data[saved_service][saved_username]["password"].encode()
+                        ).decode()
+
+                        saved_data[saved_service][saved_username]["last-refresh"] = (datetime.datetime.now()
+                                                                                     .strftime(format="%m-%d-%Y"))
 
-                except Exception:
-                    print(traceback.format_exc())
+                    else:
+                        temp_cipher = self.key_table.cipher(saved_data[saved_service][saved_username]["key"])
+                        saved_data[saved_service][saved_username]["password"] = temp_cipher.encrypt(
+                            saved_data[saved_service][saved_username]["password"].encode()).decode()
+
+                        saved_data[saved_service][saved_username]["last-refresh"] = (datetime.datetime.now()
+                                                                                     .strftime(format="%m-%d-%Y"))
+                        saved_data[saved_service][saved_username]["key"] = self.key_table.wrap(
+                            self.key_table.unwrap(saved_data[saved_service][saved_username]["key"])
+                        )
+
+            vault_tree = self.load_vault_tree(saved_data)
+
+            for decrypted_service in decrypted_data.keys():
+                for decrypted_username, decrypted_entry in decrypted_data[decrypted_service].items():
+                    vault_tree.set_leaf(
+                        decrypted_service,
+                        decrypted_username,
+                        merkle.password_digest(self.digest_key, decrypted_entry["password"])
+                    )
+
+            saved_version = vault_store.save(self.client_addr, self.client_user.decode(), saved_data)
+            vault_store.save_tree(self.client_addr, self.client_user.decode(), vault_tree.to_dict())
+
+        elif mode == "REPLACE":
+            saved_data = {}
+            for decrypted_service in decrypted_data.keys():
+                for decrypted_username in decrypted_data[decrypted_service].keys():
+                    print(decrypted_data[decrypted_service][decrypted_username]["key"])
+                    password = decrypted_data[decrypted_service][decrypted_username]["password"]
+                    key = decrypted_data[decrypted_service][decrypted_username]["key"]
+
+                    if decrypted_service in saved_data.keys() and decrypted_username in saved_data[decrypted_service].keys():
+                        saved_data[decrypted_service][decrypted_username]["password"] = Fernet(key).encrypt(password.encode()).decode()
+                        saved_data[decrypted_service][decrypted_username]["key"] = self.key_table.wrap(key.encode())
+                        saved_data[decrypted_service][decrypted_username]["last-refresh"] = refreshed_on
+                        saved_data[decrypted_service][decrypted_username]["version"] = new_version
+
+                    elif decrypted_service in saved_data.keys():
+                        saved_data[decrypted_service][decrypted_username] = {
+                            "password": Fernet(key).encrypt(password.encode()).decode(),
+                            "key": self.key_table.wrap(key.encode()),
+                            "last-refresh": refreshed_on,
+                            "version": new_version
+                        }
 
-                    client.sendall(b"Failed to update data. Invalid data")
-                    logger.error("Failed to update data. Invalid data")
+                    else:
+                        saved_data[decrypted_service] = {
+                            decrypted_username: {
+                                "password": Fernet(key).encrypt(password.encode()).decode(),
+                                "key": self.key_table.wrap(key.encode()),
+                                "last-refresh": refreshed_on,
+                                "version": new_version
+                            }
+                        }
 
-                else:
-                    client.sendall(b"Successfully updated data")
-                    logger.info("Successfully updated saved data")
+            print(f"Saved data and decrypted data combined are: {saved_data}")
 
-                finally:
-                    print(f"Saved data is: {saved_data}")
+            vault_tree = merkle.VaultTree.from_passwords(self.digest_key, {
+                decrypted_service: {
+                    decrypted_username: decrypted_entry["password"]
+                    for decrypted_username, decrypted_entry in decrypted_data[decrypted_service].items()
+                }
+                for decrypted_service in decrypted_data.keys()
+            })
 
-    def load_device_data(self) -> dict:
-        logger.info("Checking if user already has data saved")
+            saved_version = vault_store.save(self.client_addr, self.client_user.decode(), saved_data)
+            vault_store.save_tree(self.client_addr, self.client_user.decode(), vault_tree.to_dict())
 
-        # Check if user has data already saved
-        if os.path.exists(f"data/{self.client_addr}/{self.client_user.decode()}/.passwords.json"):
-            logger.info("User already has data saved, loading saved data")
+        elif mode == "DELTA":
+            # Only the entries the client changed since its last acknowledged sync are sent
+            vault_tree = self.load_vault_tree(saved_data)
 
-            # User has data already saved, load it and return it
-            saved_passwords: dict = json.loads(json_repair.from_file(f"data/{self.client_addr}/{self.client_user.decode()}/.passwords.json"))
-            print(f"Saved passwords are: {saved_passwords} and are of type: {type(saved_passwords)}")
+            saved_data = self.apply_delta(saved_data, decrypted_data["operations"], new_version, vault_tree)
 
-            # Check if data was successfully loaded
-            if saved_passwords == "":
-                logger.warning("The data that was saved was invalid, returning empty data")
-                return {}
+            saved_version = vault_store.save(self.client_addr, self.client_user.decode(), saved_data)
+            vault_store.save_tree(self.client_addr, self.client_user.decode(), vault_tree.to_dict())
 
-            else:
-                logger.info("Successfully loaded saved data")
+        return saved_version
+
+
+    def encrypt_entry(self, password: str, key: str) -> dict:
+        return {
+            "password": Fernet(key).encrypt(password.encode()).decode(),
+            "key": self.key_table.wrap(key.encode()),
+            "last-refresh": datetime.datetime.now().strftime(format="%m-%d-%Y")
+        }
+
+    def apply_delta(self, saved_data: dict, operations: list[dict], new_version: int, vault_tree: merkle.VaultTree) -> dict:
+        for operation in operations:
+            if operation["op"] not in ("upsert", "delete"):
+                raise ValueError(f"Unknown delta operation {operation['op']}")
+
+            self.apply_operation(saved_data, operation, new_version, vault_tree)
+
+        logger.info(f"Applied {len(operations)} delta operation(s)")
+
+        return saved_data
+
+    def apply_operation(self, saved_data: dict, operation: dict, new_version: int, vault_tree: merkle.VaultTree):
+        # Applies one delta or batch operation in place. add and edit insist on the entry not existing and
+        # existing, upsert and delete don't mind either way
+        service = operation["service"]
+        username = operation["username"]
+        entry_exists = username in saved_data.get(service, {})
+
+        if operation["op"] == "add" and entry_exists:
+            raise ValueError(f"{service}/{username} already exists")
+
+        if operation["op"] == "edit" and not entry_exists:
+            raise ValueError(f"{service}/{username} doesn't exist")
+
+        if operation["op"] in ("add", "edit", "upsert"):
+            saved_entry = self.encrypt_entry(operation["password"], operation["key"])
+            saved_entry["version"] = new_version
+
+            saved_data.setdefault(service, {})[username] = saved_entry
+            vault_tree.set_leaf(service, username, merkle.password_digest(self.digest_key, operation["password"]))
+
+        elif operation["op"] == "delete":
+            if entry_exists:
+                del saved_data[service][username]
+
+                if saved_data[service] == {}:
+                    del saved_data[service]
 
-                return saved_passwords
+            vault_tree.remove_leaf(service, username)
 
-        elif os.path.exists(f"data/{self.client_addr}"):
-            logger.info("A device profile has been created, but no data has been saved")
+        else:
+            raise ValueError(f"Unknown operation {operation['op']}")
+
+    def load_vault_tree(self, saved_data: dict | None = None) -> merkle.VaultTree:
+        saved_tree = vault_store.load_tree(self.client_addr, self.client_user.decode())
+
+        if saved_tree is not None:
+            return merkle.VaultTree(saved_tree)
+
+        # Vaults saved before hash trees existed get theirs built once from the saved passwords
+        logger.info("No hash tree saved for user, building one")
+
+        if saved_data is None:
+            saved_data = self.load_device_data()
+
+        saved_passwords = {}
+
+        for service in saved_data.keys():
+            for username, saved_entry in saved_data[service].items():
+                try:
+                    saved_passwords.setdefault(service, {})[username] = self.key_table.cipher(
+                        saved_entry["key"]
+                    ).decrypt(saved_entry["password"].encode()).decode()
 
-            # User doesn't have any data saved, but profile already exists. Return empty dictionary
-            return {}
+                except (cryptography.fernet.InvalidToken, ValueError):
+                    logger.warning(f"Couldn't decrypt service {service} username {username} for the hash tree")
 
-        elif os.path.exists(f"data/{self.client_addr}/{self.client_user.decode()}"):
-            logger.info("A user profile has been created, but no data has been saved")
+        vault_tree = merkle.VaultTree.from_passwords(self.digest_key, saved_passwords)
+        vault_store.save_tree(self.client_addr, self.client_user.decode(), vault_tree.to_dict())
 
-            return {}
+        return vault_tree
+
+    def load_device_data(self) -> dict:
+        logger.info("Loading saved data")
+
+        saved_passwords: dict = vault_store.load(self.client_addr, self.client_user.decode())
+
+        if saved_passwords == {}:
+            logger.info("User doesn't have any data saved")
 
         else:
-            logger.info("User doesn't have profile saved. Creating profile")
+            logger.info("Successfully loaded saved data")
+
+        return saved_passwords
+
+    def decrypt_services(self, saved_services: dict) -> dict:
+        # Decrypts every entry of the given services with its own key, for sending back to the client
+        decrypted_services = {}
+
+        for service in saved_services.keys():
+            decrypted_services[service] = {}
+
+            for username, saved_entry in saved_services[service].items():
+                decrypted_services[service][username] = {
+                    "password": self.key_table.cipher(saved_entry["key"]).decrypt(saved_entry["password"].encode()).decode(),
+                    "key": self.key_table.unwrap(saved_entry["key"]).decode()
+                }
 
-            # User doesn't have data already saved and doesn't have a profile saved, return empty dictionary and
-            # create new folder for them
-            os.mkdir(f"data/{self.client_addr}")
-            os.mkdir(f"data/{self.client_addr}/{self.client_user.decode()}")
+        return decrypted_services
 
-            print("Successfully created profile")
-            return {}
+    @staticmethod
+    def valid_selectors(selectors) -> bool:
+        return isinstance(selectors, list) and all(
+            isinstance(selector, list)
+            and len(selector) in (1, 2)
+            and all(isinstance(name, str) for name in selector)
+            for selector in selectors
+        )
 
     @staticmethod
-    def break_down_data(data: dict) -> list:
-        broken_down_data: list[dict] = []
+    def break_down_data(data: dict):
+        # Yields the data one service at a time, as {service: service data}
+        for service, service_data in data.items():
+            yield {
+                service: service_data
+            }
 
-        logger.info("Breaking down received data")
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    session = asyncio.current_task()
+    client_sessions.add(session)
 
-        for service in data.keys():
-            for service_data in data.values():
-                broken_down_data.append(
-                    {
-                        service: service_data
-                    }
-                )
+    try:
+        await Client(reader, writer).run()
 
-        logger.info("Successfully broke down data")
+    finally:
+        client_sessions.discard(session)
 
-        return broken_down_data
+async def serve(server_data: tuple, listening_socket: socket.socket | None = None):
+    if listening_socket is None:
+        server = await asyncio.start_server(handle_client, host=server_data[0], port=server_data[1])
 
-client_connected = False
+    else:
+        server = await asyncio.start_server(handle_client, sock=listening_socket)
 
-if __name__ == "__main__":
-    if not os.path.exists("logs"):
-        os.mkdir("logs")
+    logger.info(f"Server started and listening in process {os.getpid()}")
+
+    print(f"Listening on address {server_data[0]} port {server_data[1]}...")
+
+    try:
+        async with server:
+            await server.serve_forever()
+
+    finally:
+        if client_sessions:
+            logger.info("Client(s) still connected, closing connection")
+            print("Client(s) connected, closing connection")
+
+            for session in list(client_sessions):
+                session.cancel()
+
+            await asyncio.gather(*client_sessions, return_exceptions=True)
+
+def create_listening_socket(server_data: tuple, reuse_port: bool) -> socket.socket:
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reuse_port:
+        # Every worker binds its own socket and the kernel spreads new connections between them
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    listening_socket.bind(server_data)
+    listening_socket.listen(socket.SOMAXCONN)
+    listening_socket.setblocking(False)
+
+    return listening_socket
+
+def configure_logging():
+    global logger
 
     logging.basicConfig(
         level=logging.DEBUG,
@@ -500,9 +903,250 @@ if __name__ == "__main__":
     )
     logger = logging.getLogger(__name__)
 
+def open_stores(arguments: argparse.Namespace):
+    global key_ring, rotation_index, vault_store
+
+    key_ring = envelope.KeyRing()
+    rotation_index = storage.RotationIndex()
+    group_commit = None
+
+    if arguments.group_commit_window > 0:
+        group_commit = persistence.GroupCommit(arguments.group_commit_window / 1000)
+
+    write_ahead_log = None
+
+    if arguments.wal:
+        write_ahead_log = wal.WriteAheadLog(checkpoint_bytes=arguments.wal_checkpoint_mb * 1024 * 1024)
+
+    vault_store = storage.open_vault_store(
+        arguments.storage,
+        arguments.cache_size_mb,
+        key_ring,
+        rotation_index,
+        group_commit,
+        write_ahead_log,
+        arguments.vault_codec
+    )
+
+def run_worker(server_data: tuple, listening_socket: socket.socket | None, worker_arguments: argparse.Namespace):
+    # Workers start from a fresh interpreter, they set up logging and open the vault store themselves
+    global stop_event
+
+    configure_logging()
+    open_stores(worker_arguments)
+    stop_event = threading.Event()
+
+    if listening_socket is None:
+        listening_socket = create_listening_socket(server_data, reuse_port=True)
+
+    try:
+        asyncio.run(serve(server_data, listening_socket))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        vault_store.close()
+
+def supervise_workers(server_data: tuple, worker_count: int, reuse_port: bool):
+    # The server already runs the scheduler thread, and group commit and sqlite keep locks a forked worker could
+    # inherit while they are held. Workers are started from a fresh process instead and are handed the listening
+    # socket and the command line arguments
+    worker_context = multiprocessing.get_context(rotation.worker_start_method())
+
+    if reuse_port:
+        listening_socket = None
+
+    else:
+        listening_socket = create_listening_socket(server_data, reuse_port=False)
+
+    workers: list[multiprocessing.Process | None] = [None] * worker_count
+
+    try:
+        while not stop_event.is_set():
+            for worker_index, worker in enumerate(workers):
+                if worker is not None and worker.is_alive():
+                    continue
+
+                if worker is not None:
+                    logger.warning(f"Worker {worker_index} (pid {worker.pid}) exited with code {worker.exitcode}, restarting")
+
+                workers[worker_index] = worker_context.Process(
+                    target=run_worker,
+                    args=(server_data, listening_socket, arguments),
+                    name=f"pypass-worker-{worker_index}"
+                )
+                workers[worker_index].start()
+
+                logger.info(f"Started worker {worker_index} (pid {workers[worker_index].pid})")
+
+            time.sleep(1)
+
+    finally:
+        for worker in workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+
+        for worker in workers:
+            if worker is not None:
+                worker.join()
+
+        if listening_socket is not None:
+            listening_socket.close()
+
+# Every connected client is served by a task on the same event loop
+client_sessions: set[asyncio.Task] = set()
+
+if __name__ == "__main__":
+    if not os.path.exists("logs"):
+        os.mkdir("logs")
+
+    argument_parser = argparse.ArgumentParser(description="PyPass sync server")
+    argument_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes serving clients. Each worker runs its own event loop"
+    )
+    argument_parser.add_argument(
+        "--reuse-port",
+        action="store_true",
+        help="Give every worker its own SO_REUSEPORT socket instead of sharing one inherited socket"
+    )
+    argument_parser.add_argument(
+        "--storage",
+        choices=sorted(storage.STORAGE_BACKENDS.keys()),
+        default="sqlite",
+        help="Backend used to store vaults"
+    )
+    argument_parser.add_argument(
+        "--cache-size-mb",
+        type=int,
+        default=64,
+        help="Memory ceiling of the parsed vault cache in each process. 0 disables the cache"
+    )
+    argument_parser.add_argument(
+        "--vault-codec",
+        choices=codec.available_codecs(),
+        default="json",
+        help="Encoding of the json backend's vault files. Files in any other encoding are moved to it on their next save"
+    )
+    argument_parser.add_argument(
+        "--group-commit-window",
+        type=float,
+        default=2,
+        help="Milliseconds the json backend waits to commit the writes of other sessions in the same fsync. 0 commits "
+             "every write on its own"
+    )
+    argument_parser.add_argument(
+        "--wal",
+        action="store_true",
+        help="Make saves durable by appending them to a write-ahead log instead of syncing the backend on every save"
+    )
+    argument_parser.add_argument(
+        "--wal-checkpoint-mb",
+        type=int,
+        default=16,
+        help="Size a process's write-ahead log grows to before the backend is flushed to disk and the log emptied"
+    )
+    argument_parser.add_argument(
+        "--data-key-max-age",
+        type=int,
+        default=90,
+        help="Days before the weekly key rotation replaces a vault's data key"
+    )
+    argument_parser.add_argument(
+        "--rotation-rate",
+        type=int,
+        default=500,
+        help="Most entry keys re-wrapped per second by the key rotation"
+    )
+    argument_parser.add_argument(
+        "--rotation-cpu-budget",
+        type=float,
+        default=0.25,
+        help="Share of the CPU cores the key rotation's worker processes may use"
+    )
+    argument_parser.add_argument(
+        "--migrate-layout",
+        choices=storage.DataLayout.SCHEMES,
+        help="Move every vault folder to the given data layout, then exit. hashed fans the folders out over "
+             "data/ab/cd/<vault id>/ so no directory grows with the number of clients"
+    )
+    argument_parser.add_argument(
+        "--rebuild-manifest",
+        action="store_true",
+        help="Rebuild the json backend's vault manifest (data/manifest.sqlite3) from the data tree, then exit"
+    )
+    argument_parser.add_argument(
+        "--import-data",
+        action="store_true",
+        help="Import every data/<client_addr>/<user>/.passwords.json into the storage backend, then exit"
+    )
+    arguments = argument_parser.parse_args()
+
+    if arguments.rotation_rate <= 0:
+        argument_parser.error("--rotation-rate must be positive")
+
+    configure_logging()
+
+    if arguments.migrate_layout:
+        source_layout = storage.DataLayout.load()
+
+        if source_layout.scheme == arguments.migrate_layout:
+            print(f"The data tree already uses the {arguments.migrate_layout} layout")
+            raise SystemExit(0)
+
+        moved_vaults = storage.migrate_layout(source_layout, storage.DataLayout(scheme=arguments.migrate_layout))
+
+        print(f"Moved {moved_vaults} vault folder(s) to the {arguments.migrate_layout} layout")
+        raise SystemExit(0)
+
+    open_stores(arguments)
+
+    # Saves a crash left only in the write-ahead logs are replayed before anything reads the backend. Without --wal
+    # they are replayed onto the configured backend, with its codec and group commit
+    if os.path.isdir(wal.LOG_FOLDER):
+        wal_store = vault_store.find_store(storage.WalVaultStore)
+
+        if wal_store is None:
+            wal_store = storage.WalVaultStore(
+                vault_store.find_store(storage.STORAGE_BACKENDS[arguments.storage]),
+                wal.WriteAheadLog()
+            )
+
+        wal_store.recover()
+
+    if arguments.import_data:
+        imported_users = storage.import_json_tree(storage.JsonVaultStore(), vault_store)
+
+        print(f"Imported {imported_users} vault(s) into the {arguments.storage} backend")
+        raise SystemExit(0)
+
+    if arguments.rebuild_manifest:
+        json_store = vault_store.find_store(storage.JsonVaultStore)
+
+        if json_store is None:
+            print("The sqlite backend keeps its manifest in vaults.sqlite3, there is nothing to rebuild")
+
+        else:
+            print(f"Rebuilt the manifest from {json_store.layout.manifest.rebuild(json_store)} vault(s)")
+
+        raise SystemExit(0)
+
     stop_event = threading.Event()
 
-    schedule.every().monday.at("00:00")
+    # The rotation runs on its own thread so the scheduler keeps ticking, and resumes from its checkpoint if the
+    # server was stopped halfway through
+    rotation_arguments = (arguments.data_key_max_age, arguments.rotation_rate, arguments.rotation_cpu_budget)
+
+    schedule.every().monday.at("00:00").do(
+        lambda: threading.Thread(target=refresh_keys, args=rotation_arguments).start()
+    )
+
+    if os.path.exists(rotation.CHECKPOINT_PATH):
+        threading.Thread(target=refresh_keys, args=rotation_arguments).start()
+
     schedule_thread = threading.Thread(target=start_scheduled_tasks)
     schedule_thread.start()
 
@@ -512,43 +1156,24 @@ if __name__ == "__main__":
     try:
         server_data = get_connection_data()
 
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind(server_data)
-        server.listen()
+        if arguments.workers > 1:
+            supervise_workers(server_data, arguments.workers, arguments.reuse_port)
 
-        logger.info("Server started and listening")
-
-        print(f"Listening on address {server_data[0]} port {server_data[1]}...")
-
-        while not stop_event.is_set():
-
-            client, client_addr = server.accept()
-            threading.Thread(target=Client, kwargs={"user_client": client, "client_address": client_addr}).start()
+        else:
+            asyncio.run(serve(server_data))
 
     except Exception as e:
         print(traceback.format_exc())
 
         logger.error(f"Error occurred: {e}. Shutting down")
         print("Exception, shutting down")
-        stop_event.set()
-        schedule_thread.join()
-
-        if client_connected:
-            logger.info("Client(s) still connected, closing connection")
-            print("Client(s) connected, closing connection")
-            client.close()
-
-            client_connected = False
 
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt received, shutting down")
         print("Keyboard interrupt, shutting down")
+
+    finally:
         stop_event.set()
         schedule_thread.join()
 
-        if client_connected:
-            logger.info("Client(s) still connected, closing connection")
-            print("Client(s) connected, closing connection")
-            client.close()
-
-            client_connected = False 
+        vault_store.close()
@@ -0,0 +1,216 @@
+# Hash tree over a vault, used by the app and the server to find which entries differ without sending the vault
+
+# Tree layout:
+# root /
+#   first hex digit of sha256(service) /
+#     second hex digit of sha256(service) /
+#       service /
+#         username: digest of the password
+# Every node holds the digest of its sorted children, so two vaults with the same root digest hold the same
+# passwords. The hex digit buckets keep the number of children per node small, so walking down to a changed
+# entry in a large vault only exchanges a few small nodes
+
+# Leaf digests are HMACs of the plaintext password keyed from the user's main key. The app and the server both
+# know the main key, so they compute the same leaves even though their ciphertexts differ, and the digests
+# don't reveal anything to someone without the key
+
+import hmac
+import hashlib
+
+BUCKET_LEVELS = 2
+LEAF_DEPTH = BUCKET_LEVELS + 2
+
+# Digests are truncated to 128 bits to keep exchanged nodes small
+DIGEST_LENGTH = 32
+
+
+def derive_digest_key(main_key: bytes) -> bytes:
+    return hmac.new(main_key, b"pypass vault tree", hashlib.sha256).digest()
+
+
+def password_digest(digest_key: bytes, password: str) -> str:
+    return hmac.new(digest_key, password.encode(), hashlib.sha256).hexdigest()[:DIGEST_LENGTH]
+
+
+def entry_path(service: str, username: str) -> list[str]:
+    service_hash = hashlib.sha256(service.encode()).hexdigest()
+
+    return [service_hash[level] for level in range(BUCKET_LEVELS)] + [service, username]
+
+
+def child_digest(child) -> str:
+    # Leaves are stored as plain digest strings, every other node as a dict
+    return child if isinstance(child, str) else child["digest"]
+
+
+def node_digest(children: dict) -> str:
+    digest = hashlib.sha256()
+
+    for name in sorted(children.keys()):
+        digest.update(name.encode() + b"\0" + child_digest(children[name]).encode() + b"\0")
+
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+EMPTY_DIGEST = node_digest({})
+
+
+class VaultTree:
+    def __init__(self, root: dict | None = None):
+        self.root = root if root is not None else {"digest": EMPTY_DIGEST, "children": {}}
+
+    @classmethod
+    def from_passwords(cls, digest_key: bytes, passwords: dict):
+        # passwords is {service: {username: plaintext password}}
+        tree = cls()
+
+        for service in passwords.keys():
+            for username, password in passwords[service].items():
+                tree.set_leaf(service, username, password_digest(digest_key, password), rehash=False)
+
+        tree.rehash(tree.root)
+
+        return tree
+
+    @property
+    def digest(self) -> str:
+        return self.root["digest"]
+
+    def set_leaf(self, service: str, username: str, leaf_digest: str, rehash: bool = True):
+        path = entry_path(service, username)
+        nodes = [self.root]
+
+        for name in path[:-1]:
+            nodes.append(nodes[-1]["children"].setdefault(name, {"digest": EMPTY_DIGEST, "children": {}}))
+
+        nodes[-1]["children"][path[-1]] = leaf_digest
+
+        if rehash:
+            # Only the nodes along the changed path need new digests
+            for node in reversed(nodes):
+                node["digest"] = node_digest(node["children"])
+
+    def remove_leaf(self, service: str, username: str):
+        path = entry_path(service, username)
+        nodes = [self.root]
+
+        for name in path[:-1]:
+            if name not in nodes[-1]["children"]:
+                return
+
+            nodes.append(nodes[-1]["children"][name])
+
+        if nodes[-1]["children"].pop(path[-1], None) is None:
+            return
+
+        for depth in range(len(nodes) - 1, -1, -1):
+            node = nodes[depth]
+
+            if node["children"] == {} and depth > 0:
+                # Drop empty nodes so an emptied service hashes the same as one that never existed
+                del nodes[depth - 1]["children"][path[depth - 1]]
+
+            else:
+                node["digest"] = node_digest(node["children"])
+
+    def rehash(self, node: dict) -> str:
+        for child in node["children"].values():
+            if not isinstance(child, str):
+                self.rehash(child)
+
+        node["digest"] = node_digest(node["children"])
+
+        return node["digest"]
+
+    def node(self, path: list[str]) -> dict | None:
+        node = self.root
+
+        for name in path:
+            if isinstance(node, str) or name not in node["children"]:
+                return None
+
+            node = node["children"][name]
+
+        return node
+
+    def describe(self, path: list[str]) -> dict | None:
+        # The node's digest and its children's digests, which is all the other side needs to decide where to
+        # descend next
+        node = self.node(path)
+
+        if node is None or isinstance(node, str):
+            return None
+
+        return {
+            "digest": node["digest"],
+            "children": {name: child_digest(child) for name, child in node["children"].items()}
+        }
+
+    def leaves(self, path: list[str]) -> list[tuple[str, str]]:
+        # Every (service, username) at or under path
+        node = self.node(path)
+
+        if node is None:
+            return []
+
+        if len(path) == LEAF_DEPTH:
+            return [(path[-2], path[-1])]
+
+        found_leaves = []
+
+        for name in node["children"].keys():
+            found_leaves += self.leaves(path + [name])
+
+        return found_leaves
+
+    def to_dict(self) -> dict:
+        return self.root
+
+
+def compare_nodes(local_tree: VaultTree, path: list[str], remote_node: dict | None, differences: dict) -> list[list[str]]:
+    # Compares one node of the local tree with the same node from the other side. Differing leaves are added to
+    # differences, and the paths that still need to be fetched from the other side are returned
+    local_node = local_tree.describe(path)
+
+    if local_node is not None and remote_node is not None and local_node["digest"] == remote_node["digest"]:
+        return []
+
+    local_children = local_node["children"] if local_node is not None else {}
+    remote_children = remote_node["children"] if remote_node is not None else {}
+
+    next_paths = []
+
+    for name in local_children.keys() | remote_children.keys():
+        child_path = path + [name]
+
+        if local_children.get(name) == remote_children.get(name):
+            continue
+
+        if len(child_path) == LEAF_DEPTH:
+            entry = (child_path[-2], child_path[-1])
+
+            if name not in remote_children:
+                differences["local_only"].append(entry)
+
+            elif name not in local_children:
+                differences["remote_only"].append(entry)
+
+            else:
+                differences["changed"].append(entry)
+
+        elif name not in remote_children:
+            # Everything under this node is only saved locally, no need to ask the other side about it
+            differences["local_only"] += local_tree.leaves(child_path)
+
+        else:
+            next_paths.append(child_path)
+
+    return next_paths
+
+
+def empty_differences() -> dict:
+    return {
+        "changed": [],
+        "local_only": [],
+        "remote_only": []
+    }
@@ -0,0 +1,301 @@
+# Key rotation engine used by refresh_keys
+
+# Only vaults the rotation index (storage.RotationIndex) says are due are visited: vaults whose data key is older
+# than the maximum age, and vaults still wrapped with a KEK older than the last KEK_GENERATIONS_KEPT. Every other
+# vault is moved to the active KEK the next time it is saved, so a run costs O(due vaults), not O(all vaults)
+
+# Every due vault is one task for a pool of worker processes. A task replaces the vault's data key (re-wrapping
+# every entry key) once it is older than the maximum age, otherwise it only re-wraps the data key with the active
+# KEK. The workers run at a lower priority and the parent only hands out new vaults while the run stays under its
+# entries per second rate, so a rotation over every user doesn't starve live sessions
+
+# Progress is appended to data/rotation.checkpoint, one json line per finished vault after a header line:
+# {"kek_id": KEK the run rotated to, "started": "%m-%d-%Y"}
+# {"client_addr": ..., "user": ..., "status": "rotated" | "skipped" | "failed", "entries": ...}
+# An interrupted run leaves the file behind and the next run resumes from it instead of starting over
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+import multiprocessing
+import multiprocessing.util
+import concurrent.futures
+
+import wal
+import envelope
+import storage
+import persistence
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATH = os.path.join("data", "rotation.checkpoint")
+
+# Added to the worker processes' nice value
+WORKER_NICENESS = 10
+
+# Number of the newest KEKs a vault's data key may be wrapped with before the rotation re-wraps it. One KEK is
+# generated per run, so with weekly runs an idle vault is re-wrapped about once a month
+KEK_GENERATIONS_KEPT = 4
+
+# Store opened by each worker process, see init_worker
+worker_store: storage.EnvelopeVaultStore | None = None
+
+
+def init_worker(
+        backend: str,
+        kek_path: str,
+        vault_codec: str,
+        group_commit_window: float,
+        wal_checkpoint_bytes: int | None
+):
+    global worker_store
+
+    if hasattr(os, "nice"):
+        os.nice(WORKER_NICENESS)
+
+    # The workers write vaults the way the server does, with its codec, group commit and write-ahead log. Each
+    # worker appends to a log of its own, which is replayed with the others' if the server crashes
+    group_commit = persistence.GroupCommit(group_commit_window) if group_commit_window > 0 else None
+    write_ahead_log = None
+
+    if wal_checkpoint_bytes is not None:
+        write_ahead_log = wal.WriteAheadLog(checkpoint_bytes=wal_checkpoint_bytes)
+
+    # No cache in the workers, every vault is only visited once per run
+    worker_store = storage.open_vault_store(
+        backend,
+        0,
+        envelope.KeyRing(kek_path),
+        storage.RotationIndex(),
+        group_commit,
+        write_ahead_log,
+        vault_codec
+    )
+
+    # Runs when the pool shuts the worker down. Checkpoints the worker's log and removes it, a log is only left
+    # behind for the next start up to replay if the worker dies
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    global worker_store
+
+    if worker_store is not None:
+        worker_store.close()
+        worker_store = None
+
+
+def data_key_due(metadata: dict, max_age_days: int) -> bool:
+    if "data_key_created" not in metadata:
+        return True
+
+    data_key_created = datetime.datetime.strptime(metadata["data_key_created"], "%m-%d-%Y").date()
+
+    return (datetime.date.today() - data_key_created).days >= max_age_days
+
+
+def rotate_vault(client_addr: str, user: str, max_age_days: int) -> dict:
+    # Runs in a worker process
+    result = {"client_addr": client_addr, "user": user, "status": "failed", "entries": 0}
+
+    try:
+        with storage.VaultLock(worker_store.vault_folder(client_addr, user)):
+            if data_key_due(worker_store.load_metadata(client_addr, user), max_age_days):
+                result["entries"] = worker_store.replace_data_key(client_addr, user)
+                result["status"] = "rotated"
+
+            else:
+                worker_store.rewrap_data_key(client_addr, user)
+
+                # Counted from the manifest, the vault itself isn't read
+                result["entries"] = worker_store.entry_count(client_addr, user)
+                result["status"] = "skipped"
+
+    except Exception as error:
+        logger.error(f"Rotating the keys of {client_addr}/{user} failed: {error!r}")
+
+        try:
+            result["entries"] = worker_store.entry_count(client_addr, user)
+
+        except Exception:
+            pass
+
+    return result
+
+
+class RotationCheckpoint:
+    def __init__(self, checkpoint_path: str = CHECKPOINT_PATH):
+        self.checkpoint_path = checkpoint_path
+        self.header = None
+        self.results: dict[tuple[str, str], dict] = {}
+        self.checkpoint_file = None
+
+    def load(self) -> bool:
+        # Returns whether there is an interrupted run to resume
+        if not os.path.exists(self.checkpoint_path):
+            return False
+
+        with open(self.checkpoint_path, mode="r") as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    record = json.loads(line)
+
+                except json.JSONDecodeError:
+                    # The last line may have been cut off when the run was interrupted
+                    continue
+
+                if self.header is None:
+                    self.header = record
+
+                else:
+                    self.results[(record["client_addr"], record["user"])] = record
+
+        return self.header is not None
+
+    def start(self, kek_id: str):
+        self.header = {"kek_id": kek_id, "started": datetime.date.today().strftime("%m-%d-%Y")}
+        self.results = {}
+
+        with open(self.checkpoint_path, mode="w") as checkpoint_file:
+            checkpoint_file.write(json.dumps(self.header) + "\n")
+
+    def record(self, result: dict):
+        if self.checkpoint_file is None:
+            self.checkpoint_file = open(self.checkpoint_path, mode="a")
+
+        self.results[(result["client_addr"], result["user"])] = result
+
+        self.checkpoint_file.write(json.dumps(result) + "\n")
+        self.checkpoint_file.flush()
+
+    def close(self):
+        if self.checkpoint_file is not None:
+            self.checkpoint_file.close()
+            self.checkpoint_file = None
+
+    def finish(self):
+        self.close()
+        os.remove(self.checkpoint_path)
+
+
+def worker_start_method() -> str:
+    # The rotation is started from a thread of a server that has other threads running, whose locks a forked
+    # worker could inherit while they are held. Workers are started from a fresh process instead
+    return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def rotation_workers(cpu_budget: float) -> int:
+    # cpu_budget is the share of the machine's cores the rotation may use
+    return max(1, int((os.cpu_count() or 1) * cpu_budget))
+
+
+def run_rotation(
+        vault_store: storage.VaultStore,
+        key_ring: envelope.KeyRing,
+        rotation_index: storage.RotationIndex,
+        backend: str,
+        max_age_days: int = 90,
+        max_entries_per_second: int = 500,
+        cpu_budget: float = 0.25,
+        stop_event: threading.Event | None = None,
+        vault_codec: str = "json",
+        group_commit_window: float = 0,
+        wal_checkpoint_bytes: int | None = None
+) -> dict:
+    # group_commit_window is in seconds, and wal_checkpoint_bytes is None when the server runs without --wal
+    if max_entries_per_second <= 0:
+        raise ValueError(f"The rotation rate must be positive, not {max_entries_per_second}")
+
+    checkpoint = RotationCheckpoint()
+
+    if checkpoint.load():
+        logger.info(f"Resuming key rotation started {checkpoint.header['started']}, {len(checkpoint.results)} vault(s) done")
+
+    else:
+        checkpoint.start(key_ring.rotate())
+
+    if not rotation_index.built():
+        rotation_index.rebuild(vault_store)
+
+    data_keys_created_before = int(time.time()) - max_age_days * 24 * 60 * 60
+    oldest_kek_kept = int(key_ring.active_id) - KEK_GENERATIONS_KEPT + 1
+
+    pending_users = [
+        (client_addr, user) for client_addr, user in rotation_index.due(data_keys_created_before, oldest_kek_kept)
+        if (client_addr, user) not in checkpoint.results
+        or checkpoint.results[(client_addr, user)]["status"] == "failed"
+    ]
+
+    worker_count = rotation_workers(cpu_budget)
+    started = time.monotonic()
+    rotated_entries = 0
+    interrupted = False
+
+    logger.info(f"Rotating keys of {len(pending_users)} vault(s) with {worker_count} worker(s)")
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=worker_count,
+        mp_context=multiprocessing.get_context(worker_start_method()),
+        initializer=init_worker,
+        initargs=(backend, key_ring.kek_path, vault_codec, group_commit_window, wal_checkpoint_bytes)
+    ) as executor:
+        running = set()
+        user_iterator = iter(pending_users)
+
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                interrupted = True
+
+            # Keep every worker busy without queueing the whole user list up front
+            while not interrupted and len(running) < worker_count * 2:
+                next_user = next(user_iterator, None)
+
+                if next_user is None:
+                    break
+
+                running.add(executor.submit(rotate_vault, *next_user, max_age_days))
+
+            if running == set():
+                break
+
+            finished, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in finished:
+                result = future.result()
+                checkpoint.record(result)
+
+                if result["status"] == "rotated":
+                    rotated_entries += result["entries"]
+
+            # Wait until the entries rotated so far fit within the rate before handing out more vaults
+            ahead = rotated_entries / max_entries_per_second - (time.monotonic() - started)
+
+            if ahead > 0:
+                if stop_event is not None:
+                    stop_event.wait(ahead)
+
+                else:
+                    time.sleep(ahead)
+
+    report = {"rotated": 0, "skipped": 0, "failed": 0}
+
+    for result in checkpoint.results.values():
+        report[result["status"]] += result["entries"]
+
+    if interrupted:
+        checkpoint.close()
+        logger.info(f"Key rotation interrupted, it will resume on the next run. So far: {report}")
+
+        return report
+
+    # Failed vaults keep their old KEK in the index, so it isn't retired from under them
+    key_ring.retire({kek_id for kek_id in key_ring.raw_keys.keys() if rotation_index.kek_in_use(kek_id)})
+
+    checkpoint.finish()
+
+    logger.info(f"Key rotation finished: {report}")
+
+    return report
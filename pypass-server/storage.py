@@ -0,0 +1,1945 @@
+# Storage backends for the server's vaults
+
+# A vault is the dictionary a user has saved on the server:
+# service: {
+#     username: {
+#       "password": encrypted password
+#       "key": Key used for Fernet encryption
+#       "last-refresh": date the key was last refreshed, "%m-%d-%Y"
+#       "version": vault version the entry was last changed in
+#       }
+#   }
+
+# JsonVaultStore keeps the original layout of data/client_addr/user/.passwords.json, encoded with one of the
+# codecs in codec.py. Its files are replaced atomically through persistence, optionally with a GroupCommit shared by every session. SqliteVaultStore keeps
+# one row per (client_addr, user, service, username) in data/vaults.sqlite3, so a save only touches the rows
+# that changed. Either can be put behind WalVaultStore, which makes saves durable through a write-ahead log
+
+# Where each vault's folder (its lock file, and for the json backend the vault itself) lives is decided by the
+# DataLayout saved in data/layout.json, see migrate_layout
+
+import os
+import json
+import mmap
+import time
+import asyncio
+import hashlib
+import sqlite3
+import weakref
+import logging
+import datetime
+import contextlib
+import threading
+import collections
+
+import cryptography.exceptions
+
+try:
+    import fcntl
+
+except ImportError:
+    # fcntl isn't available on Windows. Worker processes need fork, so there is only ever one process writing there
+    fcntl = None
+
+import wal
+import codec
+import envelope
+import persistence
+
+logger = logging.getLogger(__name__)
+
+
+class VaultLock:
+    # Exclusive lock on a user's vault folder. The lock is taken with flock on a lock file, so it is respected by
+    # every worker process as well as every session inside a process
+    # Sessions of the same process first queue on an asyncio lock per vault, so only one of them at a time holds a
+    # thread blocked in flock
+    async_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    def __init__(self, user_folder_path: str):
+        self.lock_file_path = os.path.join(user_folder_path, ".passwords.lock")
+        self.lock_file = None
+        self.async_lock = None
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.lock_file_path), exist_ok=True)
+        self.lock_file = open(self.lock_file_path, mode="a")
+
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        if self.lock_file is None:
+            return
+
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+        self.lock_file.close()
+        self.lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+    async def __aenter__(self):
+        self.async_lock = VaultLock.async_locks.setdefault(self.lock_file_path, asyncio.Lock())
+        await self.async_lock.acquire()
+
+        try:
+            # flock blocks, wait for it off the event loop so other sessions keep running
+            await asyncio.to_thread(self.acquire)
+
+        except BaseException:
+            self.async_lock.release()
+            raise
+
+        return self
+
+    async def __aexit__(self, *_):
+        self.release()
+
+        self.async_lock.release()
+        self.async_lock = None
+
+
+def local_sqlite_connection(local: threading.local, database_path: str) -> sqlite3.Connection:
+    # sqlite connections can't be shared between threads or forked worker processes, so every thread of every
+    # process opens its own
+    if getattr(local, "pid", None) != os.getpid():
+        connection = sqlite3.connect(database_path, isolation_level=None, timeout=30)
+
+        # WAL lets readers carry on while another connection writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        local.connection = connection
+        local.pid = os.getpid()
+
+    return local.connection
+
+
+class VaultManifest:
+    # Every vault of the json backend, kept in data/manifest.sqlite3 so vaults are enumerated and described without
+    # touching the data tree. A row is written in one transaction after each save. vault_id and .owner.json are
+    # only used by the hashed layout. A manifest that was lost or predates a migration is rebuilt from disk, and a
+    # row left behind its vault by a crash between the two writes is refreshed when it is read, see
+    # JsonVaultStore.manifest_row
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS vaults (
+            client_addr TEXT NOT NULL,
+            user TEXT NOT NULL,
+            vault_id TEXT NOT NULL,
+            path TEXT,
+            size INTEGER,
+            entries INTEGER,
+            version INTEGER,
+            last_write INTEGER,
+            PRIMARY KEY (client_addr, user)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS manifest_state (
+            built INTEGER NOT NULL
+        );
+    """
+
+    COLUMNS = ("path", "size", "entries", "version", "last_write")
+
+    def __init__(self, database_path: str = os.path.join("data", "manifest.sqlite3")):
+        self.database_path = database_path
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self.connection().executescript(self.SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        vault_columns = {column[1] for column in self.connection().execute("PRAGMA table_info(vaults)")}
+
+        for column in self.COLUMNS:
+            if column not in vault_columns:
+                self.connection().execute(
+                    f"ALTER TABLE vaults ADD COLUMN {column} {'TEXT' if column == 'path' else 'INTEGER'}"
+                )
+
+    def connection(self) -> sqlite3.Connection:
+        return local_sqlite_connection(self.local, self.database_path)
+
+    def add(self, client_addr: str, user: str, vault_id: str):
+        self.connection().execute(
+            "INSERT OR IGNORE INTO vaults (client_addr, user, vault_id) VALUES (?, ?, ?)",
+            (client_addr, user, vault_id)
+        )
+
+    def update(
+            self,
+            client_addr: str,
+            user: str,
+            path: str,
+            size: int,
+            entries: int,
+            version: int,
+            last_write: int | None = None
+    ):
+        self.connection().execute(
+            "INSERT INTO vaults (client_addr, user, vault_id, path, size, entries, version, last_write) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (client_addr, user) DO UPDATE SET "
+            "path = excluded.path, size = excluded.size, entries = excluded.entries, version = excluded.version, "
+            "last_write = excluded.last_write",
+            (
+                client_addr,
+                user,
+                DataLayout.vault_id(client_addr, user),
+                path,
+                size,
+                entries,
+                version,
+                int(time.time()) if last_write is None else last_write
+            )
+        )
+
+    def users(self) -> list[tuple[str, str]]:
+        return list(self.connection().execute("SELECT client_addr, user FROM vaults"))
+
+    def get(self, client_addr: str, user: str) -> dict | None:
+        row = self.connection().execute(
+            "SELECT path, size, entries, version, last_write FROM vaults WHERE client_addr = ? AND user = ?",
+            (client_addr, user)
+        ).fetchone()
+
+        return None if row is None else dict(zip(self.COLUMNS, row))
+
+    def vaults(self) -> list[dict]:
+        return [
+            {"client_addr": client_addr, "user": user, **dict(zip(self.COLUMNS, row))}
+            for client_addr, user, *row in self.connection().execute(
+                "SELECT client_addr, user, path, size, entries, version, last_write FROM vaults"
+            )
+        ]
+
+    def built(self) -> bool:
+        return self.connection().execute("SELECT built FROM manifest_state").fetchone() is not None
+
+    def clear(self):
+        # Forget every row, the next enumeration rebuilds the manifest from disk
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("DELETE FROM vaults")
+        connection.execute("DELETE FROM manifest_state")
+        connection.execute("COMMIT")
+
+    def rebuild(self, json_store: "JsonVaultStore") -> int:
+        # One pass over the data tree, swapped in as a single transaction
+        rows = []
+
+        for client_addr, user in json_store.layout.scan_owners():
+            vault_path = json_store.vault_path(client_addr, user)
+
+            try:
+                vault_stat = os.stat(vault_path)
+
+            except FileNotFoundError:
+                continue
+
+            rows.append((
+                client_addr,
+                user,
+                DataLayout.vault_id(client_addr, user),
+                vault_path,
+                vault_stat.st_size,
+                sum(len(usernames) for usernames in json_store.load(client_addr, user).values()),
+                json_store.version(client_addr, user),
+                int(vault_stat.st_mtime)
+            ))
+
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            connection.execute("DELETE FROM vaults")
+            connection.executemany(
+                "INSERT INTO vaults (client_addr, user, vault_id, path, size, entries, version, last_write) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            connection.execute("DELETE FROM manifest_state")
+            connection.execute("INSERT INTO manifest_state (built) VALUES (1)")
+
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        connection.execute("COMMIT")
+
+        logger.info(f"Rebuilt the vault manifest from {len(rows)} vault(s)")
+
+        return len(rows)
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+
+        self.local = threading.local()
+
+
+class DataLayout:
+    # flat:   data/<client_addr>/<user>/, the original layout
+    # hashed: data/ab/cd/<vault id>/, where the vault id is a hash of client_addr and user and ab, cd are its first
+    #         characters, one directory level each. No directory ends up with more than 256 entries above the
+    #         vault folders, however many clients there are. Every vault folder holds an .owner.json naming its
+    #         vault, and the VaultManifest maps vaults back to their folders
+    SCHEMES = ("flat", "hashed")
+
+    # Files that mark a folder as a vault folder in the flat layout
+    VAULT_FILES = (".passwords.json", ".passwords.lock", ".version", ".tree.json", ".metadata.json")
+
+    def __init__(self, data_folder: str = "data", scheme: str = "flat", levels: int = 2):
+        if scheme not in self.SCHEMES:
+            raise ValueError(f"Unknown data layout {scheme}")
+
+        self.data_folder = data_folder
+        self.scheme = scheme
+        self.levels = levels
+
+        self.vault_manifest = None
+        self.registered: set[tuple[str, str]] = set()
+
+    @classmethod
+    def load(cls, data_folder: str = "data") -> "DataLayout":
+        # Data trees without a layout.json predate hashed layouts, so they are flat
+        try:
+            with open(os.path.join(data_folder, "layout.json"), mode="r") as layout_file:
+                layout_data = json.load(layout_file)
+
+        except FileNotFoundError:
+            return cls(data_folder)
+
+        return cls(data_folder, layout_data["scheme"], layout_data.get("levels", 2))
+
+    def save(self):
+        persistence.write_json(
+            os.path.join(self.data_folder, "layout.json"),
+            {"scheme": self.scheme, "levels": self.levels},
+            indent=4
+        )
+
+    @property
+    def manifest(self) -> VaultManifest:
+        if self.vault_manifest is None:
+            self.vault_manifest = VaultManifest(os.path.join(self.data_folder, "manifest.sqlite3"))
+
+        return self.vault_manifest
+
+    @staticmethod
+    def vault_id(client_addr: str, user: str) -> str:
+        return hashlib.sha256(f"{client_addr}\0{user}".encode()).hexdigest()[:32]
+
+    def vault_folder(self, client_addr: str, user: str) -> str:
+        if self.scheme == "flat":
+            return os.path.join(self.data_folder, client_addr, user)
+
+        vault_id = self.vault_id(client_addr, user)
+        fan_out = [vault_id[level * 2:level * 2 + 2] for level in range(self.levels)]
+
+        return os.path.join(self.data_folder, *fan_out, vault_id)
+
+    def register(self, client_addr: str, user: str):
+        # Names a hashed vault folder before anything is saved in it, so the manifest can always be rebuilt
+        if self.scheme == "flat" or (client_addr, user) in self.registered:
+            return
+
+        owner_path = os.path.join(self.vault_folder(client_addr, user), ".owner.json")
+
+        if not os.path.exists(owner_path):
+            persistence.write_json(owner_path, {"client_addr": client_addr, "user": user})
+
+        self.manifest.add(client_addr, user, self.vault_id(client_addr, user))
+        self.registered.add((client_addr, user))
+
+    def scan_owners(self) -> list[tuple[str, str]]:
+        # (client_addr, user) of every vault folder on disk. Walks the whole tree, so it is only used to rebuild the
+        # manifest and to migrate
+        owners = []
+
+        if not os.path.isdir(self.data_folder):
+            return owners
+
+        if self.scheme == "hashed":
+            # Only the fan-out folders are walked into, not wal/ or anything else at the top
+            fan_out_folders = [self.data_folder]
+
+            for _ in range(self.levels):
+                fan_out_folders = [
+                    os.path.join(fan_out_folder, folder_name)
+                    for fan_out_folder in fan_out_folders
+                    for folder_name in os.listdir(fan_out_folder)
+                    if len(folder_name) == 2 and all(character in "0123456789abcdef" for character in folder_name)
+                    and os.path.isdir(os.path.join(fan_out_folder, folder_name))
+                ]
+
+            for fan_out_folder in fan_out_folders:
+                for vault_id in os.listdir(fan_out_folder):
+                    try:
+                        with open(os.path.join(fan_out_folder, vault_id, ".owner.json"), mode="r") as owner_file:
+                            owner = json.load(owner_file)
+
+                    except (FileNotFoundError, NotADirectoryError, json.decoder.JSONDecodeError):
+                        continue
+
+                    owners.append((owner["client_addr"], owner["user"]))
+
+            return owners
+
+        for client_folder in os.listdir(self.data_folder):
+            client_folder_path = os.path.join(self.data_folder, client_folder)
+
+            if not os.path.isdir(client_folder_path):
+                continue
+
+            for user_folder in os.listdir(client_folder_path):
+                user_folder_path = os.path.join(client_folder_path, user_folder)
+
+                # The fan-out folders of a half finished migration hold folders, never vault files
+                if os.path.isdir(user_folder_path) and any(
+                    os.path.exists(os.path.join(user_folder_path, vault_file)) for vault_file in self.VAULT_FILES
+                ):
+                    owners.append((client_folder, user_folder))
+
+        return owners
+
+    def close(self):
+        if self.vault_manifest is not None:
+            self.vault_manifest.close()
+
+
+def migrate_layout(source_layout: DataLayout, target_layout: DataLayout) -> int:
+    # Moves every vault folder from one layout to the other with a rename each. The server must be stopped. The
+    # new layout is only saved once every folder has moved, and an interrupted migration can just be run again
+    moved_vaults = 0
+
+    for client_addr, user in source_layout.scan_owners():
+        source_folder = source_layout.vault_folder(client_addr, user)
+        target_folder = target_layout.vault_folder(client_addr, user)
+
+        if not os.path.isdir(source_folder):
+            continue
+
+        os.makedirs(os.path.dirname(target_folder), exist_ok=True)
+        os.rename(source_folder, target_folder)
+
+        target_layout.register(client_addr, user)
+
+        if source_layout.scheme == "hashed":
+            owner_path = os.path.join(target_folder, ".owner.json")
+
+            if os.path.exists(owner_path):
+                os.remove(owner_path)
+
+        # Drop the parent folders the move left empty
+        parent_folder = os.path.dirname(source_folder)
+
+        while parent_folder != source_layout.data_folder and os.listdir(parent_folder) == []:
+            os.rmdir(parent_folder)
+            parent_folder = os.path.dirname(parent_folder)
+
+        moved_vaults += 1
+
+        logger.info(f"Moved vault folder of {client_addr}/{user} to {target_folder}")
+
+    # Every path in the manifest moved, it is rebuilt the next time vaults are enumerated
+    target_layout.manifest.clear()
+    target_layout.save()
+
+    return moved_vaults
+
+
+class VaultStore:
+    def load(self, client_addr: str, user: str) -> dict:
+        raise NotImplementedError
+
+    def save(self, client_addr: str, user: str, vault: dict) -> int:
+        # Saves the vault and returns its new version. Every save bumps the version by one
+        raise NotImplementedError
+
+    def rewrite(self, client_addr: str, user: str, vault: dict):
+        # Saves a vault holding the same entries in a different stored form, eg re-wrapped with a new data key,
+        # without bumping the version clients compare and set against. Rewrites are always durable
+        raise NotImplementedError
+
+    def load_entries(self, client_addr: str, user: str, selectors: list[list[str]]) -> dict:
+        # Only the selected entries of a vault. A selector is [service] for a whole service or [service, username]
+        # for one entry. Backends that can look entries up directly override this
+        return select_entries(self.load(client_addr, user), selectors)
+
+    def load_listing(self, client_addr: str, user: str) -> dict:
+        # The vault without any password or key: {service: {username: {"last-refresh": ..., "version": ...}}}
+        return list_entries(self.load(client_addr, user))
+
+    def version(self, client_addr: str, user: str) -> int:
+        raise NotImplementedError
+
+    def users(self) -> list[tuple[str, str]]:
+        raise NotImplementedError
+
+    def fingerprint(self, client_addr: str, user: str):
+        # A cheap value that changes whenever the saved vault changes, used to invalidate cached vaults
+        raise NotImplementedError
+
+    def load_tree(self, client_addr: str, user: str) -> dict | None:
+        # The vault's hash tree (see merkle.py), or None if one hasn't been saved
+        raise NotImplementedError
+
+    def save_tree(self, client_addr: str, user: str, tree: dict):
+        raise NotImplementedError
+
+    def delete_tree(self, client_addr: str, user: str):
+        # Drops a hash tree that no longer matches the vault, so the next session rebuilds it
+        raise NotImplementedError
+
+    def load_metadata(self, client_addr: str, user: str) -> dict:
+        # Small per vault values that aren't entries, eg the wrapped data key. Empty if nothing is saved
+        raise NotImplementedError
+
+    def save_metadata(self, client_addr: str, user: str, metadata: dict):
+        raise NotImplementedError
+
+    def vault_folder(self, client_addr: str, user: str) -> str:
+        # Folder holding the vault's lock file. Stores wrapping another store ask the store they wrap
+        return self.vault_store.vault_folder(client_addr, user)
+
+    def manifest(self) -> list[dict]:
+        # {"client_addr", "user", "path", "size", "entries", "version", "last_write"} of every vault, without
+        # reading any of them. size is in bytes of stored data and last_write a unix timestamp
+        return self.vault_store.manifest()
+
+    def entry_count(self, client_addr: str, user: str) -> int:
+        # Number of entries in one vault, from the manifest rather than the vault
+        return self.vault_store.entry_count(client_addr, user)
+
+    def find_store(self, store_type: type):
+        # Stores wrap each other (cache -> envelope -> backend), find the layer of the given type
+        vault_store = self
+
+        while not isinstance(vault_store, store_type):
+            vault_store = getattr(vault_store, "vault_store", None)
+
+            if vault_store is None:
+                return None
+
+        return vault_store
+
+    def flush(self) -> bool:
+        # Makes every write the backend made without waiting for the disk durable, see WalVaultStore.checkpoint.
+        # Returns False if some of them couldn't be synced yet
+        return True
+
+    def close(self):
+        pass
+
+
+class JsonVaultStore(VaultStore):
+    def __init__(
+            self,
+            data_folder: str = "data",
+            group_commit: persistence.GroupCommit = None,
+            layout: DataLayout = None,
+            vault_codec: str = "json"
+    ):
+        self.data_folder = data_folder
+        self.group_commit = group_commit
+        self.layout = layout or DataLayout.load(data_folder)
+
+        # Vaults are written with this codec. Files written with any other codec, or before codecs existed, are
+        # still read and move to this one on their next save
+        self.vault_codec = vault_codec
+
+        # Whether vault and tree writes wait for the disk. Behind a WalVaultStore they don't, its log makes them
+        # durable until a checkpoint flushes the paths written since the last one
+        self.durable = True
+        self.unsynced_paths: set[str] = set()
+        self.unsynced_lock = threading.Lock()
+
+    def vault_folder(self, client_addr: str, user: str) -> str:
+        return self.layout.vault_folder(client_addr, user)
+
+    def vault_path(self, client_addr: str, user: str) -> str:
+        return os.path.join(self.vault_folder(client_addr, user), ".passwords.json")
+
+    def read_vault(self, client_addr: str, user: str) -> bytes | None:
+        try:
+            with open(self.vault_path(client_addr, user), mode="rb") as passwords_file:
+                return passwords_file.read()
+
+        except FileNotFoundError:
+            return None
+
+    def decode_vault(self, client_addr: str, user: str, raw_data: bytes | None) -> dict:
+        if raw_data is None:
+            return {}
+
+        saved_data = codec.decode(raw_data)
+
+        if not isinstance(saved_data, dict):
+            logger.warning(f"The data saved at {self.vault_path(client_addr, user)} was invalid, returning empty data")
+            return {}
+
+        return saved_data
+
+    def load(self, client_addr: str, user: str) -> dict:
+        return self.decode_vault(client_addr, user, self.read_vault(client_addr, user))
+
+    @contextlib.contextmanager
+    def map_vault(self, client_addr: str, user: str):
+        # Yields the vault file as a BinaryVault over a read only mmap, or None if it isn't a binary vault. Lookups
+        # only touch the pages of the index and of the records they read, and slice them without copying the file.
+        # A save during the lookup renames a new file into place and leaves the mapped one as it was
+        try:
+            passwords_file = open(self.vault_path(client_addr, user), mode="rb")
+
+        except FileNotFoundError:
+            yield None
+            return
+
+        with passwords_file:
+            if not codec.is_binary(passwords_file.read(codec.HEADER.size)):
+                yield None
+                return
+
+            with mmap.mmap(passwords_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                binary_vault = codec.BinaryVault(mapped_file)
+
+                try:
+                    yield binary_vault
+
+                finally:
+                    binary_vault.release()
+
+    def load_entries(self, client_addr: str, user: str, selectors: list[list[str]]) -> dict:
+        # Binary vaults are looked up through their index, without reading the other entries
+        with self.map_vault(client_addr, user) as binary_vault:
+            if binary_vault is not None:
+                return binary_vault.select(selectors)
+
+        return select_entries(self.load(client_addr, user), selectors)
+
+    def load_listing(self, client_addr: str, user: str) -> dict:
+        with self.map_vault(client_addr, user) as binary_vault:
+            if binary_vault is not None:
+                return binary_vault.listing()
+
+        return list_entries(self.load(client_addr, user))
+
+    def version_path(self, client_addr: str, user: str) -> str:
+        return os.path.join(self.vault_folder(client_addr, user), ".version")
+
+    def save(self, client_addr: str, user: str, vault: dict) -> int:
+        self.layout.register(client_addr, user)
+
+        new_version = self.version(client_addr, user) + 1
+        vault_data = codec.encode(vault, self.vault_codec)
+
+        # The version is only bumped once the vault it belongs to is on disk
+        persistence.write_files([
+            (self.vault_path(client_addr, user), vault_data),
+            (self.version_path(client_addr, user), str(new_version))
+        ], self.group_commit, self.durable)
+
+        self.written(self.vault_path(client_addr, user), self.version_path(client_addr, user))
+
+        self.layout.manifest.update(
+            client_addr,
+            user,
+            self.vault_path(client_addr, user),
+            len(vault_data),
+            sum(len(usernames) for usernames in vault.values()),
+            new_version
+        )
+
+        return new_version
+
+    def rewrite(self, client_addr: str, user: str, vault: dict):
+        vault_data = codec.encode(vault, self.vault_codec)
+
+        # Durable even behind a write-ahead log, which only logs saves
+        persistence.write_file(self.vault_path(client_addr, user), vault_data, self.group_commit)
+
+        self.layout.manifest.update(
+            client_addr,
+            user,
+            self.vault_path(client_addr, user),
+            len(vault_data),
+            sum(len(usernames) for usernames in vault.values()),
+            self.version(client_addr, user)
+        )
+
+    def version(self, client_addr: str, user: str) -> int:
+        try:
+            with open(self.version_path(client_addr, user), mode="r") as version_file:
+                return int(version_file.read().strip() or 0)
+
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def fingerprint(self, client_addr: str, user: str):
+        try:
+            vault_stat = os.stat(self.vault_path(client_addr, user))
+
+        except FileNotFoundError:
+            return None
+
+        return vault_stat.st_ino, vault_stat.st_mtime_ns, vault_stat.st_size
+
+    def tree_path(self, client_addr: str, user: str) -> str:
+        return os.path.join(self.vault_folder(client_addr, user), ".tree.json")
+
+    def load_tree(self, client_addr: str, user: str) -> dict | None:
+        try:
+            with open(self.tree_path(client_addr, user), mode="r") as tree_file:
+                return json.load(tree_file)
+
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+
+    def save_tree(self, client_addr: str, user: str, tree: dict):
+        persistence.write_json(
+            self.tree_path(client_addr, user),
+            tree,
+            self.group_commit,
+            self.durable,
+            separators=(",", ":")
+        )
+
+        self.written(self.tree_path(client_addr, user))
+
+    def delete_tree(self, client_addr: str, user: str):
+        try:
+            os.remove(self.tree_path(client_addr, user))
+
+        except FileNotFoundError:
+            return
+
+        if self.durable:
+            persistence.fsync_path(self.vault_folder(client_addr, user))
+
+        else:
+            self.written(self.tree_path(client_addr, user))
+
+    def written(self, *paths: str):
+        if not self.durable:
+            with self.unsynced_lock:
+                self.unsynced_paths.update(paths)
+
+    def flush(self) -> bool:
+        with self.unsynced_lock:
+            unsynced_paths, self.unsynced_paths = self.unsynced_paths, set()
+
+        persistence.sync_files(list(unsynced_paths))
+
+        return True
+
+    def metadata_path(self, client_addr: str, user: str) -> str:
+        return os.path.join(self.vault_folder(client_addr, user), ".metadata.json")
+
+    def load_metadata(self, client_addr: str, user: str) -> dict:
+        try:
+            with open(self.metadata_path(client_addr, user), mode="r") as metadata_file:
+                return json.load(metadata_file)
+
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def save_metadata(self, client_addr: str, user: str, metadata: dict):
+        persistence.write_json(self.metadata_path(client_addr, user), metadata, self.group_commit, indent=4)
+
+    def users(self) -> list[tuple[str, str]]:
+        if not self.layout.manifest.built():
+            self.layout.manifest.rebuild(self)
+
+        return self.layout.manifest.users()
+
+    def manifest(self) -> list[dict]:
+        if not self.layout.manifest.built():
+            self.layout.manifest.rebuild(self)
+
+        manifest_rows = self.layout.manifest.vaults()
+
+        for manifest_row in manifest_rows:
+            if not self.manifest_row_current(manifest_row["client_addr"], manifest_row["user"], manifest_row):
+                manifest_row.update(self.refresh_manifest_row(manifest_row["client_addr"], manifest_row["user"]))
+
+        return manifest_rows
+
+    def entry_count(self, client_addr: str, user: str) -> int:
+        manifest_row = self.manifest_row(client_addr, user)
+
+        return 0 if manifest_row is None else manifest_row["entries"]
+
+    def manifest_row(self, client_addr: str, user: str) -> dict | None:
+        # The vault file and its manifest row can't be written in one transaction. A row that doesn't match the
+        # vault's size and version is refreshed from the vault, only that vault is read
+        manifest_row = self.layout.manifest.get(client_addr, user)
+
+        if manifest_row is not None and self.manifest_row_current(client_addr, user, manifest_row):
+            return manifest_row
+
+        return self.refresh_manifest_row(client_addr, user)
+
+    def manifest_row_current(self, client_addr: str, user: str, manifest_row: dict) -> bool:
+        try:
+            vault_size = os.stat(self.vault_path(client_addr, user)).st_size
+
+        except FileNotFoundError:
+            return manifest_row["size"] is None
+
+        return manifest_row["size"] == vault_size and manifest_row["version"] == self.version(client_addr, user)
+
+    def refresh_manifest_row(self, client_addr: str, user: str) -> dict | None:
+        # Also gives vaults saved before the manifest existed their row
+        try:
+            vault_stat = os.stat(self.vault_path(client_addr, user))
+
+        except FileNotFoundError:
+            return self.layout.manifest.get(client_addr, user)
+
+        logger.warning(f"Manifest row of {client_addr}/{user} doesn't match its vault, refreshing it")
+
+        self.layout.manifest.update(
+            client_addr,
+            user,
+            self.vault_path(client_addr, user),
+            vault_stat.st_size,
+            sum(len(usernames) for usernames in self.load(client_addr, user).values()),
+            self.version(client_addr, user),
+            int(vault_stat.st_mtime)
+        )
+
+        return self.layout.manifest.get(client_addr, user)
+
+    def close(self):
+        logger.info(f"Vault codec stats: {dict(codec.counters)}")
+
+        self.layout.close()
+
+
+class SqliteVaultStore(VaultStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            client_addr TEXT NOT NULL,
+            user TEXT NOT NULL,
+            service TEXT NOT NULL,
+            username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            key TEXT NOT NULL,
+            last_refresh TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (client_addr, user, service, username)
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS entries_last_refresh ON entries (last_refresh);
+
+        CREATE TABLE IF NOT EXISTS vaults (
+            client_addr TEXT NOT NULL,
+            user TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            size INTEGER,
+            entries INTEGER,
+            last_write INTEGER,
+            PRIMARY KEY (client_addr, user)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS trees (
+            client_addr TEXT NOT NULL,
+            user TEXT NOT NULL,
+            tree TEXT NOT NULL,
+            PRIMARY KEY (client_addr, user)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS metadata (
+            client_addr TEXT NOT NULL,
+            user TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            PRIMARY KEY (client_addr, user)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, database_path: str = os.path.join("data", "vaults.sqlite3"), layout: DataLayout = None):
+        self.database_path = database_path
+        self.local = threading.local()
+
+        # Only lock files live in the vault folders of this backend
+        self.layout = layout or DataLayout.load(os.path.dirname(database_path) or ".")
+
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self.connection().executescript(self.SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        # Add columns that databases created by older versions of the server don't have yet
+        entry_columns = {column[1] for column in self.connection().execute("PRAGMA table_info(entries)")}
+
+        if "version" not in entry_columns:
+            self.connection().execute("ALTER TABLE entries ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+        vault_columns = {column[1] for column in self.connection().execute("PRAGMA table_info(vaults)")}
+
+        if "entries" not in vault_columns:
+            # The manifest columns, backfilled once from the entries. last_write is only known from the next save on
+            self.connection().executescript("""
+                BEGIN IMMEDIATE;
+                ALTER TABLE vaults ADD COLUMN size INTEGER;
+                ALTER TABLE vaults ADD COLUMN entries INTEGER;
+                ALTER TABLE vaults ADD COLUMN last_write INTEGER;
+                UPDATE vaults SET
+                    entries = (
+                        SELECT COUNT(*) FROM entries
+                        WHERE entries.client_addr = vaults.client_addr AND entries.user = vaults.user
+                    ),
+                    size = (
+                        SELECT COALESCE(SUM(LENGTH(password) + LENGTH(key)), 0) FROM entries
+                        WHERE entries.client_addr = vaults.client_addr AND entries.user = vaults.user
+                    );
+                COMMIT;
+            """)
+
+    def connection(self) -> sqlite3.Connection:
+        return local_sqlite_connection(self.local, self.database_path)
+
+    def load(self, client_addr: str, user: str) -> dict:
+        vault = {}
+
+        rows = self.connection().execute(
+            "SELECT service, username, password, key, last_refresh, version FROM entries "
+            "WHERE client_addr = ? AND user = ?",
+            (client_addr, user)
+        )
+
+        self.add_rows(vault, rows)
+
+        return vault
+
+    def load_entries(self, client_addr: str, user: str, selectors: list[list[str]]) -> dict:
+        vault = {}
+
+        for selector in selectors:
+            # Both lookups use the primary key, so only the selected rows are read
+            rows = self.connection().execute(
+                "SELECT service, username, password, key, last_refresh, version FROM entries "
+                "WHERE client_addr = ? AND user = ? AND service = ?" + (" AND username = ?" if len(selector) > 1 else ""),
+                (client_addr, user, *selector[:2])
+            )
+
+            self.add_rows(vault, rows)
+
+        return vault
+
+    def load_listing(self, client_addr: str, user: str) -> dict:
+        listing = {}
+
+        # The password and key columns are never read
+        rows = self.connection().execute(
+            "SELECT service, username, last_refresh, version FROM entries WHERE client_addr = ? AND user = ?",
+            (client_addr, user)
+        )
+
+        for service, username, last_refresh, version in rows:
+            listed_entry = {}
+
+            if last_refresh is not None:
+                listed_entry["last-refresh"] = last_refresh
+
+            if version != 0:
+                listed_entry["version"] = version
+
+            listing.setdefault(service, {})[username] = listed_entry
+
+        return listing
+
+    @staticmethod
+    def add_rows(vault: dict, rows):
+        for service, username, password, key, last_refresh, version in rows:
+            entry = {
+                "password": password,
+                "key": key
+            }
+
+            if last_refresh is not None:
+                entry["last-refresh"] = last_refresh
+
+            if version != 0:
+                entry["version"] = version
+
+            vault.setdefault(service, {})[username] = entry
+
+    def save(self, client_addr: str, user: str, vault: dict) -> int:
+        return self.write_entries(client_addr, user, vault, True)
+
+    def rewrite(self, client_addr: str, user: str, vault: dict):
+        connection = self.connection()
+
+        # Synced like the metadata, the data key replacement drops the old data key right after this
+        connection.execute("PRAGMA synchronous=FULL")
+
+        try:
+            self.write_entries(client_addr, user, vault, False)
+
+        finally:
+            connection.execute("PRAGMA synchronous=NORMAL")
+
+    def write_entries(self, client_addr: str, user: str, vault: dict, bump_version: bool) -> int:
+        new_rows = {}
+
+        for service in vault.keys():
+            for username, entry in vault[service].items():
+                new_rows[(service, username)] = (
+                    entry["password"],
+                    entry["key"],
+                    entry.get("last-refresh"),
+                    entry.get("version", 0)
+                )
+
+        connection = self.connection()
+
+        # BEGIN IMMEDIATE takes the write lock before reading, so the diff can't go stale under another writer
+        connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            saved_rows = {
+                (service, username): (password, key, last_refresh, version)
+                for service, username, password, key, last_refresh, version in connection.execute(
+                    "SELECT service, username, password, key, last_refresh, version FROM entries "
+                    "WHERE client_addr = ? AND user = ?",
+                    (client_addr, user)
+                )
+            }
+
+            deleted_rows = [
+                (client_addr, user, service, username) for service, username in saved_rows.keys() - new_rows.keys()
+            ]
+            changed_rows = [
+                (client_addr, user, service, username, *row)
+                for (service, username), row in new_rows.items()
+                if saved_rows.get((service, username)) != row
+            ]
+
+            connection.executemany(
+                "DELETE FROM entries WHERE client_addr = ? AND user = ? AND service = ? AND username = ?",
+                deleted_rows
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries "
+                "(client_addr, user, service, username, password, key, last_refresh, version) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                changed_rows
+            )
+
+            # Bump the vault version so cached copies in every worker process are invalidated. The manifest columns
+            # are updated in the same transaction as the entries. Rewrites keep the version, the vault they write
+            # holds the same entries
+            connection.execute(
+                "INSERT INTO vaults (client_addr, user, version, size, entries, last_write) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (client_addr, user) DO UPDATE SET version = version + ?, size = excluded.size, "
+                "entries = excluded.entries, last_write = excluded.last_write",
+                (
+                    client_addr,
+                    user,
+                    int(bump_version),
+                    sum(len(row[0]) + len(row[1]) for row in new_rows.values()),
+                    len(new_rows),
+                    int(time.time()),
+                    int(bump_version)
+                )
+            )
+
+            new_version = connection.execute(
+                "SELECT version FROM vaults WHERE client_addr = ? AND user = ?",
+                (client_addr, user)
+            ).fetchone()[0]
+
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        connection.execute("COMMIT")
+
+        logger.info(f"Saved vault for {client_addr}/{user}: {len(changed_rows)} rows written, {len(deleted_rows)} deleted")
+
+        return new_version
+
+    def version(self, client_addr: str, user: str) -> int:
+        return self.fingerprint(client_addr, user) or 0
+
+    def fingerprint(self, client_addr: str, user: str):
+        version = self.connection().execute(
+            "SELECT version FROM vaults WHERE client_addr = ? AND user = ?",
+            (client_addr, user)
+        ).fetchone()
+
+        return None if version is None else version[0]
+
+    def load_tree(self, client_addr: str, user: str) -> dict | None:
+        tree = self.connection().execute(
+            "SELECT tree FROM trees WHERE client_addr = ? AND user = ?",
+            (client_addr, user)
+        ).fetchone()
+
+        return None if tree is None else json.loads(tree[0])
+
+    def save_tree(self, client_addr: str, user: str, tree: dict):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO trees (client_addr, user, tree) VALUES (?, ?, ?)",
+            (client_addr, user, json.dumps(tree, separators=(",", ":")))
+        )
+
+    def delete_tree(self, client_addr: str, user: str):
+        self.connection().execute("DELETE FROM trees WHERE client_addr = ? AND user = ?", (client_addr, user))
+
+    def load_metadata(self, client_addr: str, user: str) -> dict:
+        metadata = self.connection().execute(
+            "SELECT metadata FROM metadata WHERE client_addr = ? AND user = ?",
+            (client_addr, user)
+        ).fetchone()
+
+        return {} if metadata is None else json.loads(metadata[0])
+
+    def save_metadata(self, client_addr: str, user: str, metadata: dict):
+        connection = self.connection()
+
+        # Synced even though saves aren't, the wrapped data key has to survive a power loss that a write-ahead log
+        # replay of entries wrapped with it would follow
+        connection.execute("PRAGMA synchronous=FULL")
+
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO metadata (client_addr, user, metadata) VALUES (?, ?, ?)",
+                (client_addr, user, json.dumps(metadata))
+            )
+
+        finally:
+            connection.execute("PRAGMA synchronous=NORMAL")
+
+    def vault_folder(self, client_addr: str, user: str) -> str:
+        return self.layout.vault_folder(client_addr, user)
+
+    def flush(self) -> bool:
+        # With synchronous=NORMAL commits reach sqlite's own log without a sync. A full checkpoint syncs that log
+        # and copies it into the database file, unless another connection keeps it from finishing
+        busy, _, _ = self.connection().execute("PRAGMA wal_checkpoint(FULL)").fetchone()
+
+        return busy == 0
+
+    def users(self) -> list[tuple[str, str]]:
+        return list(self.connection().execute("SELECT client_addr, user FROM vaults WHERE entries > 0"))
+
+    def manifest(self) -> list[dict]:
+        return [
+            {
+                "client_addr": client_addr,
+                "user": user,
+                "path": self.database_path,
+                "size": size,
+                "entries": entries,
+                "version": version,
+                "last_write": last_write
+            }
+            for client_addr, user, size, entries, version, last_write in self.connection().execute(
+                "SELECT client_addr, user, size, entries, version, last_write FROM vaults"
+            )
+        ]
+
+    def entry_count(self, client_addr: str, user: str) -> int:
+        entries = self.connection().execute(
+            "SELECT entries FROM vaults WHERE client_addr = ? AND user = ?",
+            (client_addr, user)
+        ).fetchone()
+
+        return 0 if entries is None else entries[0]
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+
+        self.local = threading.local()
+        self.layout.close()
+
+
+class RotationIndex:
+    # When each vault is next due for key rotation, kept in data/rotation_due.sqlite3 whatever the storage backend.
+    # A vault is due once its data key is older than the maximum age, or once its data key is wrapped with a KEK
+    # that is about to be retired. Both columns are indexed, so the rotation only reads the rows that are due
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rotation_due (
+            client_addr TEXT NOT NULL,
+            user TEXT NOT NULL,
+            data_key_created INTEGER NOT NULL,
+            kek_id INTEGER NOT NULL,
+            PRIMARY KEY (client_addr, user)
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS rotation_due_data_key_created ON rotation_due (data_key_created);
+        CREATE INDEX IF NOT EXISTS rotation_due_kek_id ON rotation_due (kek_id);
+
+        CREATE TABLE IF NOT EXISTS rotation_index_state (
+            built INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, database_path: str = os.path.join("data", "rotation_due.sqlite3")):
+        self.database_path = database_path
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self.connection().executescript(self.SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        return local_sqlite_connection(self.local, self.database_path)
+
+    def update(self, client_addr: str, user: str, metadata: dict):
+        # Vaults without a data key yet are indexed as created at the epoch with KEK 0, so they are due straight away
+        if "data_key_created" in metadata:
+            data_key_created = int(datetime.datetime.strptime(metadata["data_key_created"], "%m-%d-%Y").timestamp())
+
+        else:
+            data_key_created = 0
+
+        self.connection().execute(
+            "INSERT OR REPLACE INTO rotation_due (client_addr, user, data_key_created, kek_id) VALUES (?, ?, ?, ?)",
+            (client_addr, user, data_key_created, int(metadata.get("kek_id", 0)))
+        )
+
+    def due(self, data_keys_created_before: int, oldest_kek_kept: int) -> list[tuple[str, str]]:
+        return list(self.connection().execute(
+            """
+                SELECT client_addr, user FROM rotation_due WHERE data_key_created < ?
+                UNION
+                SELECT client_addr, user FROM rotation_due WHERE kek_id < ?
+            """,
+            (data_keys_created_before, oldest_kek_kept)
+        ))
+
+    def kek_in_use(self, kek_id: str) -> bool:
+        return self.connection().execute(
+            "SELECT 1 FROM rotation_due WHERE kek_id = ? LIMIT 1",
+            (int(kek_id),)
+        ).fetchone() is not None
+
+    def built(self) -> bool:
+        return self.connection().execute("SELECT built FROM rotation_index_state").fetchone() is not None
+
+    def rebuild(self, vault_store: VaultStore) -> int:
+        # One full pass over every vault's metadata, for a server upgraded from before the index existed
+        indexed_vaults = 0
+
+        for client_addr, user in vault_store.users():
+            self.update(client_addr, user, vault_store.load_metadata(client_addr, user))
+            indexed_vaults += 1
+
+        connection = self.connection()
+        connection.execute("DELETE FROM rotation_index_state")
+        connection.execute("INSERT INTO rotation_index_state (built) VALUES (1)")
+
+        logger.info(f"Rebuilt the rotation index from {indexed_vaults} vault(s)")
+
+        return indexed_vaults
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+
+        self.local = threading.local()
+
+
+def select_entries(vault: dict, selectors: list[list[str]]) -> dict:
+    selected_entries = {}
+
+    for selector in selectors:
+        service = selector[0]
+
+        if service not in vault:
+            continue
+
+        if len(selector) == 1:
+            selected_entries[service] = dict(vault[service])
+
+        elif selector[1] in vault[service]:
+            selected_entries.setdefault(service, {})[selector[1]] = vault[service][selector[1]]
+
+    return selected_entries
+
+
+def list_entries(vault: dict) -> dict:
+    return {
+        service: {
+            username: {field: entry[field] for field in ("last-refresh", "version") if field in entry}
+            for username, entry in vault[service].items()
+        }
+        for service in vault.keys()
+    }
+
+
+def copy_vault(vault: dict) -> dict:
+    # Vaults are only ever three levels deep, copying them by hand is a lot faster than copy.deepcopy
+    return {
+        service: {
+            username: dict(entry) for username, entry in usernames.items()
+        }
+        for service, usernames in vault.items()
+    }
+
+
+def estimate_vault_size(vault: dict) -> int:
+    # Rough number of bytes a parsed vault holds, counting its strings plus a fixed overhead per dict
+    vault_size = 0
+
+    for service, usernames in vault.items():
+        vault_size += len(service) + 200
+
+        for username, entry in usernames.items():
+            vault_size += len(username) + 200
+
+            for field, value in entry.items():
+                vault_size += len(field) + len(str(value)) + 100
+
+    return vault_size
+
+
+def diff_vaults(saved_vault: dict, vault: dict) -> tuple[dict, list[list[str]]]:
+    # The entries of vault that are new or changed since saved_vault, and the [service, username] of the entries
+    # it no longer has
+    changed_entries = {}
+
+    for service, usernames in vault.items():
+        for username, entry in usernames.items():
+            if saved_vault.get(service, {}).get(username) != entry:
+                changed_entries.setdefault(service, {})[username] = entry
+
+    deleted_entries = [
+        [service, username]
+        for service, usernames in saved_vault.items()
+        for username in usernames.keys()
+        if username not in vault.get(service, {})
+    ]
+
+    return changed_entries, deleted_entries
+
+
+class WalVaultStore(VaultStore):
+    # Logs every save and tree save to a wal.WriteAheadLog before handing it to the backend, which then doesn't
+    # have to wait for the disk itself. Checkpoints wait for saves in progress, so a save's record is never dropped
+    # from the log before its backend write is done
+    def __init__(
+            self,
+            vault_store: VaultStore,
+            write_ahead_log: wal.WriteAheadLog,
+            max_saved_bytes: int = 16 * 1024 * 1024
+    ):
+        self.vault_store = vault_store
+        self.write_ahead_log = write_ahead_log
+
+        # (client_addr, user): (version, vault, estimated size) of the last vaults saved through this store. A save
+        # is diffed against the vault it replaces, which is read back from the backend only if it isn't kept here
+        self.saved_vaults: collections.OrderedDict[tuple[str, str], tuple[int, dict, int]] = collections.OrderedDict()
+        self.saved_bytes = 0
+        self.max_saved_bytes = max_saved_bytes
+        self.saved_vaults_lock = threading.Lock()
+
+        self.condition = threading.Condition()
+        self.active_saves = 0
+        self.checkpointing = False
+
+    def begin_save(self):
+        with self.condition:
+            while self.checkpointing:
+                self.condition.wait()
+
+            self.active_saves += 1
+
+    def end_save(self):
+        with self.condition:
+            self.active_saves -= 1
+            self.condition.notify_all()
+
+        if self.write_ahead_log.size() >= self.write_ahead_log.checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self):
+        with self.condition:
+            if self.checkpointing:
+                return
+
+            self.checkpointing = True
+
+            while self.active_saves > 0:
+                self.condition.wait()
+
+        try:
+            # The log is only emptied once the backend is on disk, otherwise the next save tries again
+            if self.vault_store.flush():
+                self.write_ahead_log.checkpoint()
+
+        finally:
+            with self.condition:
+                self.checkpointing = False
+                self.condition.notify_all()
+
+    def save(self, client_addr: str, user: str, vault: dict) -> int:
+        # The caller holds the vault lock, so the version can't move between the record and the backend write
+        self.begin_save()
+
+        try:
+            version = self.vault_store.version(client_addr, user)
+            changed_entries, deleted_entries = diff_vaults(self.saved_vault(client_addr, user, version), vault)
+
+            self.write_ahead_log.append({
+                "client_addr": client_addr,
+                "user": user,
+                "version": version + 1,
+                "set": changed_entries,
+                "delete": deleted_entries
+            })
+
+            new_version = self.vault_store.save(client_addr, user, vault)
+            self.remember_saved_vault(client_addr, user, new_version, copy_vault(vault))
+
+            return new_version
+
+        finally:
+            self.end_save()
+
+    def rewrite(self, client_addr: str, user: str, vault: dict):
+        # Not logged, the backend writes it durably. The vault kept for the version no longer matches what's saved
+        with self.saved_vaults_lock:
+            saved_vault = self.saved_vaults.pop((client_addr, user), None)
+
+            if saved_vault is not None:
+                self.saved_bytes -= saved_vault[2]
+
+        self.vault_store.rewrite(client_addr, user, vault)
+
+    def saved_vault(self, client_addr: str, user: str, version: int) -> dict:
+        # The vault as saved at version. Another process may have saved it since this one did, the version tells
+        with self.saved_vaults_lock:
+            saved_vault = self.saved_vaults.get((client_addr, user))
+
+            if saved_vault is not None and saved_vault[0] == version:
+                self.saved_vaults.move_to_end((client_addr, user))
+
+                return saved_vault[1]
+
+        return self.vault_store.load(client_addr, user)
+
+    def remember_saved_vault(self, client_addr: str, user: str, version: int, vault: dict):
+        vault_size = estimate_vault_size(vault)
+
+        with self.saved_vaults_lock:
+            previous_vault = self.saved_vaults.pop((client_addr, user), None)
+
+            if previous_vault is not None:
+                self.saved_bytes -= previous_vault[2]
+
+            if vault_size > self.max_saved_bytes:
+                return
+
+            self.saved_vaults[(client_addr, user)] = (version, vault, vault_size)
+            self.saved_bytes += vault_size
+
+            while self.saved_bytes > self.max_saved_bytes:
+                _, (_, _, evicted_size) = self.saved_vaults.popitem(last=False)
+                self.saved_bytes -= evicted_size
+
+    def save_tree(self, client_addr: str, user: str, tree: dict):
+        self.begin_save()
+
+        try:
+            self.write_ahead_log.append({
+                "client_addr": client_addr,
+                "user": user,
+                "version": self.vault_store.version(client_addr, user),
+                "tree": tree
+            })
+
+            self.vault_store.save_tree(client_addr, user, tree)
+
+        finally:
+            self.end_save()
+
+    def recover(self) -> int:
+        # Replays the logs left by every process onto the backend. Must run before any session or worker process
+        # starts. A save is replayed only if the backend is exactly one version behind it, so replaying saves
+        # that already made it to disk is harmless. Returns the number of saves replayed
+        vault_records: dict[tuple[str, str], list[dict]] = {}
+        tree_records: dict[tuple[str, str], list[dict]] = {}
+
+        for record in self.write_ahead_log.read_all():
+            records = tree_records if "tree" in record else vault_records
+            records.setdefault((record["client_addr"], record["user"]), []).append(record)
+
+        replayed_saves = 0
+
+        for (client_addr, user), records in vault_records.items():
+            version = self.vault_store.version(client_addr, user)
+            vault = None
+
+            for record in sorted(records, key=lambda vault_record: vault_record["version"]):
+                if record["version"] <= version:
+                    continue
+
+                if record["version"] != version + 1:
+                    logger.error(f"Write-ahead log of {client_addr}/{user} is missing version {version + 1}")
+                    break
+
+                if vault is None:
+                    vault = self.vault_store.load(client_addr, user)
+
+                for service, usernames in record["set"].items():
+                    vault.setdefault(service, {}).update(usernames)
+
+                for service, username in record["delete"]:
+                    vault.get(service, {}).pop(username, None)
+
+                    if vault.get(service) == {}:
+                        del vault[service]
+
+                version = self.vault_store.save(client_addr, user, vault)
+                replayed_saves += 1
+
+        for client_addr, user in vault_records.keys() | tree_records.keys():
+            version = self.vault_store.version(client_addr, user)
+            current_trees = [
+                record["tree"] for record in tree_records.get((client_addr, user), []) if record["version"] == version
+            ]
+
+            if current_trees != []:
+                self.vault_store.save_tree(client_addr, user, current_trees[-1])
+
+            else:
+                # The saved tree may be older than the vault, and load_vault_tree only rebuilds a missing tree.
+                # Rebuilding needs the client's digest key, so the tree is dropped and rebuilt by its next session
+                self.vault_store.delete_tree(client_addr, user)
+
+        if not self.vault_store.flush():
+            raise RuntimeError("The backend couldn't be synced, the write-ahead logs are kept for the next start up")
+
+        self.write_ahead_log.remove_all()
+
+        logger.info(f"Replayed {replayed_saves} save(s) from the write-ahead log")
+
+        return replayed_saves
+
+    def load(self, client_addr: str, user: str) -> dict:
+        return self.vault_store.load(client_addr, user)
+
+    def load_entries(self, client_addr: str, user: str, selectors: list[list[str]]) -> dict:
+        return self.vault_store.load_entries(client_addr, user, selectors)
+
+    def load_listing(self, client_addr: str, user: str) -> dict:
+        return self.vault_store.load_listing(client_addr, user)
+
+    def version(self, client_addr: str, user: str) -> int:
+        return self.vault_store.version(client_addr, user)
+
+    def users(self) -> list[tuple[str, str]]:
+        return self.vault_store.users()
+
+    def fingerprint(self, client_addr: str, user: str):
+        return self.vault_store.fingerprint(client_addr, user)
+
+    def load_tree(self, client_addr: str, user: str) -> dict | None:
+        return self.vault_store.load_tree(client_addr, user)
+
+    def load_metadata(self, client_addr: str, user: str) -> dict:
+        return self.vault_store.load_metadata(client_addr, user)
+
+    def save_metadata(self, client_addr: str, user: str, metadata: dict):
+        # Not logged, the wrapped data key has to be on disk before any entry wrapped with it is
+        self.vault_store.save_metadata(client_addr, user, metadata)
+
+    def close(self):
+        self.checkpoint()
+        self.write_ahead_log.close()
+        self.vault_store.close()
+
+
+class EnvelopeVaultStore(VaultStore):
+    # Wraps every entry's key with the vault's data key on save and unwraps it on load (see envelope.py), so the
+    # rest of the server only ever sees keys wrapped by the client's main key
+    def __init__(self, vault_store: VaultStore, key_ring: envelope.KeyRing, rotation_index: RotationIndex = None):
+        self.vault_store = vault_store
+        self.key_ring = key_ring
+        self.rotation_index = rotation_index
+
+        # Unwrapping a data key costs a Fernet decrypt, remember the ones we've already unwrapped
+        self.data_keys: dict[tuple[str, str], bytes] = {}
+
+    def data_key(self, metadata: dict) -> bytes:
+        data_key_id = (metadata["kek_id"], metadata["wrapped_data_key"])
+
+        if data_key_id not in self.data_keys:
+            if len(self.data_keys) > 4096:
+                self.data_keys.clear()
+
+            self.data_keys[data_key_id] = self.key_ring.unwrap(*data_key_id)
+
+        return self.data_keys[data_key_id]
+
+    def unwrap_entry_key(self, metadata: dict, stored_entry_key: str) -> str:
+        try:
+            return envelope.unwrap_entry_key(self.data_key(metadata), stored_entry_key)
+
+        except cryptography.exceptions.InvalidTag:
+            # A data key replacement was interrupted before the entries were saved, they still use the old data key
+            if "previous_data_key" not in metadata:
+                raise
+
+            return envelope.unwrap_entry_key(self.data_key(metadata["previous_data_key"]), stored_entry_key)
+
+    def load(self, client_addr: str, user: str) -> dict:
+        return self.unwrap_vault(client_addr, user, self.vault_store.load(client_addr, user))
+
+    def load_entries(self, client_addr: str, user: str, selectors: list[list[str]]) -> dict:
+        # Only the selected entry keys are unwrapped
+        return self.unwrap_vault(client_addr, user, self.vault_store.load_entries(client_addr, user, selectors))
+
+    def load_listing(self, client_addr: str, user: str) -> dict:
+        # Listings have no keys, nothing to unwrap
+        return self.vault_store.load_listing(client_addr, user)
+
+    def unwrap_vault(self, client_addr: str, user: str, vault: dict) -> dict:
+        metadata = self.vault_store.load_metadata(client_addr, user)
+
+        if "wrapped_data_key" not in metadata:
+            return vault
+
+        # Wrapping is deterministic, entries that share a key share its stored form and it is only unwrapped once
+        entry_keys = {}
+
+        for service in vault.keys():
+            for entry in vault[service].values():
+                if entry["key"] not in entry_keys:
+                    entry_keys[entry["key"]] = self.unwrap_entry_key(metadata, entry["key"])
+
+                entry["key"] = entry_keys[entry["key"]]
+
+        return vault
+
+    def save(self, client_addr: str, user: str, vault: dict) -> int:
+        metadata = self.vault_store.load_metadata(client_addr, user)
+
+        if "wrapped_data_key" not in metadata:
+            # The data key is saved before any entry is wrapped with it
+            data_key, data_key_metadata = envelope.new_data_key(self.key_ring)
+            metadata.update(data_key_metadata)
+
+            self.save_metadata(client_addr, user, metadata)
+
+        else:
+            data_key = self.data_key(metadata)
+
+            # Vaults that are written to move to the active KEK as they go, so the rotation only has to re-wrap
+            # the data keys of vaults nobody has touched for a while
+            if metadata["kek_id"] != self.key_ring.active_id and "previous_data_key" not in metadata:
+                self.save_metadata(client_addr, user, envelope.rewrap_data_key(self.key_ring, metadata))
+
+        wrapped_vault = copy_vault(vault)
+        wrapped_keys = {}
+
+        for service in wrapped_vault.keys():
+            for entry in wrapped_vault[service].values():
+                if entry["key"] not in wrapped_keys:
+                    wrapped_keys[entry["key"]] = envelope.wrap_entry_key(data_key, entry["key"])
+
+                entry["key"] = wrapped_keys[entry["key"]]
+
+        return self.vault_store.save(client_addr, user, wrapped_vault)
+
+    def replace_data_key(self, client_addr: str, user: str) -> int:
+        # Full data key rotation: every entry key is re-wrapped with a brand new data key. The caller holds the
+        # vault lock
+        vault = self.load(client_addr, user)
+        metadata = self.vault_store.load_metadata(client_addr, user)
+
+        data_key, data_key_metadata = envelope.new_data_key(self.key_ring)
+        metadata.update(data_key_metadata)
+
+        wrapped_vault = copy_vault(vault)
+        entry_count = 0
+
+        for service in wrapped_vault.keys():
+            for entry in wrapped_vault[service].values():
+                entry["key"] = envelope.wrap_entry_key(data_key, entry["key"])
+                entry_count += 1
+
+        # Entries wrapped with the old data key can't be read with the new one. Keep the old data key in the metadata
+        # until the entries are saved, so an interrupted replacement can still be read
+        previous_metadata = self.vault_store.load_metadata(client_addr, user)
+
+        if "wrapped_data_key" in previous_metadata:
+            metadata["previous_data_key"] = {
+                "kek_id": previous_metadata["kek_id"],
+                "wrapped_data_key": previous_metadata["wrapped_data_key"]
+            }
+
+        # The entries themselves don't change, so the version clients compare and set against doesn't either
+        self.vault_store.save_metadata(client_addr, user, metadata)
+        self.vault_store.rewrite(client_addr, user, wrapped_vault)
+
+        metadata.pop("previous_data_key", None)
+        self.save_metadata(client_addr, user, metadata)
+
+        return entry_count
+
+    def rewrap_data_key(self, client_addr: str, user: str) -> str | None:
+        # Routine rotation: move the vault's data key to the active KEK. Returns the KEK the vault is wrapped with
+        metadata = self.vault_store.load_metadata(client_addr, user)
+
+        if "wrapped_data_key" not in metadata:
+            return None
+
+        if metadata["kek_id"] != self.key_ring.active_id:
+            metadata = envelope.rewrap_data_key(self.key_ring, metadata)
+
+            if "previous_data_key" in metadata:
+                metadata["previous_data_key"] = envelope.rewrap_data_key(self.key_ring, metadata["previous_data_key"])
+
+            self.save_metadata(client_addr, user, metadata)
+
+        return metadata["kek_id"]
+
+    def fingerprint(self, client_addr: str, user: str):
+        return self.vault_store.fingerprint(client_addr, user)
+
+    def version(self, client_addr: str, user: str) -> int:
+        return self.vault_store.version(client_addr, user)
+
+    def load_tree(self, client_addr: str, user: str) -> dict | None:
+        return self.vault_store.load_tree(client_addr, user)
+
+    def save_tree(self, client_addr: str, user: str, tree: dict):
+        self.vault_store.save_tree(client_addr, user, tree)
+
+    def load_metadata(self, client_addr: str, user: str) -> dict:
+        return self.vault_store.load_metadata(client_addr, user)
+
+    def save_metadata(self, client_addr: str, user: str, metadata: dict):
+        self.vault_store.save_metadata(client_addr, user, metadata)
+
+        if self.rotation_index is not None:
+            self.rotation_index.update(client_addr, user, metadata)
+
+    def users(self) -> list[tuple[str, str]]:
+        return self.vault_store.users()
+
+    def close(self):
+        if self.rotation_index is not None:
+            self.rotation_index.close()
+
+        self.vault_store.close()
+
+
+class CachedVaultStore(VaultStore):
+    # Process wide LRU cache of parsed vaults in front of another store. Every load checks the backend's
+    # fingerprint, so a vault written by another worker process is reloaded instead of served stale
+    def __init__(self, vault_store: VaultStore, max_cache_bytes: int = 64 * 1024 * 1024):
+        self.vault_store = vault_store
+        self.max_cache_bytes = max_cache_bytes
+
+        # (client_addr, user): (fingerprint, vault, estimated size)
+        self.cached_vaults: collections.OrderedDict[tuple[str, str], tuple] = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.cache_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def load(self, client_addr: str, user: str) -> dict:
+        cache_key = (client_addr, user)
+        fingerprint = self.vault_store.fingerprint(client_addr, user)
+
+        with self.cache_lock:
+            cached_vault = self.cached_vaults.get(cache_key)
+
+            if cached_vault is not None and cached_vault[0] == fingerprint:
+                self.hits += 1
+                self.cached_vaults.move_to_end(cache_key)
+
+                # Callers mutate the vault they get back, never hand out the cached copy itself
+                return copy_vault(cached_vault[1])
+
+            self.misses += 1
+
+            if cached_vault is not None:
+                self.invalidations += 1
+                self.remove(cache_key)
+
+        vault = self.vault_store.load(client_addr, user)
+        self.remember(cache_key, fingerprint, vault)
+
+        return copy_vault(vault)
+
+    def load_entries(self, client_addr: str, user: str, selectors: list[list[str]]) -> dict:
+        cache_key = (client_addr, user)
+        fingerprint = self.vault_store.fingerprint(client_addr, user)
+
+        with self.cache_lock:
+            cached_vault = self.cached_vaults.get(cache_key)
+
+            if cached_vault is not None and cached_vault[0] == fingerprint:
+                self.hits += 1
+                self.cached_vaults.move_to_end(cache_key)
+
+                return copy_vault(select_entries(cached_vault[1], selectors))
+
+        # Not worth loading the whole vault into the cache for a few entries
+        return self.vault_store.load_entries(client_addr, user, selectors)
+
+    def load_listing(self, client_addr: str, user: str) -> dict:
+        fingerprint = self.vault_store.fingerprint(client_addr, user)
+
+        with self.cache_lock:
+            cached_vault = self.cached_vaults.get((client_addr, user))
+
+            if cached_vault is not None and cached_vault[0] == fingerprint:
+                self.hits += 1
+
+                return list_entries(cached_vault[1])
+
+        return self.vault_store.load_listing(client_addr, user)
+
+    def save(self, client_addr: str, user: str, vault: dict) -> int:
+        new_version = self.vault_store.save(client_addr, user, vault)
+
+        # Update the cache in place with what we just wrote, so the next load doesn't parse it again
+        self.remember((client_addr, user), self.vault_store.fingerprint(client_addr, user), copy_vault(vault))
+
+        return new_version
+
+    def version(self, client_addr: str, user: str) -> int:
+        return self.vault_store.version(client_addr, user)
+
+    def remember(self, cache_key: tuple[str, str], fingerprint, vault: dict):
+        vault_size = estimate_vault_size(vault)
+
+        with self.cache_lock:
+            self.remove(cache_key)
+
+            if fingerprint is None or vault_size > self.max_cache_bytes:
+                return
+
+            self.cached_vaults[cache_key] = (fingerprint, vault, vault_size)
+            self.cached_bytes += vault_size
+
+            while self.cached_bytes > self.max_cache_bytes:
+                evicted_key = next(iter(self.cached_vaults))
+                self.remove(evicted_key)
+                self.evictions += 1
+
+    def remove(self, cache_key: tuple[str, str]):
+        cached_vault = self.cached_vaults.pop(cache_key, None)
+
+        if cached_vault is not None:
+            self.cached_bytes -= cached_vault[2]
+
+    def stats(self) -> dict:
+        with self.cache_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "cached_vaults": len(self.cached_vaults),
+                "cached_bytes": self.cached_bytes
+            }
+
+    def fingerprint(self, client_addr: str, user: str):
+        return self.vault_store.fingerprint(client_addr, user)
+
+    def load_tree(self, client_addr: str, user: str) -> dict | None:
+        return self.vault_store.load_tree(client_addr, user)
+
+    def save_tree(self, client_addr: str, user: str, tree: dict):
+        self.vault_store.save_tree(client_addr, user, tree)
+
+    def load_metadata(self, client_addr: str, user: str) -> dict:
+        return self.vault_store.load_metadata(client_addr, user)
+
+    def save_metadata(self, client_addr: str, user: str, metadata: dict):
+        self.vault_store.save_metadata(client_addr, user, metadata)
+
+    def users(self) -> list[tuple[str, str]]:
+        return self.vault_store.users()
+
+    def close(self):
+        logger.info(f"Vault cache stats: {self.stats()}")
+
+        self.vault_store.close()
+
+
+STORAGE_BACKENDS = {
+    "json": JsonVaultStore,
+    "sqlite": SqliteVaultStore
+}
+
+
+def open_vault_store(
+        backend: str = "sqlite",
+        cache_size_mb: int = 64,
+        key_ring: envelope.KeyRing = None,
+        rotation_index: RotationIndex = None,
+        group_commit: persistence.GroupCommit = None,
+        write_ahead_log: wal.WriteAheadLog = None,
+        vault_codec: str = "json"
+) -> VaultStore:
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend {backend}")
+
+    # sqlite commits its own transactions and stores entries as rows, group commit and codecs only apply to the
+    # json backend's files
+    if backend == "json":
+        vault_store = JsonVaultStore(group_commit=group_commit, vault_codec=vault_codec)
+
+    else:
+        vault_store = STORAGE_BACKENDS[backend]()
+
+    if write_ahead_log is not None:
+        # The log makes saves durable, the backend's files are only synced when it is checkpointed
+        if backend == "json":
+            vault_store.durable = False
+
+        vault_store = WalVaultStore(vault_store, write_ahead_log)
+
+    if key_ring is not None:
+        vault_store = EnvelopeVaultStore(vault_store, key_ring, rotation_index)
+
+    if cache_size_mb > 0:
+        vault_store = CachedVaultStore(vault_store, max_cache_bytes=cache_size_mb * 1024 * 1024)
+
+    return vault_store
+
+
+def import_json_tree(json_store: JsonVaultStore, vault_store: VaultStore) -> int:
+    # One shot copy of every data/client_addr/user/.passwords.json into another backend
+    imported_users = 0
+
+    for client_addr, user in json_store.users():
+        vault = json_store.load(client_addr, user)
+
+        if vault == {}:
+            continue
+
+        vault_store.save(client_addr, user, vault)
+        imported_users += 1
+
+        logger.info(f"Imported vault for {client_addr}/{user}")
+
+    return imported_users
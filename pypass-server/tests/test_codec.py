@@ -0,0 +1,84 @@
+import base64
+
+import pytest
+
+import codec
+import storage
+
+
+def token(seed: int) -> str:
+    return base64.urlsafe_b64encode(bytes([seed]) * 57).decode()
+
+
+def sample_vault() -> dict:
+    shared_key = "dek:" + token(1)
+
+    return {
+        "mail": {
+            "alice@mail.com": {"password": token(2), "key": shared_key, "last-refresh": "01-02-2026", "version": 3},
+            "bob@mail.com": {"password": token(3), "key": shared_key, "last-refresh": "01-02-2026", "version": 4}
+        },
+        "bank": {
+            "alice": {"password": "short", "key": token(4), "version": -1}
+        },
+        "odd values": {
+            "ünïcode": {
+                "password": "not base64 but long enough!",
+                "list": [1, "two", None],
+                "dict": {"nested": [True]},
+                "none": None,
+                "flag": False,
+                "large": 2 ** 40
+            }
+        }
+    }
+
+
+def test_binary_round_trip():
+    """Every value type survives an encode and decode."""
+    vault = sample_vault()
+    raw_data = codec.encode(vault, "binary")
+
+    assert codec.is_binary(raw_data)
+    assert codec.decode_binary(raw_data) == vault
+    assert codec.decode(raw_data) == vault
+
+
+def test_binary_round_trip_of_empty_vault():
+    """An empty vault is still a valid file."""
+    assert codec.decode_binary(codec.encode({}, "binary")) == {}
+
+
+def test_binary_stores_shared_keys_once():
+    """A key used by several entries appears once in the file."""
+    vault = sample_vault()
+    raw_data = codec.encode(vault, "binary")
+
+    assert raw_data.count(vault["mail"]["alice@mail.com"]["key"].encode()) == 1
+
+
+def test_binary_rejects_other_shapes():
+    """Only vault shaped data can be stored."""
+    with pytest.raises(codec.CodecError):
+        codec.encode({"service": ["not", "a", "dict"]}, "binary")
+
+
+def test_binary_lookups_match_decoded_vault():
+    """Index lookups give what selecting from the decoded vault gives."""
+    vault = sample_vault()
+    binary_vault = codec.BinaryVault(codec.encode(vault, "binary"))
+    selectors = [["mail"], ["bank", "alice"], ["bank", "nobody"], ["missing"]]
+
+    assert binary_vault.select(selectors) == storage.select_entries(vault, selectors)
+    assert binary_vault.listing() == storage.list_entries(vault)
+    assert binary_vault.entry("odd values", "ünïcode") == vault["odd values"]["ünïcode"]
+
+    binary_vault.release()
+
+
+def test_binary_rejects_cut_off_file():
+    """A file without its trailer isn't read as a vault."""
+    raw_data = codec.encode(sample_vault(), "binary")
+
+    with pytest.raises(codec.CodecError):
+        codec.decode_binary(raw_data[:-4])
@@ -0,0 +1,55 @@
+import merkle
+
+DIGEST_KEY = merkle.derive_digest_key(b"main key")
+
+
+def tree(passwords: dict) -> merkle.VaultTree:
+    return merkle.VaultTree.from_passwords(DIGEST_KEY, passwords)
+
+
+def compare(local_tree: merkle.VaultTree, remote_tree: merkle.VaultTree) -> dict:
+    # Walks the trees the way the app walks the server's, one level of nodes per round
+    differences = merkle.empty_differences()
+    requested_paths = [[]]
+
+    while requested_paths != []:
+        next_paths = []
+
+        for path in requested_paths:
+            next_paths += merkle.compare_nodes(local_tree, path, remote_tree.describe(path), differences)
+
+        requested_paths = next_paths
+
+    return {kind: sorted(entries) for kind, entries in differences.items()}
+
+
+def test_equal_trees_have_no_differences():
+    """The same passwords give the same root digest."""
+    passwords = {"mail": {"alice": "one", "bob": "two"}, "bank": {"alice": "three"}}
+
+    assert tree(passwords).digest == tree(passwords).digest
+    assert compare(tree(passwords), tree(passwords)) == merkle.empty_differences()
+
+
+def test_compare_finds_every_kind_of_difference():
+    """Changed, local only and remote only entries are all reported."""
+    local_tree = tree({"mail": {"alice": "one", "bob": "two"}, "bank": {"alice": "three"}})
+    remote_tree = tree({"mail": {"alice": "changed", "carol": "four"}, "shop": {"dave": "five"}})
+
+    assert compare(local_tree, remote_tree) == {
+        "changed": [("mail", "alice")],
+        "local_only": [("bank", "alice"), ("mail", "bob")],
+        "remote_only": [("mail", "carol"), ("shop", "dave")]
+    }
+
+
+def test_removing_a_leaf_restores_the_digest():
+    """Adding and removing an entry leaves the tree as it was."""
+    vault_tree = tree({"mail": {"alice": "one"}})
+    digest = vault_tree.digest
+
+    vault_tree.set_leaf("mail", "bob", merkle.password_digest(DIGEST_KEY, "two"))
+    assert vault_tree.digest != digest
+
+    vault_tree.remove_leaf("mail", "bob")
+    assert vault_tree.digest == digest
@@ -0,0 +1,139 @@
+import socket
+import asyncio
+import secrets
+import threading
+
+import pytest
+import cryptography.exceptions
+
+import protocol
+
+
+def channel_pair(cipher_name: str) -> tuple[protocol.SessionChannel, protocol.SessionChannel]:
+    # The app's end and the server's end of one connection
+    session_key = secrets.token_bytes(32)
+    nonce = secrets.token_bytes(16)
+
+    return (
+        protocol.SessionChannel(session_key, cipher_name, nonce, is_server=False),
+        protocol.SessionChannel(session_key, cipher_name, nonce, is_server=True)
+    )
+
+
+def test_frames_round_trip_over_a_socket():
+    """Frames sent back to back are read one at a time, including ones larger than the socket buffer."""
+    payloads = [b"", b"x", secrets.token_bytes(1024 * 1024)]
+    sender, receiver = socket.socketpair()
+
+    def send_all():
+        for payload in payloads:
+            protocol.send_frame(sender, protocol.DATA, payload)
+
+    sending_thread = threading.Thread(target=send_all)
+    sending_thread.start()
+
+    with sender, receiver:
+        received = [protocol.read_frame(receiver) for _ in payloads]
+        sending_thread.join()
+
+    assert received == [(protocol.DATA, payload) for payload in payloads]
+
+
+def test_streamed_frames_are_read_in_order_by_the_async_reader():
+    """A streamed response, partial frames then the end of the stream, reaches an async reader intact."""
+    frames = [(protocol.SESSION_DATA, b"service %d" % index) for index in range(5)] + [(protocol.END_OF_STREAM, b"")]
+
+    async def read_frames() -> list[tuple[int, bytes]]:
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(protocol.encode_frame(*frame) for frame in frames))
+        reader.feed_eof()
+
+        return [await protocol.read_frame_async(reader) for _ in frames]
+
+    assert asyncio.run(read_frames()) == frames
+
+
+def test_truncated_frame_is_a_connection_error():
+    """A connection closed halfway through a frame isn't mistaken for a shorter message."""
+    async def read_truncated():
+        reader = asyncio.StreamReader()
+        reader.feed_data(protocol.encode_frame(protocol.DATA, b"0123456789")[:-3])
+        reader.feed_eof()
+
+        await protocol.read_frame_async(reader)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(read_truncated())
+
+
+@pytest.mark.parametrize("header", [
+    b"XX" + protocol.encode_frame(protocol.DATA, b"")[2:],
+    protocol.FRAME_HEADER.pack(protocol.MAGIC, protocol.PROTOCOL_VERSION + 1, protocol.DATA, 0),
+    protocol.FRAME_HEADER.pack(protocol.MAGIC, protocol.PROTOCOL_VERSION, 0x7F, 0),
+    protocol.FRAME_HEADER.pack(protocol.MAGIC, protocol.PROTOCOL_VERSION, protocol.DATA, protocol.MAX_FRAME_SIZE + 1)
+])
+def test_invalid_headers_are_rejected(header):
+    """Foreign data, other versions, unknown types and oversized frames are refused before any payload is read."""
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_header(header)
+
+
+def test_session_cipher_is_chosen_in_order_of_preference():
+    """The server picks its most preferred cipher the app offers, and none if there is no common one."""
+    offer, nonce = protocol.session_offer()
+
+    assert protocol.choose_session_cipher(offer) == ("aes-gcm", nonce)
+    assert protocol.choose_session_cipher(b'{"session_ciphers": ["rot13"], "nonce": ""}') == (None, b"")
+
+    with pytest.raises(protocol.ProtocolError):
+        protocol.choose_session_cipher(b"not json")
+
+
+@pytest.mark.parametrize("cipher_name", sorted(protocol.SESSION_CIPHERS.keys()))
+def test_session_channel_round_trips_both_ways(cipher_name):
+    """Each side decrypts what the other sent, in order, and no two frames share a ciphertext."""
+    app_channel, server_channel = channel_pair(cipher_name)
+
+    requests = [app_channel.encrypt(b"same message") for _ in range(3)]
+    responses = [server_channel.encrypt(b"reply %d" % index) for index in range(3)]
+
+    assert len(set(requests)) == 3
+    assert [server_channel.decrypt(request) for request in requests] == [b"same message"] * 3
+    assert [app_channel.decrypt(response) for response in responses] == [b"reply 0", b"reply 1", b"reply 2"]
+
+
+@pytest.mark.parametrize("cipher_name", sorted(protocol.SESSION_CIPHERS.keys()))
+def test_session_channel_rejects_replayed_reordered_and_reflected_frames(cipher_name):
+    """Nonces come from per direction counters, so a frame only decrypts once, in its place, on the other side."""
+    app_channel, server_channel = channel_pair(cipher_name)
+    first, second = app_channel.encrypt(b"first"), app_channel.encrypt(b"second")
+
+    # Reordered: the second frame is read where the first is expected
+    with pytest.raises(cryptography.exceptions.InvalidTag):
+        server_channel.decrypt(second)
+
+    assert server_channel.decrypt(first) == b"first"
+
+    # Replayed: the first frame again, where the second is expected
+    with pytest.raises(cryptography.exceptions.InvalidTag):
+        server_channel.decrypt(first)
+
+    assert server_channel.decrypt(second) == b"second"
+
+    # Reflected: a frame the app sent can't be passed back to the app as if the server had sent it
+    with pytest.raises(cryptography.exceptions.InvalidTag):
+        app_channel.decrypt(app_channel.encrypt(b"echo"))
+
+
+def test_session_channel_rejects_a_tampered_frame():
+    """Changing one byte of a frame makes it fail to decrypt, and the counter doesn't move past it."""
+    app_channel, server_channel = channel_pair("aes-gcm")
+    frame = bytearray(app_channel.encrypt(b"message"))
+    frame[0] ^= 1
+
+    with pytest.raises(cryptography.exceptions.InvalidTag):
+        server_channel.decrypt(bytes(frame))
+
+    frame[0] ^= 1
+
+    assert server_channel.decrypt(bytes(frame)) == b"message"
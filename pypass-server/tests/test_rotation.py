@@ -0,0 +1,126 @@
+import os
+import json
+import threading
+
+import pytest
+
+import envelope
+import rotation
+import storage
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+
+    # A forkserver started by an earlier test would start workers in that test's folder
+    monkeypatch.setattr(rotation, "worker_start_method", lambda: "spawn")
+
+    return request.param
+
+
+def open_store(backend: str) -> tuple[storage.VaultStore, envelope.KeyRing, storage.RotationIndex]:
+    key_ring = envelope.KeyRing()
+    rotation_index = storage.RotationIndex()
+
+    return storage.open_vault_store(backend, 0, key_ring, rotation_index), key_ring, rotation_index
+
+
+def save_vaults(vault_store: storage.VaultStore, users: list[str]):
+    for user in users:
+        vault_store.save("c", user, {"a": {"x": {"password": user, "key": "key of " + user}}})
+
+
+def wrapped_data_key(vault_store: storage.VaultStore, user: str) -> str:
+    return vault_store.load_metadata("c", user)["wrapped_data_key"]
+
+
+def test_checkpoint_skips_a_torn_last_line(tmp_path):
+    """A run interrupted while writing its checkpoint resumes from every line written in full."""
+    checkpoint = rotation.RotationCheckpoint(str(tmp_path / "rotation.checkpoint"))
+    checkpoint.start("3")
+    checkpoint.record({"client_addr": "c", "user": "u1", "status": "rotated", "entries": 2})
+    checkpoint.record({"client_addr": "c", "user": "u2", "status": "failed", "entries": 1})
+    checkpoint.close()
+
+    with open(tmp_path / "rotation.checkpoint", mode="a") as checkpoint_file:
+        checkpoint_file.write('{"client_addr": "c", "user": "u3", "sta')
+
+    resumed_checkpoint = rotation.RotationCheckpoint(str(tmp_path / "rotation.checkpoint"))
+
+    assert resumed_checkpoint.load()
+    assert resumed_checkpoint.header["kek_id"] == "3"
+    assert sorted(resumed_checkpoint.results.keys()) == [("c", "u1"), ("c", "u2")]
+    assert not rotation.RotationCheckpoint(str(tmp_path / "missing")).load()
+
+
+def test_rotation_replaces_data_keys_without_bumping_versions(backend):
+    """Every due vault gets a new data key, its entries still decrypt and clients don't see a new version."""
+    vault_store, key_ring, rotation_index = open_store(backend)
+    save_vaults(vault_store, ["u1", "u2"])
+    old_data_keys = {user: wrapped_data_key(vault_store, user) for user in ("u1", "u2")}
+
+    report = rotation.run_rotation(vault_store, key_ring, rotation_index, backend, max_age_days=0)
+
+    assert report == {"rotated": 2, "skipped": 0, "failed": 0}
+    assert not os.path.exists(rotation.CHECKPOINT_PATH)
+
+    for user in ("u1", "u2"):
+        assert wrapped_data_key(vault_store, user) != old_data_keys[user]
+        assert vault_store.version("c", user) == 1
+        assert vault_store.load("c", user) == {"a": {"x": {"password": user, "key": "key of " + user}}}
+
+
+def test_rotation_resumes_from_its_checkpoint(backend):
+    """A resumed run keeps the KEK it started with, skips finished vaults and retries failed ones."""
+    vault_store, key_ring, rotation_index = open_store(backend)
+    save_vaults(vault_store, ["done", "failed", "pending"])
+    old_data_keys = {user: wrapped_data_key(vault_store, user) for user in ("done", "failed", "pending")}
+
+    # An earlier run rotated to a new KEK, finished one vault and failed another before it was stopped
+    checkpoint = rotation.RotationCheckpoint()
+    checkpoint.start(key_ring.rotate())
+    checkpoint.record({"client_addr": "c", "user": "done", "status": "rotated", "entries": 1})
+    checkpoint.record({"client_addr": "c", "user": "failed", "status": "failed", "entries": 1})
+    checkpoint.close()
+
+    active_kek = key_ring.active_id
+    report = rotation.run_rotation(vault_store, key_ring, rotation_index, backend, max_age_days=0)
+
+    assert report == {"rotated": 3, "skipped": 0, "failed": 0}
+    assert key_ring.active_id == active_kek
+    assert wrapped_data_key(vault_store, "done") == old_data_keys["done"]
+    assert wrapped_data_key(vault_store, "failed") != old_data_keys["failed"]
+    assert wrapped_data_key(vault_store, "pending") != old_data_keys["pending"]
+    assert not os.path.exists(rotation.CHECKPOINT_PATH)
+
+
+def test_stopped_rotation_leaves_its_checkpoint_for_the_next_run(backend):
+    """A run stopped before it finishes keeps its checkpoint, and the next run picks it up and completes it."""
+    vault_store, key_ring, rotation_index = open_store(backend)
+    save_vaults(vault_store, ["u1", "u2"])
+
+    stop_event = threading.Event()
+    stop_event.set()
+
+    report = rotation.run_rotation(vault_store, key_ring, rotation_index, backend, max_age_days=0, stop_event=stop_event)
+
+    assert report == {"rotated": 0, "skipped": 0, "failed": 0}
+
+    with open(rotation.CHECKPOINT_PATH, mode="r") as checkpoint_file:
+        started_kek = json.loads(checkpoint_file.readline())["kek_id"]
+
+    report = rotation.run_rotation(vault_store, key_ring, rotation_index, backend, max_age_days=0)
+
+    assert report == {"rotated": 2, "skipped": 0, "failed": 0}
+    assert key_ring.active_id == started_kek
+    assert not os.path.exists(rotation.CHECKPOINT_PATH)
+
+
+def test_rotation_rejects_a_rate_that_isnt_positive(backend):
+    """A zero rate would never hand out a vault, it is refused up front."""
+    vault_store, key_ring, rotation_index = open_store(backend)
+
+    with pytest.raises(ValueError):
+        rotation.run_rotation(vault_store, key_ring, rotation_index, backend, max_entries_per_second=0)
@@ -0,0 +1,173 @@
+import os
+import json
+import asyncio
+import logging
+
+import pytest
+from cryptography.fernet import Fernet
+
+import main
+import merkle
+import storage
+
+
+class StubWriter:
+    # The only part of the connection the request handlers look at
+    def get_extra_info(self, name: str):
+        return ("127.0.0.1", 0)
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def client(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+
+    monkeypatch.setattr(main, "logger", logging.getLogger("test_server"), raising=False)
+    monkeypatch.setattr(main, "vault_store", storage.open_vault_store(request.param, 0), raising=False)
+
+    client_key = Fernet.generate_key()
+
+    connected_client = main.Client(None, StubWriter())
+    connected_client.client_user = b"user"
+    connected_client.client_fernet = Fernet(client_key)
+    connected_client.digest_key = merkle.derive_digest_key(client_key)
+
+    # Responses the client would have sent, decoded
+    connected_client.responses = []
+
+    async def send_message(data: bytes):
+        connected_client.responses.append(json.loads(data))
+
+    connected_client.send_message = send_message
+
+    return connected_client
+
+
+def send(client: main.Client, op: str, mode: str | None = None, payload=None, expected_version: int | None = None) -> dict:
+    client.responses.clear()
+
+    asyncio.run(client.dispatch({
+        "op": op, "mode": mode, "payload": payload, "id": 1, "expected_version": expected_version, "legacy": False
+    }))
+
+    return client.responses[-1]
+
+
+def operation(op: str, service: str, username: str, password: str = "") -> dict:
+    return {"op": op, "service": service, "username": username, "password": password, "key": Fernet.generate_key().decode()}
+
+
+def passwords(client: main.Client) -> dict:
+    response = send(client, "download")
+
+    if response["status"] == "error":
+        return {}
+
+    return {
+        service: {username: entry["password"] for username, entry in usernames.items()}
+        for service, usernames in response["payload"].items()
+    }
+
+
+def test_failed_batch_leaves_the_vault_untouched(client):
+    """One bad operation rolls back the whole batch, and every operation's result is reported."""
+    send(client, "batch", payload={"operations": [operation("add", "mail", "me", "1")]})
+
+    response = send(client, "batch", payload={"operations": [
+        operation("edit", "mail", "me", "2"),
+        operation("add", "mail", "me", "3"),
+        operation("delete", "bank", "me")
+    ]})
+
+    assert response["status"] == "ok"
+    assert response["payload"]["committed"] is False
+    assert response["payload"]["version"] is None
+    assert [result["status"] for result in response["payload"]["results"]] == ["ok", "error", "ok"]
+    assert passwords(client) == {"mail": {"me": "1"}}
+    assert main.vault_store.version("127.0.0.1", "user") == 1
+
+
+def test_committed_batch_saves_one_version(client):
+    """Every operation of a batch that succeeds is saved together, as one new vault version."""
+    response = send(client, "batch", payload={"operations": [
+        operation("add", "mail", "me", "1"),
+        operation("add", "bank", "me", "2"),
+        operation("upsert", "bank", "you", "3")
+    ]})
+
+    assert response["payload"]["committed"] is True
+    assert response["payload"]["version"] == 1
+    assert passwords(client) == {"mail": {"me": "1"}, "bank": {"me": "2", "you": "3"}}
+
+
+def test_delta_update_only_touches_the_entries_it_names(client):
+    """A DELTA upserts and deletes single entries and leaves the rest of the vault as it was."""
+    send(client, "update", "DELTA", {"operations": [
+        operation("upsert", "mail", "me", "1"),
+        operation("upsert", "bank", "me", "2"),
+        operation("upsert", "bank", "you", "3")
+    ]})
+
+    response = send(client, "update", "DELTA", {"operations": [
+        operation("upsert", "mail", "me", "changed"),
+        operation("delete", "bank", "you"),
+        operation("delete", "shop", "nobody")
+    ]})
+
+    assert response == {"id": 1, "status": "ok", "payload": {"version": 2}}
+    assert passwords(client) == {"mail": {"me": "changed"}, "bank": {"me": "2"}}
+
+
+def test_delta_update_keeps_the_hash_tree_in_step(client):
+    """The saved hash tree matches one built from the passwords the vault holds after a DELTA."""
+    send(client, "update", "DELTA", {"operations": [
+        operation("upsert", "mail", "me", "1"),
+        operation("upsert", "bank", "me", "2")
+    ]})
+    send(client, "update", "DELTA", {"operations": [operation("delete", "bank", "me")]})
+
+    saved_tree = merkle.VaultTree(main.vault_store.load_tree("127.0.0.1", "user"))
+
+    assert saved_tree.to_dict() == merkle.VaultTree.from_passwords(client.digest_key, {"mail": {"me": "1"}}).to_dict()
+
+
+def test_unknown_delta_operation_is_refused(client):
+    """A DELTA with an operation it doesn't know fails without saving any of its other operations."""
+    response = send(client, "update", "DELTA", {"operations": [
+        operation("upsert", "mail", "me", "1"),
+        operation("add", "bank", "me", "2")
+    ]})
+
+    assert response["status"] == "error"
+    assert passwords(client) == {}
+
+
+@pytest.mark.parametrize("op, mode", [("update", "DELTA"), ("batch", None)])
+def test_stale_write_is_a_retryable_conflict(client, op, mode):
+    """A write based on an older version is refused with the current version, and nothing is saved."""
+    send(client, "update", "DELTA", {"operations": [operation("upsert", "mail", "me", "1")]})
+    send(client, "update", "DELTA", {"operations": [operation("upsert", "mail", "me", "2")]})
+
+    response = send(client, op, mode, {"operations": [operation("upsert", "mail", "me", "stale")]}, expected_version=1)
+
+    assert response["status"] == "error"
+    assert response["code"] == "conflict"
+    assert response["retryable"] is True
+    assert response["version"] == 2
+    assert passwords(client) == {"mail": {"me": "2"}}
+
+    response = send(client, op, mode, {"operations": [operation("upsert", "mail", "me", "3")]}, expected_version=2)
+
+    assert response["status"] == "ok"
+    assert passwords(client) == {"mail": {"me": "3"}}
+
+
+def test_first_write_expects_version_zero(client):
+    """A vault that was never saved is at version 0, so a client can create it only if nobody else did first."""
+    first = send(client, "update", "DELTA", {"operations": [operation("upsert", "mail", "me", "1")]}, expected_version=0)
+    second = send(client, "update", "DELTA", {"operations": [operation("upsert", "mail", "me", "2")]}, expected_version=0)
+
+    assert first["status"] == "ok"
+    assert second["status"] == "error"
+    assert second["code"] == "conflict"
+    assert passwords(client) == {"mail": {"me": "1"}}
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+import storage
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+
+    return request.param
+
+
+def entry(password: str) -> dict:
+    return {"password": password, "key": "key"}
+
+
+def test_cache_serves_hits_without_sharing_its_copy(backend):
+    """A cached vault is served again until it changes, and callers can't mutate the cached copy."""
+    cached_store = storage.CachedVaultStore(storage.STORAGE_BACKENDS[backend]())
+    cached_store.save("c", "u", {"a": {"x": entry("1")}})
+
+    loaded_vault = cached_store.load("c", "u")
+    loaded_vault["a"]["x"]["password"] = "changed by the caller"
+
+    assert cached_store.load("c", "u") == {"a": {"x": entry("1")}}
+    assert cached_store.stats()["hits"] == 2
+    assert cached_store.stats()["misses"] == 0
+
+
+def test_cache_reloads_a_vault_another_process_saved(backend):
+    """Each worker process has its own cache, a save made through another one invalidates the cached vault."""
+    worker_store = storage.CachedVaultStore(storage.STORAGE_BACKENDS[backend]())
+    other_worker_store = storage.CachedVaultStore(storage.STORAGE_BACKENDS[backend]())
+
+    worker_store.save("c", "u", {"a": {"x": entry("1")}})
+    assert worker_store.load("c", "u") == {"a": {"x": entry("1")}}
+
+    other_worker_store.save("c", "u", {"a": {"x": entry("2")}})
+
+    assert worker_store.load("c", "u") == {"a": {"x": entry("2")}}
+    assert worker_store.stats()["invalidations"] == 1
+
+
+def test_cache_evicts_least_recently_used_vaults():
+    """The cache stays under its size limit by dropping the vaults loaded longest ago."""
+    cached_store = storage.CachedVaultStore(storage.VaultStore(), max_cache_bytes=3000)
+
+    for user in ("u1", "u2", "u3"):
+        cached_store.remember(("c", user), 1, {"a": {"x": entry(user * 200)}})
+
+    assert list(cached_store.cached_vaults.keys()) == [("c", "u2"), ("c", "u3")]
+    assert cached_store.stats()["evictions"] == 1
+
+
+def test_layout_migration_round_trip(tmp_path, monkeypatch):
+    """Vaults keep their data, versions and trees through a migration to the hashed layout and back."""
+    monkeypatch.chdir(tmp_path)
+
+    flat_store = storage.JsonVaultStore()
+    vaults = {(f"10.0.0.{index}", f"user{index}"): {"a": {"x": entry(str(index))}} for index in range(5)}
+
+    for (client_addr, user), vault in vaults.items():
+        flat_store.save(client_addr, user, vault)
+        flat_store.save_tree(client_addr, user, {"tree": user})
+
+    flat_store.close()
+
+    assert storage.migrate_layout(storage.DataLayout.load(), storage.DataLayout(scheme="hashed")) == 5
+    assert not any(os.path.exists(os.path.join("data", client_addr)) for client_addr, _ in vaults.keys())
+
+    hashed_store = storage.JsonVaultStore()
+
+    assert hashed_store.layout.scheme == "hashed"
+    assert sorted(hashed_store.users()) == sorted(vaults.keys())
+
+    for (client_addr, user), vault in vaults.items():
+        assert hashed_store.vault_folder(client_addr, user) != os.path.join("data", client_addr, user)
+        assert hashed_store.load(client_addr, user) == vault
+        assert hashed_store.version(client_addr, user) == 1
+        assert hashed_store.load_tree(client_addr, user) == {"tree": user}
+
+    hashed_store.close()
+
+    assert storage.migrate_layout(storage.DataLayout.load(), storage.DataLayout(scheme="flat")) == 5
+
+    flat_store = storage.JsonVaultStore()
+
+    assert sorted(flat_store.users()) == sorted(vaults.keys())
+    assert all(flat_store.load(client_addr, user) == vault for (client_addr, user), vault in vaults.items())
+
+
+def test_interrupted_layout_migration_can_be_run_again(tmp_path, monkeypatch):
+    """Running a migration again after it stopped halfway moves the remaining folders and loses nothing."""
+    monkeypatch.chdir(tmp_path)
+
+    flat_store = storage.JsonVaultStore()
+    flat_store.save("c", "moved", {"a": {"x": entry("1")}})
+    flat_store.save("c", "left", {"a": {"x": entry("2")}})
+    flat_store.close()
+
+    # Stopped after the first folder was moved, before the new layout was saved
+    hashed_layout = storage.DataLayout(scheme="hashed")
+    os.makedirs(os.path.dirname(hashed_layout.vault_folder("c", "moved")))
+    os.rename(os.path.join("data", "c", "moved"), hashed_layout.vault_folder("c", "moved"))
+    hashed_layout.register("c", "moved")
+    hashed_layout.close()
+
+    assert storage.migrate_layout(storage.DataLayout.load(), storage.DataLayout(scheme="hashed")) == 1
+
+    hashed_store = storage.JsonVaultStore()
+
+    assert hashed_store.load("c", "moved") == {"a": {"x": entry("1")}}
+    assert hashed_store.load("c", "left") == {"a": {"x": entry("2")}}
+    assert not os.path.exists(os.path.join("data", "c"))
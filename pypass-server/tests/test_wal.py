@@ -0,0 +1,112 @@
+import os
+import shutil
+
+import pytest
+
+import wal
+import storage
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+
+    return request.param
+
+
+def open_store(backend: str) -> storage.WalVaultStore:
+    return storage.WalVaultStore(storage.STORAGE_BACKENDS[backend](), wal.WriteAheadLog(checkpoint_bytes=1 << 30))
+
+
+def crash(wal_store: storage.WalVaultStore, snapshot: str):
+    # Puts every backend file back as it was at the snapshot, leaving the write-ahead logs
+    wal_store.write_ahead_log.close()
+    wal_store.vault_store.close()
+
+    for name in os.listdir("data"):
+        if name != "wal":
+            path = os.path.join("data", name)
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+    shutil.copytree(snapshot, "data", dirs_exist_ok=True)
+
+
+def entry(password: str) -> dict:
+    return {"password": password, "key": "key"}
+
+
+def test_recover_replays_lost_saves(backend):
+    """Saves that only reached the log are replayed onto the backend."""
+    wal_store = open_store(backend)
+    wal_store.save("c", "u", {"a": {"x": entry("1")}})
+    wal_store.checkpoint()
+    shutil.copytree("data", "snapshot", ignore=shutil.ignore_patterns("wal"))
+
+    wal_store.save("c", "u", {"a": {"x": entry("2")}, "b": {"y": entry("3")}})
+    wal_store.save("c", "u", {"b": {"y": entry("4")}})
+    crash(wal_store, "snapshot")
+
+    recovered_store = open_store(backend)
+
+    assert recovered_store.version("c", "u") == 1
+    assert recovered_store.recover() == 2
+    assert recovered_store.version("c", "u") == 3
+    assert recovered_store.load("c", "u") == {"b": {"y": entry("4")}}
+    assert os.listdir(os.path.join("data", "wal")) == []
+
+
+def test_recover_skips_saves_already_on_disk(backend):
+    """Replaying a log whose saves all reached the backend changes nothing."""
+    wal_store = open_store(backend)
+    wal_store.save("c", "u", {"a": {"x": entry("1")}})
+    wal_store.save("c", "u", {"a": {"x": entry("2")}})
+    wal_store.write_ahead_log.close()
+
+    recovered_store = open_store(backend)
+
+    assert recovered_store.recover() == 0
+    assert recovered_store.version("c", "u") == 2
+    assert recovered_store.load("c", "u") == {"a": {"x": entry("2")}}
+
+
+def test_recover_restores_current_tree_and_drops_stale_one(backend):
+    """A tree logged at the vault's version is restored, an older one is deleted."""
+    wal_store = open_store(backend)
+    wal_store.save("c", "u", {"a": {"x": entry("1")}})
+    wal_store.save_tree("c", "u", {"tree": 1})
+    wal_store.save("c", "v", {"a": {"x": entry("1")}})
+    wal_store.save_tree("c", "v", {"tree": 1})
+    wal_store.checkpoint()
+    shutil.copytree("data", "snapshot", ignore=shutil.ignore_patterns("wal"))
+
+    # u crashes between its save and its tree save, v after both
+    wal_store.save("c", "u", {"a": {"x": entry("2")}})
+    wal_store.save("c", "v", {"a": {"x": entry("2")}})
+    wal_store.save_tree("c", "v", {"tree": 2})
+    crash(wal_store, "snapshot")
+
+    recovered_store = open_store(backend)
+    recovered_store.recover()
+
+    assert recovered_store.load_tree("c", "u") is None
+    assert recovered_store.load_tree("c", "v") == {"tree": 2}
+
+
+def test_recover_skips_torn_record(backend):
+    """A record cut off by a crash is ignored, the ones before it are replayed."""
+    wal_store = open_store(backend)
+    wal_store.checkpoint()
+    shutil.copytree("data", "snapshot", ignore=shutil.ignore_patterns("wal"))
+
+    wal_store.save("c", "u", {"a": {"x": entry("1")}})
+    log_path = wal_store.write_ahead_log.log_path()
+    crash(wal_store, "snapshot")
+
+    with open(log_path, mode="ab") as log_file:
+        log_file.write(b'{"client_addr": "c", "user": "u", "vers')
+
+    recovered_store = open_store(backend)
+
+    assert recovered_store.recover() == 1
+    assert recovered_store.load("c", "u") == {"a": {"x": entry("1")}}
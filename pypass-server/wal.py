@@ -0,0 +1,150 @@
+# Write-ahead log of vault saves
+
+# With --wal, a vault save first appends one json line to the log of the process doing the save and fsyncs it.
+# Only then is the storage backend written, without waiting for the disk. A line only holds what the save changed:
+# {"client_addr": ..., "user": ..., "version": version the save produced,
+#  "set": {service: {username: stored entry}}, "delete": [[service, username], ...]}
+# Hash trees are logged whole, as {"client_addr": ..., "user": ..., "version": vault version, "tree": tree}
+
+# Each process appends to its own data/wal/<pid>.log. Saves made by several threads while one fsync is running are
+# covered by the next fsync together. Once a log grows past its checkpoint size the backend's files are flushed to
+# disk and the log is emptied. A log left behind by a crash is replayed onto the backend at start up, see
+# storage.WalVaultStore.recover
+
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+LOG_FOLDER = os.path.join("data", "wal")
+
+
+class WriteAheadLog:
+    def __init__(self, log_folder: str = LOG_FOLDER, checkpoint_bytes: int = 16 * 1024 * 1024):
+        self.log_folder = log_folder
+        self.checkpoint_bytes = checkpoint_bytes
+
+        # Lock order is sync_lock, then append_lock
+        self.append_lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+        self.log_file = None
+        self.log_pid = None
+        self.appended = 0
+        self.synced = 0
+        self.fsyncs = 0
+
+    def log_path(self) -> str:
+        return os.path.join(self.log_folder, f"{os.getpid()}.log")
+
+    def open_log(self):
+        # A forked worker process gets a log of its own instead of sharing its parent's file
+        if self.log_pid != os.getpid():
+            os.makedirs(self.log_folder, exist_ok=True)
+
+            self.log_file = open(self.log_path(), mode="ab")
+            self.log_pid = os.getpid()
+            self.appended = 0
+            self.synced = 0
+
+        return self.log_file
+
+    def append(self, record: dict):
+        # Returns once the record is on disk
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+        with self.append_lock:
+            log_file = self.open_log()
+            log_file.write(line)
+            log_file.flush()
+
+            self.appended += 1
+            sequence = self.appended
+
+        with self.sync_lock:
+            if self.synced >= sequence:
+                # Another thread's fsync already covered this record
+                return
+
+            with self.append_lock:
+                appended = self.appended
+
+            os.fsync(log_file.fileno())
+
+            self.synced = appended
+            self.fsyncs += 1
+
+    def size(self) -> int:
+        if self.log_pid != os.getpid():
+            return 0
+
+        with self.append_lock:
+            return self.log_file.tell()
+
+    def checkpoint(self):
+        # The caller makes sure no save is between its append and its backend write, and has flushed the backend
+        with self.sync_lock, self.append_lock:
+            if self.log_pid != os.getpid():
+                return
+
+            self.log_file.truncate(0)
+            self.log_file.seek(0)
+            os.fsync(self.log_file.fileno())
+
+            self.synced = self.appended
+
+        logger.info(f"Checkpointed write-ahead log {self.log_path()}")
+
+    def read_all(self) -> list[dict]:
+        # Every record in every process's log, in the order each process appended them
+        records = []
+
+        if not os.path.isdir(self.log_folder):
+            return records
+
+        for log_name in sorted(os.listdir(self.log_folder)):
+            if not log_name.endswith(".log"):
+                continue
+
+            with open(os.path.join(self.log_folder, log_name), mode="rb") as log_file:
+                for line in log_file:
+                    try:
+                        records.append(json.loads(line))
+
+                    except json.JSONDecodeError:
+                        # Only the last line of a log can be cut off by a crash, and its save never reached the
+                        # backend
+                        logger.warning(f"Skipping a torn record at the end of {log_name}")
+
+        return records
+
+    def remove_all(self):
+        # Called once everything the logs held is on disk
+        with self.sync_lock, self.append_lock:
+            if self.log_file is not None:
+                self.log_file.close()
+
+            self.log_file = None
+            self.log_pid = None
+
+            if not os.path.isdir(self.log_folder):
+                return
+
+            for log_name in os.listdir(self.log_folder):
+                if log_name.endswith(".log"):
+                    os.remove(os.path.join(self.log_folder, log_name))
+
+    def close(self):
+        # An empty log has nothing left to replay and is removed, so short lived processes don't leave theirs behind
+        with self.sync_lock, self.append_lock:
+            if self.log_file is not None and self.log_pid == os.getpid():
+                empty = self.log_file.tell() == 0
+                self.log_file.close()
+
+                if empty:
+                    os.remove(self.log_path())
+
+            self.log_file = None
+            self.log_pid = None
@@ -6,7 +6,8 @@ import httpx
 
 # /
 #   username
-#       .passwords.json
+#       .passwords.json (encoded with codec.py, older versions wrote plain indented json)
+#       .tree.json (hash tree over the saved passwords, see merkle.py)
 
 # .passwords.json layout
 # {
@@ -20,10 +21,17 @@ import httpx
 #       service name: {
 #           username of service: {
 #               "password": the encrypted password,
-#               "key": the encryption key
+#               "key": the encryption key,
+#               "version": value of "version" when the password was last changed
 #           }
 #       }
 #   }
+#   "version": counter bumped on every change to "data"
+#   "deleted": {
+#       service name: {
+#           username of service: value of "version" when the username was deleted
+#       }
+#   }
 # }
 
 # TODO: Add way to determine whether or not device is sending data, or receiving data for data migration
@@ -38,6 +46,7 @@ from toga.style import Pack
 # App related imports
 import json
 import random
+import shutil
 import os.path
 import asyncio
 import secrets
@@ -50,6 +59,10 @@ from cryptography.fernet import Fernet
 
 # Data migration imports
 import socket
+from pypass import merkle
+from pypass import protocol
+from pypass import persistence
+from pypass import codec
 
 from pprint import pprint as print
 
@@ -117,6 +130,11 @@ class PyPass(toga.App):
         self.logged_in_user = None
         self.server_key = None
         self.server = None
+        self.session_channel: protocol.SessionChannel | None = None
+        self.request_id = 0
+
+        # How many times an upload is merged and sent again when another device writes to the vault meanwhile
+        self.conflict_retries = 3
 
         self.backup_words = {
             "A": [
@@ -2639,8 +2657,7 @@ class PyPass(toga.App):
             user_data = self.load_user_passwords(check_data_integrity=False)
             user_data["key"] = self.main_fernet.encrypt(recovered_key.encode()).decode()
 
-            with open(password_file_path, mode="w") as passwords_file:
-                json.dump(user_data, passwords_file, indent=4)
+            persistence.write_file(password_file_path, codec.encode(user_data))
 
             dialog = toga.InfoDialog(
                 title=self.success_title,
@@ -2825,14 +2842,8 @@ class PyPass(toga.App):
                     if os.path.isdir(user_folder):
                         user_path = os.path.join(self.paths.data, user_folder)
 
-                        os.unlink(
-                            os.path.join(
-                                user_path,
-                                ".passwords.json"
-                            )
-                        )
-
-                        os.rmdir(user_path)
+                        # The folder also holds the hash tree, .tree.json
+                        shutil.rmtree(user_path)
 
         print(main_key)
 
@@ -3024,8 +3035,7 @@ class PyPass(toga.App):
 
         os.mkdir(username_path)
 
-        with open(self.data_file_path, mode="w") as data_file:
-            json.dump(user_data, data_file, indent=4)
+        persistence.write_file(self.data_file_path, codec.encode(user_data))
 
         dialog = toga.InfoDialog(
             title=self.success_title,
@@ -3085,15 +3095,8 @@ class PyPass(toga.App):
         if not confirm_result:
             return None
 
-        os.unlink(
-            os.path.join(
-                self.paths.data,
-                user,
-                ".passwords.json"
-            )
-        )
-
-        os.rmdir(
+        # Removes the hash tree, .tree.json, along with the passwords
+        shutil.rmtree(
             os.path.join(
                 self.paths.data,
                 user
@@ -3148,18 +3151,27 @@ class PyPass(toga.App):
             user_data["data"][service] = {
                 username: {
                     "password": cipher.encrypt(password.encode()).decode(),
-                    "key": self.main_fernet.encrypt(password_key).decode()
+                    "key": self.main_fernet.encrypt(password_key).decode(),
+                    "version": self.next_data_version(user_data)
                 }
             }
 
         elif username not in user_data["data"][service].keys():
             user_data["data"][service][username] = {
                 "password": cipher.encrypt(password.encode()).decode(),
-                "key": self.main_fernet.encrypt(password_key).decode()
+                "key": self.main_fernet.encrypt(password_key).decode(),
+                "version": self.next_data_version(user_data)
             }
 
-        with open(self.data_file_path, mode="w") as data_file:
-            json.dump(user_data, data_file, indent=4)
+        # The username was added back, so it no longer needs to be deleted on the server
+        user_data.get("deleted", {}).get(service, {}).pop(username, None)
+
+        vault_tree = self.load_vault_tree(user_data)
+        vault_tree.set_leaf(service, username, merkle.password_digest(self.get_digest_key(), password))
+
+        persistence.write_file(self.data_file_path, codec.encode(user_data))
+
+        self.save_vault_tree(vault_tree)
 
         self.copy_to_clipboard(password)
 
@@ -3220,11 +3232,16 @@ class PyPass(toga.App):
 
         user_data["data"][service][username]["key"] = self.main_fernet.encrypt(new_key).decode()
         user_data["data"][service][username]["password"] = cipher.encrypt(new_password.encode()).decode()
+        user_data["data"][service][username]["version"] = self.next_data_version(user_data)
+
+        vault_tree = self.load_vault_tree(user_data)
+        vault_tree.set_leaf(service, username, merkle.password_digest(self.get_digest_key(), new_password))
 
-        with open(self.data_file_path, mode="w") as data_file:
-            json.dump(user_data, data_file, indent=4)
+        persistence.write_file(self.data_file_path, codec.encode(user_data))
 
-            self.copy_to_clipboard(new_password)
+        self.copy_to_clipboard(new_password)
+
+        self.save_vault_tree(vault_tree)
 
         dialog = toga.InfoDialog(
             title=self.success_title,
@@ -3322,8 +3339,15 @@ class PyPass(toga.App):
 
         del user_data["data"][service][username]
 
-        with open(self.data_file_path, mode="w") as data_file:
-            json.dump(user_data, data_file, indent=4)
+        # Remember the deletion so the next delta upload deletes the username on the server too
+        user_data.setdefault("deleted", {}).setdefault(service, {})[username] = self.next_data_version(user_data)
+
+        vault_tree = self.load_vault_tree(user_data)
+        vault_tree.remove_leaf(service, username)
+
+        persistence.write_file(self.data_file_path, codec.encode(user_data))
+
+        self.save_vault_tree(vault_tree)
 
         dialog = toga.InfoDialog(
             title=self.success_title,
@@ -3500,17 +3524,22 @@ class PyPass(toga.App):
         if not os.path.exists(password_file_path):
             return {}
 
-        user_data = json_repair.from_file(password_file_path)
+        # Reads files written before codecs existed too, repairing them with json_repair if they are damaged
+        with open(password_file_path, mode="rb") as data_file:
+            raw_data = data_file.read()
+
+        user_data = codec.decode(raw_data)
 
         if user_data == "" and check_data_integrity == True:
             recovered_data = {}
 
-            with open(password_file_path, mode="r") as data_file:
-                user_data_list = data_file.readlines()
-                print(user_data_list)
+            # Only legacy json files come back empty, scrape the same bytes the codec read as text. An empty or cut
+            # off file has no user lines to find
+            user_data_list = raw_data.decode(errors="replace").splitlines(keepends=True)
+            print(user_data_list)
 
             print("Looking for User")
-            if f'"{username}":' in user_data_list[1] and '"key":' in user_data_list[2]:
+            if len(user_data_list) > 2 and f'"{username}":' in user_data_list[1] and '"key":' in user_data_list[2]:
                 print("Found User")
                 new_key = Fernet.generate_key()
                 cipher = Fernet(new_key)
@@ -3604,8 +3633,7 @@ class PyPass(toga.App):
                                 "key": recovered_key
                             }
 
-                with open(password_file_path, mode="w") as data_file:
-                    json.dump(recovered_data, data_file, indent=4)
+                persistence.write_file(password_file_path, codec.encode(recovered_data))
 
             return recovered_data
 
@@ -3869,8 +3897,7 @@ class PyPass(toga.App):
             "server_port": server_port
         }
 
-        with open(user_data_path, mode="w") as data_file:
-            json.dump(user_data, data_file, indent=4)
+        persistence.write_file(user_data_path, codec.encode(user_data))
 
         dialog = toga.InfoDialog(
             title=self.success_title,
@@ -3914,8 +3941,7 @@ class PyPass(toga.App):
             "server_port": server_port
         }
 
-        with open(data_path, mode="w") as data_file:
-            json.dump(user_data, data_file, indent=4)
+        persistence.write_file(data_path, codec.encode(user_data))
 
         dialog = toga.InfoDialog(
             title=self.success_title,
@@ -3950,8 +3976,7 @@ class PyPass(toga.App):
 
         del user_data["servers"][server_title]
 
-        with open(data_path, mode="w") as data_file:
-            json.dump(user_data, data_file, indent=4)
+        persistence.write_file(data_path, codec.encode(user_data))
 
         dialog = toga.InfoDialog(
             title=self.success_title,
@@ -4000,51 +4025,35 @@ class PyPass(toga.App):
             await self.dialog(dialog)
             return self.return_to_home_screen()
 
-        try:
-            for_server = {}
-            server_cipher = Fernet(self.server_key)
-
-        except ValueError:
-            dialog = toga.ErrorDialog(
-                title=self.error_title,
-                message="The server sent an invalid key. Please restart the app, and try again"
-            )
+        if user_data["servers"][server_title].get("synced_version") is not None:
+            # The server already has everything up to synced_version, only send what changed since then
+            return await self.upload_changes(user_data, server_title)
 
-            await self.dialog(dialog)
-            return self.return_to_home_screen()
+        # Compare hash trees first, there is nothing to send if the server already has the same passwords. The
+        # version is read before the trees are compared, so a write in between only makes it older than the trees
+        server_version = (await self.send_request("list"))["payload"]["version"]
+        differences = await self.find_server_differences(self.load_vault_tree(user_data))
 
-        for service in user_data["data"].keys():
-            for username in user_data["data"][service].keys():
-                encrypted_password = user_data["data"][service][username]["password"]
-                encryption_key = user_data["data"][service][username]["key"]
-                print(encryption_key)
-                cipher = Fernet(self.main_fernet.decrypt(encryption_key))
-
-                if service not in for_server.keys():
-                    for_server[service] = {
-                        username: {
-                            "password": cipher.decrypt(encrypted_password).decode(),
-                            "key": self.server_key.decode()
-                        }
-                    }
+        if differences == merkle.empty_differences():
+            user_data["servers"][server_title]["synced_version"] = user_data.get("version", 0)
+            user_data["servers"][server_title]["server_version"] = server_version
+            self.prune_deleted(user_data)
 
-                else:
-                    for_server[service][username] = {
-                        "password": cipher.decrypt(encrypted_password).decode(),
-                        "key": self.server_key.decode()
-                    }
+            persistence.write_file(self.data_file_path, codec.encode(user_data))
 
-        encrypted_for_server_string: bytes = server_cipher.encrypt(
-            self.main_fernet.encrypt(
-                json.dumps(for_server).encode()
+            dialog = toga.InfoDialog(
+                title=self.success_title,
+                message=f"The server titled {server_title} already has all your passwords"
             )
-        )
 
-        print(f"Encrypted string is: {encrypted_for_server_string}")
-        await asyncio.to_thread(self.server.sendall, encrypted_for_server_string)
-        print("Sent data")
+            await self.dialog(dialog)
+
+            await asyncio.to_thread(self.server.close)
+            self.server = None
 
-        await asyncio.to_thread(self.server.sendall, b"DONE")
+            return self.return_to_home_screen()
+
+        print(f"Found {sum(len(entries) for entries in differences.values())} differences with the server")
 
         confirm_dialog = toga.QuestionDialog(
             title=self.confirm_title,
@@ -4055,34 +4064,185 @@ class PyPass(toga.App):
 
         print(f"Update recursively is: {update_recursively}")
 
-        if update_recursively:
-            await asyncio.to_thread(self.server.sendall, server_cipher.encrypt(self.main_fernet.encrypt(b"RECURSIVE")))
-            print("Sent recursive command to server")
+        # Only the entries that differ are sent. A recursive update keeps what only the server has, a replace
+        # deletes it
+        operations = [
+            self.upsert_operation(service, username, user_data["data"][service][username])
+            for service, username in differences["changed"] + differences["local_only"]
+        ]
+
+        if not update_recursively:
+            operations += [
+                {"op": "delete", "service": service, "username": username}
+                for service, username in differences["remote_only"]
+            ]
+
+        response, operations, merged = await self.send_operations(user_data, operations, server_version)
+        print("Sent data")
+
+        if response["status"] == "ok":
+            if not update_recursively:
+                # The server now holds exactly the local data, so later uploads can be sent as deltas
+                user_data["servers"][server_title]["synced_version"] = user_data.get("version", 0)
+                user_data["servers"][server_title]["server_version"] = response["payload"]["version"]
+                self.prune_deleted(user_data)
+
+                persistence.write_file(self.data_file_path, codec.encode(user_data))
+
+            message = "Successfully updated data"
+
+            if merged:
+                message += ". Another device changed the passwords on the server too, its changes were kept"
+
+            dialog = toga.InfoDialog(
+                title=self.success_title,
+                message=message
+            )
+
+            await self.dialog(dialog)
 
         else:
-            await asyncio.to_thread(self.server.sendall, server_cipher.encrypt(self.main_fernet.encrypt(b"REPLACE")))
+            print(response["error"])
 
-        self.server.sendall(server_cipher.encrypt(self.main_fernet.encrypt(b"DONE")))
-        print("Sent done message to server")
+        await asyncio.to_thread(self.server.close)
+        self.server = None
 
-        message_from_server = await asyncio.to_thread(self.server.recv, 1024)
+        return self.return_to_home_screen()
 
-        if message_from_server.decode() == "Successfully updated data":
+    def upsert_operation(self, service: str, username: str, entry: dict) -> dict:
+        cipher = Fernet(self.main_fernet.decrypt(entry["key"]))
+
+        return {
+            "op": "upsert",
+            "service": service,
+            "username": username,
+            "password": cipher.decrypt(entry["password"]).decode(),
+            "key": self.server_key.decode()
+        }
+
+    def local_changes(self, user_data: dict, synced_version: int) -> list[dict]:
+        # Upsert and delete operations for every entry changed here since synced_version
+        operations = []
+
+        for service in user_data["data"].keys():
+            for username, entry in user_data["data"][service].items():
+                if entry.get("version", 0) > synced_version:
+                    operations.append(self.upsert_operation(service, username, entry))
+
+        for service in user_data.get("deleted", {}).keys():
+            for username, deleted_version in user_data["deleted"][service].items():
+                if deleted_version > synced_version:
+                    operations.append({
+                        "op": "delete",
+                        "service": service,
+                        "username": username
+                    })
+
+        return operations
+
+    async def upload_changes(self, user_data: dict, server_title: str):
+        synced_version = user_data["servers"][server_title]["synced_version"]
+        operations = self.local_changes(user_data, synced_version)
+
+        if operations == []:
             dialog = toga.InfoDialog(
                 title=self.success_title,
-                message="Successfully updated data"
+                message="Nothing has changed since the last upload"
             )
 
             await self.dialog(dialog)
+            return self.return_to_home_screen()
+
+        response, operations, merged = await self.send_operations(
+            user_data,
+            operations,
+            user_data["servers"][server_title].get("server_version")
+        )
+
+        if response["status"] == "ok":
+            user_data["servers"][server_title]["synced_version"] = user_data.get("version", 0)
+            user_data["servers"][server_title]["server_version"] = response["payload"]["version"]
+            self.prune_deleted(user_data)
+
+            persistence.write_file(self.data_file_path, codec.encode(user_data))
+
+            message = f"Successfully uploaded {len(operations)} change(s)"
+
+            if merged:
+                message += ". Another device changed the passwords on the server too, its changes were kept"
+
+            dialog = toga.InfoDialog(
+                title=self.success_title,
+                message=message
+            )
+
+        elif response.get("code") == "conflict":
+            dialog = toga.ErrorDialog(
+                title=self.error_title,
+                message="The passwords on the server kept changing during the upload. Nothing was lost, please "
+                        "upload again"
+            )
 
         else:
-            print(message_from_server)
+            dialog = toga.ErrorDialog(
+                title=self.error_title,
+                message=f"Failed to upload changes. Reason: {response['error']}"
+            )
+
+        await self.dialog(dialog)
 
         await asyncio.to_thread(self.server.close)
         self.server = None
 
         return self.return_to_home_screen()
 
+    async def send_operations(
+            self,
+            user_data: dict,
+            operations: list[dict],
+            expected_version: int | None
+    ) -> tuple[dict, list[dict], bool]:
+        # Sends the operations as one delta on top of expected_version. Returns the final response, the operations
+        # that were sent in the end and whether they were merged with another device's changes
+        merged = False
+
+        for _ in range(self.conflict_retries):
+            if operations == []:
+                break
+
+            response = await self.send_request(
+                "update",
+                "DELTA",
+                {"operations": operations},
+                expected_version=expected_version
+            )
+            print(f"Sent {len(operations)} changes to server")
+
+            if response.get("code") != "conflict":
+                return response, operations, merged
+
+            # Another device wrote to the vault since this one last synced, nothing was applied. The local changes
+            # are sent again on top of the server's version, leaving out the ones the server already has, so the
+            # other device's changes are kept and no local change is lost
+            expected_version = response["version"]
+            merged = True
+
+            differences = await self.find_server_differences(self.load_vault_tree(user_data))
+            differing_entries = {
+                tuple(entry) for entries in differences.values() for entry in entries
+            }
+
+            operations = [
+                operation for operation in operations
+                if (operation["service"], operation["username"]) in differing_entries
+            ]
+
+        if operations == []:
+            # Nothing left that the server doesn't already have
+            return {"status": "ok", "payload": {"version": expected_version}}, operations, merged
+
+        return response, operations, merged
+
     async def download_passwords(self, button_called: toga.Button):
         if button_called.text == "Recover Passwords":
             server_address = self.server_address_entry.value
@@ -4101,13 +4261,16 @@ class PyPass(toga.App):
                 await self.dialog(dialog)
                 return self.return_to_home_screen()
 
-            await asyncio.to_thread(self.server.sendall, self.user_entry.value.encode())
-            encrypted_server_key = await asyncio.to_thread(self.server.recv, 1024)
+            await asyncio.to_thread(protocol.send_frame, self.server, protocol.HANDSHAKE, self.user_entry.value.encode())
+            await asyncio.to_thread(protocol.send_frame, self.server, protocol.HANDSHAKE, os.environ["MAIN_KEY"].encode())
 
             try:
+                _, encrypted_server_key = await asyncio.to_thread(protocol.read_frame, self.server)
                 self.server_key = self.main_fernet.decrypt(encrypted_server_key)
 
-            except ValueError:
+                await self.negotiate_session()
+
+            except (ValueError, ConnectionError, protocol.ProtocolError):
                 dialog = toga.ErrorDialog(
                     title=self.error_title,
                     message="The server sent an invalid key. Please restart the app, and try again"
@@ -4151,29 +4314,6 @@ class PyPass(toga.App):
             if not server_exists:
                 return None
 
-        print("Sending download command")
-        self.server.sendall(
-            Fernet(self.server_key).encrypt(self.main_fernet.encrypt(b"DOWNLOAD_DATA"))
-        )
-
-        print("Sent download command to server, await response")
-
-        downloaded_user_data_str: str = await self.receive_all()
-
-        if downloaded_user_data_str.startswith("Failed to download passwords. "):
-            dialog = toga.ErrorDialog(
-                title=self.error_title,
-                message=f"Failed to download password from server. Reason: {downloaded_user_data_str.replace('Failed to download passwords. ', '')}"
-            )
-
-            self.return_to_home_screen()
-            return await self.dialog(dialog)
-
-        await asyncio.to_thread(self.server.close)
-        self.server = None
-
-        print("Received response")
-
         if not button_called.text == "Recover Passwords":
             dialog = toga.ConfirmDialog(
                 title=self.confirm_title,
@@ -4187,49 +4327,116 @@ class PyPass(toga.App):
         else:
             dialog_result = True
 
-        if dialog_result:
-            downloaded_server_data = json_repair.loads(downloaded_user_data_str)
+        if not dialog_result:
+            await asyncio.to_thread(self.server.close)
+            self.server = None
+
+            return self.return_to_home_screen()
+
+        print("Sending download command")
+        request_id = await self.send_request("download", "STREAM", wait_for_response=False)
+
+        print("Sent download command to server, await response")
+
+        # The server sends one partial response per service and then the final response. Every service is
+        # re-encrypted as soon as it arrives, so the whole decrypted vault is never held at once
+        digest_key = self.get_digest_key()
+        vault_tree = merkle.VaultTree()
+        downloaded_server_data = {}
+
+        while True:
+            response = await self.receive_response(request_id)
+
+            if response["status"] == "ok":
+                # The final response carries the vault version the download was taken at
+                downloaded_version = response["payload"].get("version")
+                break
 
-            for downloaded_service in downloaded_server_data.keys():
-                for downloaded_username in downloaded_server_data[downloaded_service].keys():
-                    password = downloaded_server_data[downloaded_service][downloaded_username]["password"]
-                    key = downloaded_server_data[downloaded_service][downloaded_username]["key"]
+            if response["status"] == "error":
+                await asyncio.to_thread(self.server.close)
+                self.server = None
+
+                dialog = toga.ErrorDialog(
+                    title=self.error_title,
+                    message=f"Failed to download password from server. Reason: {response['error'].replace('Failed to download passwords. ', '')}"
+                )
+
+                self.return_to_home_screen()
+                return await self.dialog(dialog)
+
+            downloaded_chunk = response["payload"]
+
+            for downloaded_service in downloaded_chunk.keys():
+                downloaded_server_data[downloaded_service] = {}
+
+                for downloaded_username, downloaded_entry in downloaded_chunk[downloaded_service].items():
+                    password = downloaded_entry["password"]
+                    key = downloaded_entry["key"]
                     cipher = Fernet(key.encode())
 
+                    vault_tree.set_leaf(
+                        downloaded_service,
+                        downloaded_username,
+                        merkle.password_digest(digest_key, password),
+                        rehash=False
+                    )
+
                     downloaded_server_data[downloaded_service][downloaded_username] = {
                         "password": cipher.encrypt(password.encode()).decode(),
                         "key": self.main_fernet.encrypt(key.encode()).decode()
                     }
 
-            user = self.user_entry.value
-            password = self.password_entry.value
-            encryption_key = Fernet.generate_key()
+        await asyncio.to_thread(self.server.close)
+        self.server = None
 
-            downloaded_user_data = {
-                user: Fernet(encryption_key).encrypt(password.encode()).decode(),
-                "key": self.main_fernet.encrypt(encryption_key).decode(),
-                "data": downloaded_server_data,
-                "servers": self.load_user_passwords()["servers"]
-            }
+        print("Received response")
 
-            with open(data_path, mode="w") as data_file:
-                json.dump(downloaded_user_data, data_file, indent=4)
+        vault_tree.rehash(vault_tree.root)
 
-            if not button_called.text == "Recover Passwords":
-                dialog = toga.InfoDialog(
-                    title=self.success_title,
-                    message=f"Successfully downloaded passwords from server titled {server_title}"
-                )
+        user = self.user_entry.value
+        password = self.password_entry.value
+        encryption_key = Fernet.generate_key()
 
-                await self.dialog(dialog)
+        previous_user_data = self.load_user_passwords()
 
-            else:
-                dialog = toga.InfoDialog(
-                    title=self.success_title,
-                    message="Successfully recovered data"
-                )
+        # What any server was synced at describes the replaced data, so every server is compared from scratch on
+        # its next upload. The version counter carries on, so later edits are still newer than anything synced
+        for server in previous_user_data["servers"].values():
+            server.pop("synced_version", None)
+            server.pop("server_version", None)
 
-                await self.dialog(dialog)
+        downloaded_user_data = {
+            user: Fernet(encryption_key).encrypt(password.encode()).decode(),
+            "key": self.main_fernet.encrypt(encryption_key).decode(),
+            "data": downloaded_server_data,
+            "version": previous_user_data.get("version", 0),
+            "servers": previous_user_data["servers"]
+        }
+
+        if not button_called.text == "Recover Passwords" and downloaded_version is not None:
+            # The server holds exactly the downloaded data, so later uploads to it can be sent as deltas
+            downloaded_user_data["servers"][server_title]["synced_version"] = downloaded_user_data["version"]
+            downloaded_user_data["servers"][server_title]["server_version"] = downloaded_version
+
+        persistence.write_file(data_path, codec.encode(downloaded_user_data))
+
+        self.save_vault_tree(vault_tree, os.path.join(os.path.dirname(data_path), ".tree.json"))
+
+        if not button_called.text == "Recover Passwords":
+            dialog = toga.InfoDialog(
+                title=self.success_title,
+                message=f"Successfully downloaded passwords from server titled {server_title}"
+            )
+
+            await self.dialog(dialog)
+
+        else:
+            dialog = toga.InfoDialog(
+                title=self.success_title,
+                message="Successfully recovered data"
+            )
+
+            await self.dialog(dialog)
 
         return self.return_to_home_screen()
 
@@ -4266,15 +4473,17 @@ class PyPass(toga.App):
 
             return await self.dialog(dialog)
 
-        self.server.sendall(self.logged_in_user.encode())
-        await asyncio.to_thread(self.server.sendall, os.environ["MAIN_KEY"].encode())
+        await asyncio.to_thread(protocol.send_frame, self.server, protocol.HANDSHAKE, self.logged_in_user.encode())
+        await asyncio.to_thread(protocol.send_frame, self.server, protocol.HANDSHAKE, os.environ["MAIN_KEY"].encode())
         print("Sent logged in user and main key")
 
         try:
-            encrypted_server_key = await asyncio.to_thread(self.server.recv, 1024)
+            _, encrypted_server_key = await asyncio.to_thread(protocol.read_frame, self.server)
             self.server_key = self.main_fernet.decrypt(encrypted_server_key)
 
-        except ValueError:
+            await self.negotiate_session()
+
+        except (ValueError, ConnectionError, protocol.ProtocolError):
             dialog = toga.ErrorDialog(
                 title=self.error_title,
                 message="The server sent an invalid key. Please restart the app, and try again"
@@ -4291,6 +4500,23 @@ class PyPass(toga.App):
         self.return_to_home_screen()
         return await self.dialog(dialog)
 
+    async def find_server_differences(self, vault_tree: merkle.VaultTree) -> dict:
+        # Walk the server's hash tree from the root, only descending into nodes whose digests differ from ours
+        differences = merkle.empty_differences()
+        requested_paths = [[]]
+
+        while requested_paths != []:
+            server_nodes = (await self.send_request("tree_digests", payload=requested_paths))["payload"]
+
+            next_paths = []
+
+            for path, server_node in zip(requested_paths, server_nodes):
+                next_paths += merkle.compare_nodes(vault_tree, path, server_node, differences)
+
+            requested_paths = next_paths
+
+        return differences
+
     async def check_for_server(self, server_title: str) -> bool:
         user_data = self.load_user_passwords()
 
@@ -4324,38 +4550,79 @@ class PyPass(toga.App):
         for widget in widgets:
             self.a_box.add(widget)
 
-    async def receive_all(self) -> str:
-        print("Receive_all called")
-        print(self.server_key)
-        cipher = Fernet(self.server_key)
+    async def negotiate_session(self):
+        # Ask the server for a single layer session cipher instead of encrypting every message twice
+        offer, nonce = protocol.session_offer()
+        self.session_channel = None
 
-        encrypted_received_data: bytes = b""
+        await asyncio.to_thread(protocol.send_frame, self.server, protocol.HANDSHAKE, offer)
+        message_type, answer = await asyncio.to_thread(protocol.read_frame, self.server)
 
-        while True:
-            print("Receiving new data")
-            new_received_data = self.server.recv(1024)
+        if message_type != protocol.HANDSHAKE:
+            raise protocol.ProtocolError("Expected a handshake frame")
 
-            print(
-                f"\n ------------------------------ \n    Total received data: {encrypted_received_data} \n ------------------------------ ")
-            print(
-                f"\n ------------------------------ \n    New data received: {new_received_data} \n ------------------------------ ")
+        cipher_name = json.loads(answer).get("session_cipher")
 
-            try:
-                print("Trying to decrypt total received data")
+        if cipher_name is not None:
+            self.session_channel = protocol.SessionChannel(self.server_key, cipher_name, nonce, is_server=False)
 
-                encrypted_received_data += new_received_data
-                decrypted_received_data: str = cipher.decrypt(
-                    self.main_fernet.decrypt(encrypted_received_data)).decode()
+        print(f"Negotiated session cipher {cipher_name}")
 
-            except cryptography.fernet.InvalidToken:
-                print("Couldn't decrypt received data")
+    async def send_message(self, data: bytes):
+        if self.session_channel is not None:
+            encrypted_data = self.session_channel.encrypt(data)
 
-            else:
-                print("Data was successfully decrypted, breaking out of while loop")
-                encrypted_received_data = b""
-                break
+            return await asyncio.to_thread(protocol.send_frame, self.server, protocol.SESSION_DATA, encrypted_data)
+
+        server_cipher = Fernet(self.server_key)
+        encrypted_data = server_cipher.encrypt(self.main_fernet.encrypt(data))
+
+        await asyncio.to_thread(protocol.send_frame, self.server, protocol.DATA, encrypted_data)
+
+    async def send_request(self, op: str, mode: str = None, payload=None, wait_for_response: bool = True,
+                           expected_version: int = None) -> dict | int:
+        # Typed request, answered by {"id", "status": "ok" | "error" | "partial", "payload" | "error"}. Returns
+        # the response, or the request id when the caller reads the responses itself. Writes sent with an
+        # expected_version are rejected with a retryable "conflict" error if the vault moved past that version
+        self.request_id += 1
+
+        request = {
+            "op": op,
+            "mode": mode,
+            "payload": payload,
+            "id": self.request_id
+        }
 
-        return decrypted_received_data
+        if expected_version is not None:
+            request["expected_version"] = expected_version
+
+        await self.send_message(json.dumps(request).encode())
+
+        if not wait_for_response:
+            return self.request_id
+
+        return await self.receive_response(self.request_id)
+
+    async def receive_response(self, request_id: int) -> dict:
+        response = json.loads(await self.receive_all())
+
+        if response.get("id") != request_id:
+            raise protocol.ProtocolError(f"Expected the response to request {request_id}, received {response.get('id')}")
+
+        return response
+
+    async def receive_all(self) -> str:
+        message_type, received_data = await asyncio.to_thread(protocol.read_frame, self.server)
+
+        if message_type in (protocol.STATUS, protocol.END_OF_STREAM):
+            return received_data.decode()
+
+        if message_type == protocol.SESSION_DATA:
+            return self.session_channel.decrypt(received_data).decode()
+
+        cipher = Fernet(self.server_key)
+
+        return cipher.decrypt(self.main_fernet.decrypt(received_data)).decode()
 
     async def validate_values(self, to_validate: dict, message_for_dialog: str or None, expected_value: str = "",
                               dialog_to_raise=None, inverse_check: bool = False):
@@ -4400,6 +4667,65 @@ class PyPass(toga.App):
 
         return True
 
+    def get_digest_key(self) -> bytes:
+        return merkle.derive_digest_key(os.environ["MAIN_KEY"].encode())
+
+    def load_vault_tree(self, user_data: dict) -> merkle.VaultTree:
+        tree_path = os.path.join(os.path.dirname(self.data_file_path), ".tree.json")
+
+        if os.path.exists(tree_path):
+            try:
+                with open(tree_path, mode="r") as tree_file:
+                    return merkle.VaultTree(json.load(tree_file))
+
+            except json.decoder.JSONDecodeError:
+                print("Saved hash tree is invalid, rebuilding it")
+
+        # No tree saved yet, build one from the saved passwords
+        saved_passwords = {}
+
+        for service in user_data.get("data", {}).keys():
+            for username, entry in user_data["data"][service].items():
+                cipher = Fernet(self.main_fernet.decrypt(entry["key"]))
+                saved_passwords.setdefault(service, {})[username] = cipher.decrypt(entry["password"]).decode()
+
+        vault_tree = merkle.VaultTree.from_passwords(self.get_digest_key(), saved_passwords)
+        self.save_vault_tree(vault_tree, tree_path)
+
+        return vault_tree
+
+    def save_vault_tree(self, vault_tree: merkle.VaultTree, tree_path: str = None):
+        if tree_path is None:
+            tree_path = os.path.join(os.path.dirname(self.data_file_path), ".tree.json")
+
+        persistence.write_json(tree_path, vault_tree.to_dict(), separators=(",", ":"))
+
+    @staticmethod
+    def next_data_version(user_data: dict) -> int:
+        user_data["version"] = user_data.get("version", 0) + 1
+
+        return user_data["version"]
+
+    @staticmethod
+    def prune_deleted(user_data: dict):
+        # Deletions every synced server has already received don't need to be remembered any more
+        synced_versions = [
+            server["synced_version"] for server in user_data.get("servers", {}).values() if "synced_version" in server
+        ]
+
+        if synced_versions == [] or "deleted" not in user_data.keys():
+            return
+
+        oldest_synced_version = min(synced_versions)
+
+        for service in list(user_data["deleted"].keys()):
+            for username, deleted_version in list(user_data["deleted"][service].items()):
+                if deleted_version <= oldest_synced_version:
+                    del user_data["deleted"][service][username]
+
+            if user_data["deleted"][service] == {}:
+                del user_data["deleted"][service]
+
     @staticmethod
     def copy_to_clipboard(data_to_copy: str):
         if toga.platform.current_platform.lower() == "android" or "window" in toga.platform.current_platform.lower():
@@ -0,0 +1,149 @@
+# Serialization of saved vaults, shared by the app and the server
+
+# A vault file starts with a 4 byte header, then the vault encoded with the codec the header names:
+# +-------+----------------+-------+
+# | magic | format version | codec |
+# | "PV"  | 1 byte         | 1 byte|
+# +-------+----------------+-------+
+# Files without the header were written as indented json by older versions, sometimes json encoded twice. They
+# are read transparently and written back with a header on their next save
+
+# msgpack and cbor2 are optional, a codec whose package isn't installed can't be chosen but files written with it
+# are still recognised so the error is clear
+
+import json
+import struct
+import logging
+import collections
+
+import json_repair
+
+try:
+    import msgpack
+
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PV"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("!2sBB")
+
+CODEC_IDS = {
+    "json": 1,
+    "msgpack": 2,
+    "cbor": 3
+}
+
+CODEC_NAMES = {codec_id: codec_name for codec_name, codec_id in CODEC_IDS.items()}
+
+# How often legacy files were read, and how often strict parsing failed and json_repair had to step in
+counters = collections.Counter()
+
+
+class CodecError(Exception):
+    pass
+
+
+def available_codecs() -> list[str]:
+    return [
+        codec_name for codec_name, module in (("json", json), ("msgpack", msgpack), ("cbor", cbor2))
+        if module is not None
+    ]
+
+
+def encode(data, codec_name: str = "json") -> bytes:
+    if codec_name not in available_codecs():
+        raise CodecError(f"Codec {codec_name} isn't available")
+
+    if codec_name == "msgpack":
+        encoded_data = msgpack.packb(data, use_bin_type=True)
+
+    elif codec_name == "cbor":
+        encoded_data = cbor2.dumps(data)
+
+    else:
+        encoded_data = json.dumps(data, separators=(",", ":")).encode()
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, CODEC_IDS[codec_name]) + encoded_data
+
+
+def is_legacy(raw_data: bytes) -> bool:
+    return not raw_data.startswith(MAGIC)
+
+
+def decode(raw_data: bytes):
+    if is_legacy(raw_data):
+        return decode_legacy(raw_data)
+
+    if len(raw_data) < HEADER.size:
+        raise CodecError("Vault header is cut off")
+
+    _, format_version, codec_id = HEADER.unpack_from(raw_data)
+
+    if format_version != FORMAT_VERSION:
+        raise CodecError(f"Unsupported vault format version {format_version}")
+
+    codec_name = CODEC_NAMES.get(codec_id)
+
+    if codec_name is None:
+        raise CodecError(f"Unknown vault codec {codec_id}")
+
+    if codec_name not in available_codecs():
+        raise CodecError(f"The vault was written with {codec_name}, which isn't installed")
+
+    encoded_data = raw_data[HEADER.size:]
+
+    if codec_name == "msgpack":
+        return msgpack.unpackb(encoded_data, raw=False)
+
+    if codec_name == "cbor":
+        return cbor2.loads(encoded_data)
+
+    try:
+        return json.loads(encoded_data)
+
+    except json.JSONDecodeError:
+        return repair(encoded_data.decode(errors="replace"))
+
+
+def decode_legacy(raw_data: bytes):
+    counters["legacy_reads"] += 1
+
+    text = raw_data.decode(errors="replace")
+
+    if text.strip() == "":
+        return ""
+
+    try:
+        data = json.loads(text)
+
+    except json.JSONDecodeError:
+        data = repair(text)
+
+    # Older REPLACE writes stored the vault as a json encoded string
+    if isinstance(data, str) and data != "":
+        try:
+            data = json.loads(data)
+
+        except json.JSONDecodeError:
+            data = repair(data)
+
+    return data
+
+
+def repair(text: str):
+    counters["repair_fallbacks"] += 1
+    logger.warning(
+        f"Strict parsing of a saved vault failed, repaired it with json_repair ({counters['repair_fallbacks']} so far)"
+    )
+
+    return json_repair.loads(text)
@@ -4,6 +4,9 @@ import json_repair
 import uvicorn
 from fastapi import FastAPI
 
+from pypass import persistence
+from pypass import codec
+
 fastapi_server = FastAPI()
 
 class MigrationServer:
@@ -22,11 +25,9 @@ class MigrationServer:
         env_data["MAIN_KEY"] = main_key
 
 
-        with open(os.path.join(data_path, current_user, ".passwords.json"), mode="w") as passwords_file:
-            json.dump(user_data, passwords_file)
-
-        with open(os.path.join(data_path, ".env"), mode="w") as env_file:
-            json.dump(env_data, env_file)
+        # Both files are replaced atomically, an interrupted migration leaves the old ones in place
+        persistence.write_file(os.path.join(data_path, current_user, ".passwords.json"), codec.encode(user_data))
+        persistence.write_json(os.path.join(data_path, ".env"), env_data)
 
         os.environ['MIGRATION_SUCCESSFUL'] = "true"
 
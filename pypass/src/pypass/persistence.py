@@ -0,0 +1,196 @@
+# Crash safe file writes, shared by the app and the server
+
+# A file is never written in place. The new contents go to a temporary file next to it, which is fsynced and then
+# renamed over the old file, so a crash leaves either the old or the new file and never a truncated one. The
+# directory is fsynced after the rename so the rename itself survives a power loss. Writes that are made durable
+# some other way (see wal.py) can skip the fsyncs and keep only the atomic rename
+
+# GroupCommit is used by the server, where many sessions save vaults at once. Writers queue their temporary files
+# and one commit thread makes durable and renames every file queued within a short window, so a burst of saves
+# across many users shares a single wait on the disk instead of each paying for its own fsyncs
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+
+def write_temporary(path: str, data: bytes) -> str:
+    # Temporary files are created owner only, the files they replace hold keys and passwords
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp"
+    )
+
+    try:
+        with os.fdopen(file_descriptor, mode="wb") as temporary_file:
+            temporary_file.write(data)
+
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+    return temporary_path
+
+
+def fsync_path(path: str):
+    # Directories can't be opened on Windows, renames there are only as durable as the file system makes them
+    if os.path.isdir(path) and os.name == "nt":
+        return
+
+    file_descriptor = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(file_descriptor)
+
+    finally:
+        os.close(file_descriptor)
+
+
+def commit_files(files: list[tuple[str, str]], durable: bool = True):
+    # files is a list of (temporary path, path). Every temporary file is made durable before the first rename, so
+    # files saved together are replaced in order once all of them are on disk
+    if durable:
+        for temporary_path, _ in files:
+            fsync_path(temporary_path)
+
+    for temporary_path, path in files:
+        os.replace(temporary_path, path)
+
+    if durable:
+        for directory in {os.path.dirname(path) or "." for _, path in files}:
+            fsync_path(directory)
+
+
+def discard_files(files: list[tuple[str, str]]):
+    for temporary_path, _ in files:
+        try:
+            os.remove(temporary_path)
+
+        except FileNotFoundError:
+            pass
+
+
+def encode(data: bytes | str) -> bytes:
+    return data.encode() if isinstance(data, str) else data
+
+
+def write_files(files: list[tuple[str, bytes | str]], group_commit: "GroupCommit" = None, durable: bool = True):
+    # Atomically replaces every file in files, a list of (path, contents)
+    temporary_files = []
+
+    try:
+        for path, data in files:
+            temporary_files.append((write_temporary(path, encode(data)), path))
+
+        if group_commit is not None and durable:
+            group_commit.commit(temporary_files)
+
+        else:
+            commit_files(temporary_files, durable)
+
+    except BaseException:
+        discard_files(temporary_files)
+        raise
+
+
+def write_file(path: str, data: bytes | str, group_commit: "GroupCommit" = None, durable: bool = True):
+    write_files([(path, data)], group_commit, durable)
+
+
+def write_json(path: str, data, group_commit: "GroupCommit" = None, durable: bool = True, **dump_arguments):
+    write_file(path, json.dumps(data, **dump_arguments), group_commit, durable)
+
+
+class PendingCommit:
+    def __init__(self, files: list[tuple[str, str]]):
+        self.files = files
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommit:
+    def __init__(self, window: float = 0.002):
+        # window is how long, in seconds, the commit thread waits for more writers after the first one arrives
+        self.window = window
+        self.condition = threading.Condition()
+        self.pending: list[PendingCommit] = []
+        self.commit_thread = None
+        self.commit_pid = None
+        self.commits = 0
+        self.committed_files = 0
+
+    def commit(self, files: list[tuple[str, str]]):
+        # Blocks until the files are durable and renamed into place
+        pending_commit = PendingCommit(files)
+
+        with self.condition:
+            # A forked worker process inherits the object but not the parent's commit thread
+            if self.commit_thread is None or self.commit_pid != os.getpid():
+                self.commit_thread = threading.Thread(target=self.run, name="group-commit", daemon=True)
+                self.commit_pid = os.getpid()
+                self.commit_thread.start()
+
+            self.pending.append(pending_commit)
+            self.condition.notify()
+
+        pending_commit.done.wait()
+
+        if pending_commit.error is not None:
+            raise pending_commit.error
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending == []:
+                    self.condition.wait()
+
+            if self.window > 0:
+                time.sleep(self.window)
+
+            with self.condition:
+                batch, self.pending = self.pending, []
+
+            try:
+                self.commit_batch(batch)
+
+            except Exception as error:
+                # Nothing in the batch is known to be durable, every writer is failed rather than left waiting
+                for pending_commit in batch:
+                    pending_commit.error = pending_commit.error or error
+
+            for pending_commit in batch:
+                pending_commit.done.set()
+
+    def commit_batch(self, batch: list[PendingCommit]):
+        # A batch with a single writer is committed like any other write. A larger one is flushed with one sync of
+        # the file systems before the renames and one after, however many files it holds
+        if len(batch) == 1 or not hasattr(os, "sync"):
+            for pending_commit in batch:
+                try:
+                    commit_files(pending_commit.files)
+
+                except Exception as error:
+                    pending_commit.error = error
+
+        else:
+            os.sync()
+
+            for pending_commit in batch:
+                try:
+                    for temporary_path, path in pending_commit.files:
+                        os.replace(temporary_path, path)
+
+                except Exception as error:
+                    pending_commit.error = error
+
+            os.sync()
+
+        self.commits += 1
+        self.committed_files += sum(len(pending_commit.files) for pending_commit in batch if pending_commit.error is None)
+
+    def stats(self) -> dict:
+        return {"commits": self.commits, "files": self.committed_files}
@@ -0,0 +1,177 @@
+# Wire framing used between the pypass app and the server
+
+# Every message is sent as a single frame:
+#   magic (2 bytes) | version (1 byte) | message type (1 byte) | payload length (4 bytes, big endian) | payload
+# The receiver reads the fixed size header, then reads exactly payload length bytes, so a message is
+# read in one pass and decrypted once
+
+# Session channel: after the server has sent its session key, the app offers the session ciphers it supports in
+# another handshake frame, {"session_ciphers": [...], "nonce": base64 nonce}, and the server answers with
+# {"session_cipher": chosen cipher or null}. Once a cipher is chosen both sides derive one key from the session key
+# and the nonce, and every payload is sent as a SESSION_DATA frame encrypted once with that key, as raw bytes.
+# Without a session cipher payloads are sent as DATA frames, encrypted with the session key and the main key
+# (Fernet inside Fernet)
+
+import json
+import base64
+import struct
+import socket
+import asyncio
+import secrets
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+MAGIC = b"PP"
+PROTOCOL_VERSION = 1
+
+FRAME_HEADER = struct.Struct("!2sBBI")
+
+# Largest payload we are willing to buffer for a single frame
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Message types
+HANDSHAKE = 0x01  # Unencrypted connection setup values (client user, client key, server key)
+DATA = 0x02       # Encrypted request or response payload
+STATUS = 0x03     # Unencrypted status message, eg "Successfully updated data"
+SESSION_DATA = 0x04  # Request or response payload encrypted with the negotiated session cipher
+END_OF_STREAM = 0x05  # Unencrypted end of a streamed response, eg the per service frames of a download
+
+MESSAGE_TYPES = (HANDSHAKE, DATA, STATUS, SESSION_DATA, END_OF_STREAM)
+
+# In order of preference
+SESSION_CIPHERS = {
+    "aes-gcm": AESGCM,
+    "chacha20-poly1305": ChaCha20Poly1305
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(message_type: int, payload: bytes) -> bytes:
+    if message_type not in MESSAGE_TYPES:
+        raise ProtocolError(f"Unknown message type {message_type}")
+
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Payload of {len(payload)} bytes is larger than the maximum frame size")
+
+    return FRAME_HEADER.pack(MAGIC, PROTOCOL_VERSION, message_type, len(payload)) + payload
+
+
+def decode_header(header: bytes) -> tuple[int, int]:
+    magic, version, message_type, payload_length = FRAME_HEADER.unpack(header)
+
+    if magic != MAGIC:
+        raise ProtocolError("Received data isn't a pypass frame")
+
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+
+    if message_type not in MESSAGE_TYPES:
+        raise ProtocolError(f"Unknown message type {message_type}")
+
+    if payload_length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {payload_length} bytes is larger than the maximum frame size")
+
+    return message_type, payload_length
+
+
+def recv_exactly(connection: socket.socket, size: int) -> bytes:
+    # Collect chunks in a bytearray so reading a large payload stays linear
+    received_data = bytearray()
+
+    while len(received_data) < size:
+        new_received_data = connection.recv(min(size - len(received_data), 65536))
+
+        if new_received_data == b"":
+            raise ConnectionError("Connection closed before the whole frame was received")
+
+        received_data += new_received_data
+
+    return bytes(received_data)
+
+
+def send_frame(connection: socket.socket, message_type: int, payload: bytes):
+    connection.sendall(encode_frame(message_type, payload))
+
+
+def read_frame(connection: socket.socket) -> tuple[int, bytes]:
+    message_type, payload_length = decode_header(recv_exactly(connection, FRAME_HEADER.size))
+
+    return message_type, recv_exactly(connection, payload_length)
+
+
+async def read_frame_async(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        message_type, payload_length = decode_header(header)
+
+        return message_type, await reader.readexactly(payload_length)
+
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed before the whole frame was received")
+
+
+async def write_frame(writer: asyncio.StreamWriter, message_type: int, payload: bytes):
+    writer.write(encode_frame(message_type, payload))
+    await writer.drain()
+
+
+def session_offer() -> tuple[bytes, bytes]:
+    # Returns the handshake payload offering a session cipher, and the nonce it carries
+    nonce = secrets.token_bytes(16)
+    offer = {"session_ciphers": list(SESSION_CIPHERS.keys()), "nonce": base64.b64encode(nonce).decode()}
+
+    return json.dumps(offer).encode(), nonce
+
+
+def choose_session_cipher(offer_payload: bytes) -> tuple[str | None, bytes]:
+    try:
+        offer = json.loads(offer_payload)
+        offered_ciphers = offer["session_ciphers"]
+        nonce = base64.b64decode(offer["nonce"])
+
+    except (ValueError, KeyError, TypeError):
+        raise ProtocolError("Invalid session cipher offer")
+
+    for cipher_name in SESSION_CIPHERS.keys():
+        if cipher_name in offered_ciphers:
+            return cipher_name, nonce
+
+    return None, nonce
+
+
+class SessionChannel:
+    # One AEAD key per connection. Nonces are a fixed prefix per direction followed by a message counter, so
+    # they are never reused and never sent, and a replayed, dropped or reordered frame fails to decrypt
+    def __init__(self, session_key: bytes, cipher_name: str, nonce: bytes, is_server: bool):
+        channel_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=nonce,
+            info=b"pypass session " + cipher_name.encode()
+        ).derive(session_key)
+
+        self.cipher_name = cipher_name
+        self.aead = SESSION_CIPHERS[cipher_name](channel_key)
+
+        self.send_prefix, self.receive_prefix = (b"srv\0", b"cli\0") if is_server else (b"cli\0", b"srv\0")
+        self.send_counter = 0
+        self.receive_counter = 0
+
+    def encrypt(self, data: bytes) -> bytes:
+        nonce = self.send_prefix + self.send_counter.to_bytes(8, "big")
+        self.send_counter += 1
+
+        return self.aead.encrypt(nonce, data, bytes([SESSION_DATA]))
+
+    def decrypt(self, data: bytes) -> bytes:
+        # Raises cryptography.exceptions.InvalidTag if the frame was tampered with or is out of order
+        nonce = self.receive_prefix + self.receive_counter.to_bytes(8, "big")
+        decrypted_data = self.aead.decrypt(nonce, data, bytes([SESSION_DATA]))
+        self.receive_counter += 1
+
+        return decrypted_data